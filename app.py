@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 import sys
+import hmac
 import json
 import shutil
 import subprocess
@@ -8,42 +9,83 @@ import datetime
 import time
 import queue
 import psutil
+import logging
+import threading
 from threading import Thread
 from flask import (
     Flask, request, render_template, redirect, url_for,
-    jsonify, flash, Response, stream_with_context, session, after_this_request
+    jsonify, flash, Response, stream_with_context, session, after_this_request, g
 )
 from flask_httpauth import HTTPBasicAuth
-from dotenv import load_dotenv
+import config
+import offload_pipeline
+import offload_index
+import planner
+import retry_queue
+import job_manager
+import event_bus
+import eviction
+import uploader
+import metrics
+import metrics_sampler
+import network_monitor
+import notifier
+import cached_task
+import log_tail
+import structured_log
+import upload_scheduler
 
 # Define project directory
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
-dotenv_path = os.path.join(PROJECT_DIR, '.env')
-if os.path.exists(dotenv_path):
-    load_dotenv(dotenv_path, override=True)
-else:
+dotenv_path = config.DOTENV_PATH
+if not config.dotenv_exists():
     print(f"Warning: .env file not found at {dotenv_path}", file=sys.stderr)
 
 app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "default_insecure_secret_key_change_me!")
+app.secret_key = config.get_str("FLASK_SECRET_KEY", "default_insecure_secret_key_change_me!")
 auth = HTTPBasicAuth()
+jobs = job_manager.JobManager()
 
 # Global Variables and Paths
-MONITORED_DISK_PATH = os.getenv("MONITORED_DISK_PATH", "/")
-SD_MOUNT_PATH = os.getenv("SD_MOUNT_PATH", "")  # Set if used
+MONITORED_DISK_PATH = config.get_str("MONITORED_DISK_PATH", "/")
+SD_MOUNT_PATH = config.get_str("SD_MOUNT_PATH", "")  # Set if used
+# Several readers: SD_MOUNT_PATHS="/media/a,/media/b"; cards found by card_watcher.py need no entry.
+SD_MOUNT_PATHS = [p.strip() for p in config.get_str("SD_MOUNT_PATHS", "").split(",") if p.strip()] or \
+    ([SD_MOUNT_PATH] if SD_MOUNT_PATH else [])
 CONFIG_BACKUP_PATH = os.path.join(PROJECT_DIR, "config_backups")
-EMAIL_CONFIG_PATH = os.getenv("EMAIL_CONFIG", os.path.join(PROJECT_DIR, "email_config.json"))
-RCLONE_CONFIG_PATH = os.getenv("RCLONE_CONFIG", os.path.join(PROJECT_DIR, "rclone.conf"))
-INTERNAL_NOTIFY_TOKEN = os.getenv("INTERNAL_NOTIFY_TOKEN", "replace_with_your_generated_secure_random_notify_token")
+EMAIL_CONFIG_PATH = config.EMAIL_CONFIG_PATH
+RCLONE_CONFIG_PATH = config.rclone_settings()["config_path"]
+# card_watcher.py mounts cards below this; /internal/card_event accepts no other mount
+# that is not listed in SD_MOUNT_PATHS.
+CARD_MOUNT_BASE = config.get_str("CARD_MOUNT_BASE", "/media/sdcards")
+if not config.internal_notify_token():
+    print("Warning: INTERNAL_NOTIFY_TOKEN is not set in .env; card_watcher.py cannot queue offloads.",
+          file=sys.stderr)
+
+# In-process transfer stages log to upload.log, like the shell scripts do.
+os.makedirs(os.path.join(PROJECT_DIR, "logs"), exist_ok=True)
+_transfer_log = structured_log.JsonLinesHandler(os.path.join(PROJECT_DIR, "logs", "upload.log"))
+for _name in ("offload_engine", "offload_pipeline", "uploader", "upload_scheduler", "card_stream",
+              "eviction", "job_manager"):
+    logging.getLogger(_name).addHandler(_transfer_log)
+    logging.getLogger(_name).setLevel(logging.INFO)
+logging.getLogger("notifier").addHandler(
+    structured_log.JsonLinesHandler(os.path.join(PROJECT_DIR, "logs", "notification.log")))
+logging.getLogger("notifier").setLevel(logging.INFO)
+
+# Email goes out from a background thread that keeps its SMTP session open;
+# finished jobs are collected into one digest email per NOTIFY_DIGEST_SECONDS.
+mailer = notifier.Notifier().start()
+NOTIFY_EMAIL_JOBS = config.get_bool("NOTIFY_EMAIL_JOBS", True)
 
 # Helper Functions
 def add_notification(message, msg_type="info"):
     app.logger.info(f"Notification [{msg_type}]: {message}")
+    event_bus.notify(message, msg_type)
 
-def save_email_config(config):
+def save_email_config(settings):
     try:
-        with open(EMAIL_CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=4)
+        config.save_email_config(settings)
         flash("Email configuration saved.", "success")
         app.logger.info("Email configuration saved.")
     except Exception as e:
@@ -51,81 +93,239 @@ def save_email_config(config):
         flash(f"Error saving email config: {e}", "error")
 
 def load_email_config():
-    try:
-        with open(EMAIL_CONFIG_PATH, 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        app.logger.error(f"Error loading email config: {e}")
+    settings = config.email_config()
+    if settings is None:
+        app.logger.error(f"Error loading email config from {EMAIL_CONFIG_PATH}")
         return {}
+    return settings
 
-def get_system_status():
+def _index_probe():
     status = {}
     try:
-        usage = shutil.disk_usage(MONITORED_DISK_PATH)
-        status['free_space_mb'] = usage.free // (1024**2)
-        status['disk_percent'] = int(usage.used / usage.total * 100) if usage.total > 0 else "N/A"
-    except Exception as e:
-        app.logger.error(f"Error reading disk usage: {e}")
-        status['free_space_mb'] = 'N/A'
-        status['disk_percent'] = 'N/A'
-    try:
-        status['cpu_usage'] = psutil.cpu_percent(interval=0.5)
+        conn = offload_index.connect()
+        counts = offload_index.state_counts(conn)
+        retries = retry_queue.summary(conn)
+        conn.close()
+        status['pending_upload'] = counts[offload_index.STATE_COPIED] + counts[offload_index.STATE_VERIFIED]
+        status['uploaded_total'] = counts[offload_index.STATE_UPLOADED] + counts[offload_index.STATE_DELETED]
+        status['failed_uploads'] = retries['queued']
     except Exception as e:
-        app.logger.error(f"Error reading CPU usage: {e}")
-        status['cpu_usage'] = 'N/A'
-    try:
-        status['mem_usage'] = psutil.virtual_memory().percent
-    except Exception as e:
-        app.logger.error(f"Error reading memory usage: {e}")
-        status['mem_usage'] = 'N/A'
-    try:
-        status['sd_card_mounted'] = os.path.ismount(SD_MOUNT_PATH) if SD_MOUNT_PATH else False
-        status['sd_card_path_exists'] = os.path.exists(SD_MOUNT_PATH) if SD_MOUNT_PATH else False
-    except Exception as e:
-        app.logger.error(f"Error checking SD mount status: {e}")
-        status['sd_card_mounted'] = False
-        status['sd_card_path_exists'] = False
+        app.logger.error(f"Error reading offload index: {e}")
+        status['pending_upload'] = 'N/A'
+        status['uploaded_total'] = 'N/A'
+        status['failed_uploads'] = 'N/A'
+    return status
+
+def _last_run_probe():
     last_run_file = os.path.join(PROJECT_DIR, "logs", "last_run.txt")
     try:
         if os.path.exists(last_run_file):
             with open(last_run_file, 'r') as f:
-                status['last_offload_run'] = f.read().strip()
-        else:
-            status['last_offload_run'] = "Never or Unknown"
+                return {'last_offload_run': f.read().strip()}
+        return {'last_offload_run': "Never or Unknown"}
     except Exception as e:
         app.logger.error(f"Error reading last run timestamp: {e}")
-        status['last_offload_run'] = "Error"
-    return status
+        return {'last_offload_run': "Error"}
+
+sampler = metrics_sampler.MetricsSampler(MONITORED_DISK_PATH, SD_MOUNT_PATH,
+                                         probes=[_index_probe, _last_run_probe],
+                                         on_sample=lambda sample: event_bus.publish('status', **sample)).start()
+
+def get_system_status():
+    return sampler.latest()
+
+REQUEST_SECONDS = metrics.histogram("http_request_seconds", "Flask request latency.",
+                                    ("endpoint", "method", "status"))
+
+# (metric name, sample key, help); sampler values are read at scrape time, never stored.
+SAMPLER_GAUGES = [
+    ("cpu_usage_percent", "cpu_usage", "CPU use over the last sampler interval."),
+    ("cpu_temperature_celsius", "cpu_temp", "SoC temperature."),
+    ("memory_usage_percent", "mem_usage", "Memory in use."),
+    ("disk_usage_percent", "disk_percent", "Use of the monitored disk."),
+    ("disk_free_megabytes", "free_space_mb", "Free space on the monitored disk."),
+    ("network_sent_bytes_per_second", "net_sent_bps", "Network send rate."),
+    ("network_received_bytes_per_second", "net_recv_bps", "Network receive rate."),
+    ("pending_upload_files", "pending_upload", "Clips copied but not yet uploaded."),
+    ("retry_queue_files", "failed_uploads", "Failed uploads waiting in the retry queue."),
+]
+
+def _sampler_metrics():
+    status = get_system_status()
+    samples = [(name, "gauge", help_text, {}, status[key]) for name, key, help_text in SAMPLER_GAUGES
+               if isinstance(status.get(key), (int, float)) and not isinstance(status.get(key), bool)]
+    samples.append(("sd_card_mounted", "gauge", "1 if the SD card is mounted.", {},
+                    1 if status.get('sd_card_mounted') else 0))
+    samples.append(("jobs_running", "gauge", "Jobs running in the worker that answered.", {},
+                    sum(1 for job in jobs.list() if job['state'] == job_manager.RUNNING)))
+    return samples
+
+metrics.register_collector(_sampler_metrics)
 
 def read_log_file(log_path, lines=100):
+    """Returns (last lines of log_path or a placeholder message, end offset)."""
     if not os.path.exists(log_path):
-        return f"Log file not found: {log_path}"
+        return f"Log file not found: {log_path}", 0
     try:
-        process = subprocess.run(['tail', '-n', str(lines), log_path],
-                                   capture_output=True, text=True, check=False)
-        return process.stdout if process.stdout else "(Log is empty)"
+        text, offset = log_tail.tail(log_path, lines)
+        return structured_log.format_text(text) or "(Log is empty)", offset
     except Exception as e:
-        return f"Error reading log file: {e}"
+        return f"Error reading log file: {e}", 0
+
+def run_script_job(job, script, extra_env=None):
+    env = os.environ.copy()
+    env['OFFLOAD_LOCK_HELD'] = '1'  # the job manager already holds the device locks
+    env.update(extra_env or {})
+    process = subprocess.Popen([script], cwd=PROJECT_DIR, env=env, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    job.attach_process(process)
+    exit_code = process.wait()
+    if exit_code != 0 and not job.cancelled:
+        raise RuntimeError(f"{os.path.basename(script)} exited with code {exit_code}")
+    return {"exit_code": exit_code}
+
+def run_offload_job(job, mount=None):
+    # Copy and upload overlap: each clip is queued for upload as soon as it lands.
+    # The pipeline plans first (phase 'plan') and refuses a card that cannot fit.
+    mount = mount or SD_MOUNT_PATH
+    result = offload_pipeline.run_pipeline(mount, control=job)
+    summary = result['copy']
+    if result['plan'] and result['plan']['strategy'] == planner.REFUSE:
+        raise RuntimeError(result['plan']['reason'])
+    app.logger.info(f"Offload engine ({summary.get('camera', 'camera')}): {summary['files_copied']} copied, {summary['files_streamed']} streamed, "
+                    f"{summary['files_skipped']} skipped, "
+                    f"{len(summary['errors'])} errors in {summary['seconds']:.1f}s; "
+                    f"{result['upload']['files_uploaded']} uploaded")
+    if summary['cancelled'] or job.cancelled:
+        return result
+    if summary['errors']:
+        raise RuntimeError(f"{len(summary['errors'])} files failed to copy")
+    if result['upload']['errors']:
+        raise RuntimeError("; ".join(result['upload']['errors']))
+    job.set_phase('cleanup')
+    result['eviction'] = eviction.evict()
+    if eviction.WIPE_CARD:
+        result['card_wipe'] = eviction.wipe_card(mount)
+    return result
+
+def run_upload_job(job):
+    job.set_phase('upload')
+    summary = uploader.upload_pending(control=job)
+    if summary['errors'] and not job.cancelled:
+        raise RuntimeError("; ".join(summary['errors']))
+    if not job.cancelled:
+        job.set_phase('cleanup')
+        summary['eviction'] = eviction.evict()
+    return summary
+
+def run_retry_job(job):
+    # A manual retry skips the backoff: the user pressed the button for a reason.
+    job.set_phase('retry')
+    summary = uploader.retry_failed(control=job, force=True)
+    if summary['errors'] and not job.cancelled:
+        raise RuntimeError("; ".join(summary['errors']))
+    return summary
+
+def _job_summary(job):
+    """One line per finished job for the digest email."""
+    when = datetime.datetime.fromtimestamp(job.finished_at or time.time()).strftime('%H:%M')
+    result = job.result or {}
+    if job.kind == 'offload':
+        copy, upload = result.get('copy', {}), result.get('upload', {})
+        line = f"{when} Offload of {job.devices[0]}"
+        if copy.get('camera'):
+            line += f" ({copy['camera']})"
+        line += f": {job.state}"
+        if copy:
+            line += (f" - {copy.get('files_copied', 0)} copied, {copy.get('files_streamed', 0)} streamed, "
+                     f"{copy.get('files_skipped', 0)} skipped, {upload.get('files_uploaded', 0)} uploaded, "
+                     f"{copy.get('bytes_copied', 0) / 1024**3:.2f} GB in {copy.get('seconds', 0):.0f}s")
+    elif job.kind in ('upload', 'retry'):
+        line = f"{when} {job.kind.capitalize()}: {job.state}"
+        if 'files_uploaded' in result:
+            line += f" - {result['files_uploaded']} files uploaded"
+    else:
+        line = f"{when} {job.kind.capitalize()} of {', '.join(job.devices)}: {job.state}"
+    if job.error:
+        line += f". Error: {job.error}"
+    return line
+
+def _job_finished(job):
+    # Ejects only make the email when they fail; everything else goes in the digest.
+    if not NOTIFY_EMAIL_JOBS or (job.kind == 'eject' and job.state != job_manager.FAILED):
+        return
+    if not mailer.configured():
+        return
+    mailer.add_to_digest('jobs', 'SDTransfer Offloader', _job_summary(job), failed=job.state == job_manager.FAILED)
+
+jobs.on_finished = _job_finished
+
+def submit_job(action, mount=None):
+    mount = mount or SD_MOUNT_PATH
+    card = job_manager.device_for_mount(mount) if mount else "sdcard"
+    uplink = job_manager.UPLINK_DEVICE
+    if action in ('offload', 'eject') and (not mount or not os.path.isdir(mount)):
+        raise ValueError(f"SD card not found at '{mount}'.")
+    if action == 'offload':
+        # Only the card is exclusive; concurrent offloads take turns on the uplink batch by batch.
+        return jobs.submit(action, [card], lambda job: run_offload_job(job, mount))
+    if action == 'upload':
+        return jobs.submit(action, [uplink], run_upload_job)
+    if action == 'retry':
+        return jobs.submit(action, [uplink], run_retry_job)
+    if action == 'eject':
+        script = os.path.join(PROJECT_DIR, 'safe_eject.sh')
+        return jobs.submit(action, [card], lambda job: run_script_job(job, script, {'SD_MOUNT_PATH': mount}))
+    raise ValueError(f"Unknown job action: {action}")
+
+def submit_offloads():
+    """Queues an offload for every configured card that is present. Returns (jobs, errors)."""
+    queued, errors = [], []
+    for mount in SD_MOUNT_PATHS or [None]:
+        try:
+            queued.append(submit_job('offload', mount=mount))
+        except ValueError as e:
+            errors.append(str(e))
+    return queued, errors
+
+def _scheduled_upload(profile):
+    try:
+        job = submit_job('upload')
+        app.logger.info(f"Upload window '{profile['name']}' opened; queued upload job {job.id}.")
+    except ValueError as e:
+        app.logger.info(f"Upload window '{profile['name']}' opened; upload not queued: {e}")
+
+scheduler = upload_scheduler.UploadScheduler(on_window_open=_scheduled_upload).start()
 
 # Authentication
 @auth.verify_password
 def verify_password(username, password):
-    load_dotenv(dotenv_path, override=True)
-    admin_username = os.getenv("ADMIN_USERNAME", "")
-    admin_password = os.getenv("ADMIN_PASSWORD", "")
+    admin_username = config.get_str("ADMIN_USERNAME", "")
+    admin_password = config.get_str("ADMIN_PASSWORD", "")
     if not admin_username or not admin_password:
         return True
     if username == admin_username and password == admin_password:
         return username
     return False
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(time.monotonic() - started, endpoint=request.endpoint or "unknown",
+                                method=request.method, status=response.status_code)
+    return response
+
 @app.before_request
 def check_initial_setup():
-    load_dotenv(dotenv_path, override=True)
-    admin_username = os.getenv("ADMIN_USERNAME", "")
-    admin_password = os.getenv("ADMIN_PASSWORD", "")
+    admin_username = config.get_str("ADMIN_USERNAME", "")
+    admin_password = config.get_str("ADMIN_PASSWORD", "")
     if not admin_username or not admin_password:
-        if request.endpoint not in ['credentials', 'static', 'stream', 'internal_notify']:
+        if request.endpoint not in ['credentials', 'static', 'stream', 'internal_notify', 'internal_job']:
             if request.endpoint == 'index':
                 if 'creds_warning_shown' not in session:
                     flash("Admin credentials are not set. Please set them via the 'Credentials' page.", "warning")
@@ -148,7 +348,23 @@ def index():
 
 @app.route('/status_api')
 def status_api():
-    return jsonify(get_system_status())
+    status = get_system_status()
+    history = request.args.get('history', type=int)
+    if history:
+        status['history'] = sampler.history(min(history, metrics_sampler.HISTORY_SIZE))
+    return jsonify(status)
+
+def _format_uptime(seconds):
+    """Like `uptime -p`, without forking a shell for it."""
+    minutes = int(seconds // 60)
+    parts = [(minutes // 1440, "day"), (minutes // 60 % 24, "hour"), (minutes % 60, "minute")]
+    return "up " + (", ".join(f"{n} {unit}{'s' if n != 1 else ''}" for n, unit in parts if n) or "0 minutes")
+
+@app.route('/metrics')
+@auth.login_required
+def metrics_endpoint():
+    # Prometheus text format, merged across gunicorn workers and the cron-run scripts.
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/diagnostics')
 @auth.login_required
@@ -161,7 +377,7 @@ def diagnostics():
         disk_info = f"Error getting disk info: {e}"
     status = get_system_status()
     diagnostics_info = {
-        "uptime": subprocess.check_output("uptime -p", shell=True, text=True, timeout=5).strip() if sys.platform.startswith('linux') else "N/A",
+        "uptime": _format_uptime(time.time() - psutil.boot_time()),
         "cpu_usage": f"{status.get('cpu_usage', 'N/A')}%",
         "memory_total": f"{mem.total // (1024**2)} MB",
         "memory_used": f"{mem.used // (1024**2)} MB",
@@ -176,15 +392,96 @@ def diagnostics():
 @app.route('/logs')
 @auth.login_required
 def logs():
-    upload_log_content = read_log_file(os.path.join(PROJECT_DIR, "logs", "upload.log"), lines=200)
-    offload_log_content = read_log_file(os.path.join(PROJECT_DIR, "logs", "offload_wrapper.log"), lines=200)
-    retry_log_content = read_log_file(os.path.join(PROJECT_DIR, "logs", "retry_offload.log"), lines=100)
-    eject_log_content = read_log_file(os.path.join(PROJECT_DIR, "logs", "eject.log"), lines=50)
-    notify_log_content = read_log_file(os.path.join(PROJECT_DIR, "logs", "notification.log"), lines=100)
-    udev_log_content = read_log_file(os.path.join(PROJECT_DIR, "logs", "udev_trigger.log"), lines=50)
-    return render_template('logs.html', upload=upload_log_content, offload=offload_log_content,
-                           retry=retry_log_content, eject=eject_log_content,
-                           notification=notify_log_content, udev=udev_log_content)
+    log_views = []
+    for name, (_filename, title, icon, lines) in log_tail.LOG_FILES.items():
+        content, offset = read_log_file(log_tail.log_path(name), lines=lines)
+        log_views.append({"name": name, "title": title, "icon": icon, "content": content, "offset": offset})
+    return render_template('logs.html', logs=log_views)
+
+@app.route('/logs/<name>')
+@auth.login_required
+def log_since(name):
+    """Incremental read: ?since=<offset> returns only the bytes appended after offset."""
+    path = log_tail.log_path(name)
+    if path is None:
+        return jsonify({"error": f"Unknown log '{name}'."}), 404
+    if not os.path.exists(path):
+        return jsonify({"name": name, "data": "", "offset": 0, "reset": False})
+    since = request.args.get('since', '')
+    try:
+        if since.isdigit():
+            data, offset, reset = log_tail.read_since(path, int(since))
+        else:
+            lines = request.args.get('lines', '')
+            data, offset = log_tail.tail(path, int(lines) if lines.isdigit() else log_tail.LOG_FILES[name][3])
+            reset = True
+    except OSError as e:
+        return jsonify({"error": f"Error reading log file: {e}"}), 500
+    return jsonify({"name": name, "data": structured_log.format_text(data), "offset": offset, "reset": reset})
+
+@app.route('/logs/<name>/range')
+@auth.login_required
+def log_range(name):
+    """Records between ?start= and ?end= (epoch seconds), found via the segment index."""
+    path = log_tail.log_path(name)
+    if path is None:
+        return jsonify({"error": f"Unknown log '{name}'."}), 404
+    try:
+        start = float(request.args.get('start', ''))
+        end = float(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({"error": "start and end must be epoch seconds."}), 400
+    lines = structured_log.read_range(path, start, end)
+    return jsonify({"name": name, "data": "\n".join(structured_log.format_record(l) for l in lines) + "\n",
+                    "count": len(lines), "segments": structured_log.load_segments(path)})
+
+# SSE follow mode: pushes appended log lines; the event id is the byte offset,
+# so a reconnecting EventSource resumes where it left off. Streams wait on
+# log_tail's shared watcher and are capped at log_tail.MAX_FOLLOWERS.
+LOG_FOLLOW_KEEPALIVE_SECONDS = 15
+
+@app.route('/logs/<name>/follow')
+@auth.login_required
+def log_follow(name):
+    path = log_tail.log_path(name)
+    if path is None:
+        return jsonify({"error": f"Unknown log '{name}'."}), 404
+    last_id = request.headers.get('Last-Event-ID', '') or request.args.get('since', '')
+    try:
+        changes = log_tail.start_follow(path)
+    except log_tail.TooManyFollowers as e:
+        return jsonify({"error": f"{e} Close one, or untick Follow to poll instead."}), 503
+    def follow_stream():
+        nonlocal changes
+        offset = int(last_id) if last_id.isdigit() else None
+        changed = True
+        while True:
+            try:
+                if offset is None:
+                    offset = os.path.getsize(path)
+                data, offset, reset = log_tail.read_since(path, offset)
+            except OSError:
+                data, reset = "", False  # not created yet, or mid-rotation
+            if data or reset:
+                yield event_bus.format_sse(offset, 'log', {"data": structured_log.format_text(data),
+                                                           "offset": offset, "reset": reset})
+            elif not changed:
+                yield ": keepalive\n\n"
+            latest = log_tail.wait_change(path, changes, timeout=LOG_FOLLOW_KEEPALIVE_SECONDS)
+            changed, changes = latest != changes, latest
+    response = Response(stream_with_context(follow_stream()), mimetype="text/event-stream")
+    # Also runs when the client went away before the stream started.
+    response.call_on_close(lambda: log_tail.stop_follow(path))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Slow commands run on background threads; pages render the cached result and poll for a fresh one.
+DRIVE_AUTH_URL_TTL = 300  # rclone authorize keeps waiting for Google's redirect this long
+
+# Samples the Wi-Fi link and the running upload for the upload scheduler, and keeps the network scan fresh.
+network = network_monitor.NetworkMonitor(rclone_stats=lambda: upload_scheduler.rc_call("core/stats")).start()
+wifi_scan = network.scan_task
 
 @app.route('/wifi', methods=['GET', 'POST'])
 @auth.login_required
@@ -203,7 +500,7 @@ def wifi():
         try:
             with open(wpa_conf_path, 'a') as f:
                 f.write(config_block)
-            cmd = ['sudo', 'wpa_cli', '-i', 'wlan0', 'reconfigure']
+            cmd = ['sudo', 'wpa_cli', '-i', network.interface, 'reconfigure']
             result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=15)
             if "OK" in result.stdout:
                 flash(f"Wi‑Fi network '{ssid}' added. Attempting connection.", "success")
@@ -213,41 +510,33 @@ def wifi():
             flash(f"Error configuring Wi‑Fi: {e}", "error")
             app.logger.error(f"Wi-Fi config failed: {e}", exc_info=True)
         return redirect(url_for('wifi'))
-    else:
-        ssids = []
-        if sys.platform.startswith('linux'):
-            try:
-                scan_cmd = ['sudo', '/sbin/iwlist', 'wlan0', 'scan']
-                scan_result = subprocess.run(scan_cmd, capture_output=True, text=True, timeout=20)
-                if scan_result.returncode == 0:
-                    for line in scan_result.stdout.splitlines():
-                        if "ESSID:" in line:
-                            try:
-                                current_ssid = line.split('"')[1]
-                                if current_ssid and current_ssid != "\\x00":
-                                    ssids.append(current_ssid)
-                            except IndexError:
-                                continue
-                else:
-                    app.logger.warning(f"iwlist scan failed with code {scan_result.returncode}")
-            except Exception as e:
-                app.logger.error(f"Error scanning Wi-Fi: {e}", exc_info=True)
-        return render_template('wifi.html', ssids=sorted(list(set(ssids))))
+    scan = wifi_scan.refresh(force=request.args.get('rescan') == '1')
+    return render_template('wifi.html', networks=scan['value'] or [], scan=scan, link=network.status())
+
+@app.route('/api/wifi/scan')
+@auth.login_required
+def api_wifi_scan():
+    return jsonify(wifi_scan.refresh(force=request.args.get('rescan') == '1'))
+
+@app.route('/api/network')
+@auth.login_required
+def api_network():
+    return jsonify(network.status())
 
 @app.route('/notifications', methods=['GET', 'POST'])
 @auth.login_required
 def notifications_route():
     if request.method == 'POST':
-        config = {
+        settings = {
             "smtp_server": request.form.get("smtp_server", ""),
             "smtp_port": request.form.get("smtp_port", ""),
             "smtp_username": request.form.get("smtp_username", ""),
             "smtp_password": request.form.get("smtp_password", ""),
             "target_email": request.form.get("target_email", "")
         }
-        save_email_config(config)
-    config = load_email_config()
-    return render_template('notifications.html', config=config)
+        save_email_config(settings)
+    settings = load_email_config()
+    return render_template('notifications.html', config=settings)
 
 @app.route('/backup_config', methods=['GET', 'POST'])
 @auth.login_required
@@ -321,31 +610,27 @@ def update_system():
 @app.route('/run/<action>')
 @auth.login_required
 def run_action(action):
-    script_dir = PROJECT_DIR
-    scripts = {
-        'upload': os.path.join(script_dir, 'upload_and_cleanup.sh'),
-        'offload': os.path.join(script_dir, 'offload.sh'),
-        'retry': os.path.join(script_dir, 'retry_offload.sh'),
-        'eject': os.path.join(script_dir, 'safe_eject.sh'),
+    system_cmds = {
         'reboot': 'sudo /sbin/reboot',
         'shutdown': 'sudo /sbin/shutdown now'
     }
     if action == 'send_test_email':
         return redirect(url_for('run_send_test_email'))
-    if action in scripts:
-        cmd = scripts[action]
+    if action == 'offload':
+        queued, errors = submit_offloads()
+        for job in queued:
+            flash(f"Offload of {job.devices[0]} queued as job {job.id}.", "success")
+        for message in errors:
+            flash(message, "error")
+    elif action in ('upload', 'retry', 'eject'):
         try:
-            if action in ['reboot', 'shutdown']:
-                subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            elif os.path.exists(cmd) and os.access(cmd, os.X_OK):
-                subprocess.Popen([cmd], cwd=script_dir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                flash(f"Action '{action}' started in background.", "success")
-            else:
-                flash(f"Script for action '{action}' not found or not executable at {cmd}", "error")
-                app.logger.error(f"Action '{action}': Script not found or not executable at {cmd}")
-        except PermissionError as e:
-            flash(f"Permission denied running {action}.", "error")
-            app.logger.error(f"Permission denied for {action}: {e}", exc_info=True)
+            job = submit_job(action)
+            flash(f"Action '{action}' queued as job {job.id}.", "success")
+        except ValueError as e:
+            flash(str(e), "error")
+    elif action in system_cmds:
+        try:
+            subprocess.Popen(system_cmds[action], shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         except Exception as e:
             flash(f"Failed to run action '{action}': {e}", "error")
             app.logger.error(f"Error running action '{action}': {e}", exc_info=True)
@@ -354,11 +639,109 @@ def run_action(action):
         app.logger.warning(f"Unknown action attempted: {action}")
     return redirect(url_for('index'))
 
+@app.route('/api/jobs', methods=['GET', 'POST'])
+@auth.login_required
+def api_jobs():
+    if request.method == 'POST':
+        action = (request.get_json(silent=True) or {}).get('action') or request.form.get('action', '')
+        if action == 'offload':
+            queued, errors = submit_offloads()
+            if not queued:
+                return jsonify({"success": False, "message": "; ".join(errors)}), 409
+            return jsonify({"success": True, "job": queued[0].to_dict(), "jobs": [j.to_dict() for j in queued],
+                            "errors": errors}), 202
+        try:
+            job = submit_job(action)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 409
+        return jsonify({"success": True, "job": job.to_dict()}), 202
+    return jsonify({"jobs": jobs.list()})
+
+@app.route('/api/sources')
+@auth.login_required
+def api_sources():
+    # Per-card copy/upload throughput for offloads running in this worker.
+    return jsonify({"sources": offload_pipeline.source_stats()})
+
+PLAN_TTL = 30
+
+def _plan_cards():
+    # Readers with a card in them; an empty mount point means no card.
+    return [planner.plan(mount) for mount in SD_MOUNT_PATHS if os.path.isdir(mount) and os.listdir(mount)]
+
+card_plans = cached_task.CachedTask("plan", _plan_cards, PLAN_TTL)
+
+@app.route('/api/plan')
+@auth.login_required
+def api_plan():
+    # Pre-flight plan (fit, strategy, ETA) for each card; scanning a full card takes a moment.
+    return jsonify(card_plans.refresh(force=request.args.get('refresh') == '1'))
+
+@app.route('/api/jobs/<int:job_id>')
+@auth.login_required
+def api_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": f"Job {job_id} not found."}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<int:job_id>/<op>', methods=['POST'])
+@auth.login_required
+def api_job_control(job_id, op):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": f"Job {job_id} not found."}), 404
+    if op == 'cancel':
+        jobs.cancel(job_id)
+    elif op == 'pause':
+        job.pause()
+    elif op == 'resume':
+        job.resume()
+    else:
+        return jsonify({"success": False, "message": f"Unknown operation: {op}"}), 400
+    return jsonify({"success": True, "job": job.to_dict()})
+
+@app.route('/schedule', methods=['GET', 'POST'])
+@auth.login_required
+def schedule():
+    current = upload_scheduler.load_schedule()
+    if request.method == 'POST':
+        profiles = []
+        form = request.form
+        for name, start, end, bwlimit, transfers, start_upload in zip(
+                form.getlist('name'), form.getlist('start'), form.getlist('end'), form.getlist('bwlimit'),
+                form.getlist('transfers'), form.getlist('start_upload')):
+            if not (name.strip() or start or end):
+                continue  # blank row
+            profiles.append({"name": name.strip() or f"{start}-{end}", "start": start, "end": end,
+                             "bwlimit": bwlimit.strip() or "off",
+                             "transfers": int(transfers) if transfers.strip().isdigit() else None,
+                             "start_upload": start_upload == 'yes'})
+        updated = {"default_bwlimit": form.get('default_bwlimit', '').strip() or "off",
+                   "max_transfers": form.get('max_transfers') or upload_scheduler.MAX_TRANSFERS,
+                   "profiles": profiles}
+        try:
+            updated["max_transfers"] = int(updated["max_transfers"])
+            upload_scheduler.validate_schedule(updated)
+            config.save_upload_schedule(updated)
+            scheduler.refresh()
+            flash("Upload schedule saved.", "success")
+            app.logger.info("Upload schedule saved.")
+            current = updated
+        except (ValueError, OSError) as e:
+            flash(f"Upload schedule not saved: {e}", "error")
+            current = updated
+    return render_template('schedule.html', schedule=current, status=scheduler.status())
+
+@app.route('/api/schedule')
+@auth.login_required
+def api_schedule():
+    return jsonify({"schedule": upload_scheduler.load_schedule(), "status": scheduler.status()})
+
 @app.route('/credentials', methods=['GET', 'POST'])
 def credentials():
-    load_dotenv(dotenv_path, override=True)
-    current_admin_user = os.getenv("ADMIN_USERNAME")
-    current_admin_pass = os.getenv("ADMIN_PASSWORD")
+    current_admin_user = config.get_str("ADMIN_USERNAME", "")
+    current_admin_pass = config.get_str("ADMIN_PASSWORD", "")
     admin_exists = bool(current_admin_user and current_admin_pass)
     if request.method == "POST":
         new_user = request.form.get("new_username", "").strip()
@@ -372,29 +755,8 @@ def credentials():
             if old_user != current_admin_user or old_pass != current_admin_pass:
                 flash("Current credentials do not match!", "error")
                 return render_template("credentials.html", admin_exists=True)
-        env_lines = []
-        if os.path.exists(dotenv_path):
-            with open(dotenv_path, "r") as f:
-                env_lines = f.readlines()
-        updated_lines = []
-        found_user, found_pass = False, False
-        for line in env_lines:
-            if line.strip().startswith("ADMIN_USERNAME="):
-                updated_lines.append(f"ADMIN_USERNAME={new_user}\n")
-                found_user = True
-            elif line.strip().startswith("ADMIN_PASSWORD="):
-                updated_lines.append(f"ADMIN_PASSWORD={new_pass}\n")
-                found_pass = True
-            else:
-                updated_lines.append(line)
-        if not found_user:
-            updated_lines.append(f"ADMIN_USERNAME={new_user}\n")
-        if not found_pass:
-            updated_lines.append(f"ADMIN_PASSWORD={new_pass}\n")
         try:
-            with open(dotenv_path, "w") as f:
-                f.writelines(updated_lines)
-            load_dotenv(dotenv_path, override=True)
+            config.update_env({"ADMIN_USERNAME": new_user, "ADMIN_PASSWORD": new_pass})
             flash("Credentials updated. Restart service if login issues persist.", "success")
         except Exception as e:
             flash(f"Error writing to .env file: {e}", "error")
@@ -405,96 +767,167 @@ def credentials():
         session.pop('creds_warning_shown')
     return render_template("credentials.html", admin_exists=admin_exists)
 
+_drive_auth = {"process": None}
+
+def _drive_auth_command():
+    return ['rclone', 'authorize', 'drive', '--auth-no-open-browser', f'--config={RCLONE_CONFIG_PATH}']
+
+def _drive_auth_url():
+    """Starts rclone authorize and returns the URL it prints; rclone keeps waiting for the redirect."""
+    previous = _drive_auth["process"]
+    if previous is not None and previous.poll() is None:
+        previous.kill()
+    try:
+        process = subprocess.Popen(_drive_auth_command(), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True, start_new_session=True)
+    except FileNotFoundError:
+        raise RuntimeError("'rclone' command not found.")
+    _drive_auth["process"] = process
+    # No URL within 30 s means rclone is stuck; either way it is not left running past the URL's lifetime.
+    give_up = threading.Timer(30, process.kill)
+    give_up.start()
+    output = []
+    for line in process.stdout:
+        output.append(line)
+        if line.strip().startswith('http'):
+            give_up.cancel()
+            threading.Timer(DRIVE_AUTH_URL_TTL, process.kill).start()
+            threading.Thread(target=process.stdout.read, daemon=True).start()  # keep the pipe drained
+            return line.strip()
+    give_up.cancel()
+    process.wait()
+    app.logger.error(f"Rclone authorize URL error: {''.join(output)}")
+    raise RuntimeError(f"Error generating auth URL: {''.join(output)[-200:] or f'exit code {process.returncode}'}")
+
+def _submit_drive_token(token):
+    try:
+        process = subprocess.run(_drive_auth_command(), input=token + "\n", capture_output=True, text=True,
+                                 timeout=45)
+    except FileNotFoundError:
+        raise RuntimeError("'rclone' command not found.")
+    except subprocess.TimeoutExpired:
+        raise RuntimeError("Rclone command timed out during authorization.")
+    if process.returncode != 0:
+        app.logger.error(f"Rclone authorize error: {process.stderr}")
+        raise RuntimeError(f"Rclone auth failed: {process.stderr[:200]}")
+    app.logger.info(f"Rclone authorize output: {process.stdout}")
+    return f"Google Drive token submitted for remote '{config.rclone_settings()['remote_name']}'."
+
+drive_auth_url = cached_task.CachedTask("drive-auth-url", _drive_auth_url, DRIVE_AUTH_URL_TTL)
+drive_auth_token = cached_task.CachedTask("drive-auth-token", _submit_drive_token, 0)
+
 @app.route('/drive_auth', methods=['GET', 'POST'])
 @auth.login_required
 def drive_auth():
-    rclone_cmd = 'rclone'
-    config_flag = f'--config={RCLONE_CONFIG_PATH}'
-    remote_name = os.getenv('RCLONE_REMOTE_NAME', 'gdrive')
+    remote_name = config.rclone_settings()['remote_name']
     if request.method == 'POST':
         auth_token = request.form.get('auth_token')
         if auth_token:
-            try:
-                authorize_cmd = [rclone_cmd, 'authorize', 'drive', '--auth-no-open-browser', config_flag]
-                process = subprocess.run(authorize_cmd, input=auth_token+"\n", capture_output=True, text=True, check=True, timeout=45)
-                app.logger.info(f"Rclone authorize output: {process.stdout}")
-                flash(f"Google Drive token submitted for remote '{remote_name}'.", "success")
-            except FileNotFoundError:
-                flash(f"Error: '{rclone_cmd}' command not found.", "error")
-            except subprocess.CalledProcessError as e:
-                flash(f"Rclone auth failed: {e.stderr[:200]}...", "error")
-                app.logger.error(f"Rclone authorize error: {e.stderr}")
-            except subprocess.TimeoutExpired:
-                flash("Rclone command timed out during authorization.", "error")
-            except Exception as e:
-                flash(f"Unexpected error during authorization: {e}", "error")
-                app.logger.error(f"Drive auth unexpected error: {e}", exc_info=True)
+            drive_auth_token.refresh(auth_token.strip(), force=True)
+            flash("Token submitted; rclone is checking it.", "info")
         else:
             flash("Please enter the token from Google.", "error")
         return redirect(url_for('drive_auth'))
-    else:
-        auth_url, error_message = "", ""
-        try:
-            cmd = [rclone_cmd, 'authorize', 'drive', '--auth-no-open-browser', config_flag]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=30)
-            for line in result.stdout.splitlines():
-                if line.strip().startswith('http'):
-                    auth_url = line.strip()
-                    break
-            if not auth_url:
-                auth_url = result.stdout
-                flash("Could not auto-extract URL, see text below.", "warning")
-        except FileNotFoundError:
-            error_message = f"Error: '{rclone_cmd}' command not found."
-            flash(error_message, "error")
-        except subprocess.CalledProcessError as e:
-            error_message = f"Error generating auth URL: {e.stderr[:200]}..."
-            flash(error_message, "error")
-            app.logger.error(f"Rclone authorize URL error: {e.stderr}")
-        except subprocess.TimeoutExpired:
-            error_message = "Rclone command timed out generating auth URL."
-            flash(error_message, "error")
-        except Exception as e:
-            error_message = f"Unexpected error: {e}"
-            flash(error_message, "error")
-            app.logger.error(f"Drive auth URL unexpected error: {e}", exc_info=True)
-        return render_template('drive_auth.html', auth_url=auth_url, error_message=error_message, remote_name=remote_name)
+    return render_template('drive_auth.html', remote_name=remote_name,
+                           auth=drive_auth_url.refresh(force=request.args.get('regenerate') == '1'),
+                           token=drive_auth_token.state())
+
+@app.route('/api/drive_auth')
+@auth.login_required
+def api_drive_auth():
+    return jsonify({"auth": drive_auth_url.state(), "token": drive_auth_token.state()})
 
 @app.route('/run/send_test_email')
 @auth.login_required
 def run_send_test_email():
-    script_path = os.path.join(PROJECT_DIR, 'send_notification.py')
-    if not os.path.exists(script_path):
-        flash("send_notification.py script not found.", "error")
-        return jsonify({"success": False, "message": "send_notification.py not found."})
-    try:
-        env = os.environ.copy()
-        process = subprocess.run([sys.executable, script_path, "Test Email", "This is a test message from the web UI."],
-                                 capture_output=True, text=True, timeout=45, env=env, cwd=PROJECT_DIR)
-        if process.returncode == 0:
-            flash("Test email initiated. Check logs/recipient.", "success")
-            return jsonify({"success": True, "message": "Test email initiated. Check logs/recipient."})
-        else:
-            flash(f"send_notification.py failed with code {process.returncode}.", "error")
-            return jsonify({"success": False, "message": f"Script failed (code {process.returncode})."})
-    except subprocess.TimeoutExpired:
-        flash("send_notification.py timed out.", "error")
-        return jsonify({"success": False, "message": "Script timed out."})
-    except Exception as e:
-        flash(f"Error executing send_notification.py: {e}", "error")
-        return jsonify({"success": False, "message": f"Error executing script: {e}"})
+    missing = notifier.missing_fields(load_email_config())
+    if missing:
+        message = f"Email is not configured (missing {', '.join(missing)})."
+        flash(message, "error")
+        return jsonify({"success": False, "message": message})
+    # Queued, not sent here: the request returns at once and the mailer retries on failure.
+    mailer.send("Test Email", "This is a test message from the web UI.")
+    flash("Test email queued. Check the notification log and your inbox.", "success")
+    return jsonify({"success": True, "message": "Test email queued. Check the notification log and your inbox."})
+
+# SSE stream: every client replays the same pre-serialised events from the bus;
+# status snapshots are published once per sample by the sampler thread, not per client.
+SSE_KEEPALIVE_SECONDS = 15
 
-# New SSE stream endpoint with explicit endpoint name.
 @app.route('/stream', endpoint='stream')
 def stream():
+    last_id = request.headers.get('Last-Event-ID', '')
+    # After a restart the bus counts from 0 again; an id from before it would hide every new event.
+    seq = min(int(last_id), event_bus.latest_seq()) if last_id.isdigit() else event_bus.latest_seq()
     def event_stream():
-        # Dummy implementation: send a keepalive message every 30 seconds.
+        nonlocal seq
+        yield event_bus.format_sse(seq, 'status', get_system_status())
         while True:
-            yield "data: " + json.dumps({"message": "Keepalive", "type": "info"}) + "\n\n"
-            time.sleep(30)
-    return Response(event_stream(), mimetype="text/event-stream")
+            events = event_bus.wait_formatted(seq, timeout=SSE_KEEPALIVE_SECONDS)
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            seq = events[-1][0]
+            yield "".join(text for _seq, text in events)
+    response = Response(stream_with_context(event_stream()), mimetype="text/event-stream")
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # stop nginx from buffering the stream
+    return response
+
+# Internal endpoints for card_watcher.py (token auth, not the admin login)
+def _internal_denied():
+    # None when the request carries the token; the endpoints stay off while the token is the placeholder.
+    expected = config.internal_notify_token()
+    if not expected:
+        return jsonify({"success": False,
+                        "message": "Internal endpoints are disabled until INTERNAL_NOTIFY_TOKEN is set in .env."}), 503
+    if not hmac.compare_digest(request.headers.get('X-Notify-Token', ''), expected):
+        return jsonify({"success": False, "message": "Invalid notify token."}), 403
+    return None
+
+def _card_mount_allowed(mount):
+    if not mount:
+        return False
+    real = os.path.realpath(mount)
+    base = os.path.realpath(CARD_MOUNT_BASE)
+    if real != base and os.path.commonpath([real, base]) == base:
+        return True
+    return real in {os.path.realpath(p) for p in SD_MOUNT_PATHS}
+
+@app.route('/internal/card_event', methods=['POST'], endpoint='internal_notify')
+def internal_card_event():
+    denied = _internal_denied()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    event, mount = data.get('event'), data.get('mount', '')
+    event_bus.publish('card', event=event, uuid=data.get('uuid'), device=data.get('device'), mount=mount)
+    if event == 'removed':
+        app.logger.info(f"Card {data.get('uuid')} removed from {data.get('device')}.")
+        return jsonify({"success": True})
+    if event != 'inserted':
+        return jsonify({"success": False, "message": f"Unknown card event: {event}"}), 400
+    if not _card_mount_allowed(mount):
+        app.logger.warning(f"Refused card event for '{mount}': not below {CARD_MOUNT_BASE} or in SD_MOUNT_PATHS.")
+        return jsonify({"success": False, "message": f"Mount '{mount}' is not a card mount."}), 400
+    try:
+        job = submit_job('offload', mount=mount)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 409
+    app.logger.info(f"Card {data.get('uuid')} inserted at {mount}; queued offload job {job.id}.")
+    return jsonify({"success": True, "job": job.to_dict()}), 202
+
+@app.route('/internal/jobs/<int:job_id>', endpoint='internal_job')
+def internal_job(job_id):
+    denied = _internal_denied()
+    if denied:
+        return denied
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": f"Job {job_id} not found."}), 404
+    return jsonify(job.to_dict())
 
 if __name__ == '__main__':
-    app.logger.info(f"Starting Flask App. Internal Notify Token: {INTERNAL_NOTIFY_TOKEN[:4]}... (hidden)")
+    app.logger.info(f"Starting Flask App. Internal notify token {'set' if config.internal_notify_token() else 'NOT set'}.")
     # Turn on debug mode for testing
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# benchmark.py
+# Measures the transfer path end to end on synthetic cards.
+# make-card writes a DCIM/M4ROOT tree that mixes many small JPG/ARW stills with
+# a few large MP4 clips (plus their XML sidecars), optionally on a tmpfs or a
+# loop-mounted FAT image so the card side is not limited by the SD reader.
+# run offloads that card and uploads it to a local rclone remote (":local" on
+# disk, or ":memory" to take the remote's disk out of the picture), using the
+# real offload_engine / uploader / offload_pipeline code with its own index,
+# footage directory and rc port, so a benchmark never touches the real ones.
+# Each phase reports MB/s, files/s, CPU% (of one core, Python plus rclone) and
+# peak RSS; results are appended as JSON lines so versions can be compared.
+#   ./benchmark.py make-card DIR [--photos N --raws N --clips N ...] [--tmpfs MB | --image FILE --image-mb MB]
+#   ./benchmark.py run [--card DIR] [--mode staged|pipeline|stream] [--remote local|memory]
+#                      [--workers 1,2,4] [--chunk-mb 8] [--no-hash] [--label NAME]
+#   ./benchmark.py compare [--last N] [--label NAME]
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import datetime
+import threading
+import subprocess
+
+import psutil
+
+import config
+import eviction
+import job_manager
+import offload_engine
+import offload_index
+import offload_pipeline
+import uploader
+import upload_scheduler
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_PATH = config.get_str("BENCHMARK_RESULTS", os.path.join(BASE_DIR, "logs", "benchmark.jsonl"))
+SAMPLE_SECONDS = 0.2
+WRITE_BLOCK = 8 * 1024 * 1024
+MODES = ("staged", "pipeline", "stream")
+REMOTES = ("local", "memory")
+
+logger = logging.getLogger("benchmark")
+
+
+# --- Synthetic cards ---
+def _write_file(path, size, seed, mtime):
+    """Writes size pseudo-random bytes; each block differs so no layer can dedupe them."""
+    block = bytearray(os.urandom(min(size, WRITE_BLOCK)) if size else b"")
+    with open(path, "wb") as f:
+        written = 0
+        index = 0
+        while written < size:
+            block[:16] = f"{seed:08x}{index:08x}".encode()[:len(block)]
+            n = min(len(block), size - written)
+            f.write(memoryview(block)[:n])
+            written += n
+            index += 1
+    os.utime(path, (mtime, mtime))
+
+
+def _mount(args, target):
+    if os.geteuid() != 0:
+        raise PermissionError(f"Mounting {target} needs root.")
+    os.makedirs(target, exist_ok=True)
+    result = subprocess.run(["mount"] + args + [target], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise OSError(f"mount {' '.join(args)} {target} failed: {result.stderr.strip()}")
+
+
+def mount_tmpfs(target, size_mb):
+    """Backs the synthetic card with RAM, so reads measure the copy path rather than a device."""
+    _mount(["-t", "tmpfs", "-o", f"size={size_mb}m", "tmpfs"], target)
+
+
+def mount_image(image, target, size_mb, fs_type="vfat"):
+    """Creates a sparse FAT/exFAT image and loop-mounts it, to include the card filesystem's cost."""
+    with open(image, "wb") as f:
+        f.truncate(size_mb * 1024 * 1024)
+    mkfs = ["mkfs.vfat", "-F", "32"] if fs_type == "vfat" else ["mkfs.exfat"]
+    subprocess.run(mkfs + [image], check=True, capture_output=True)
+    _mount(["-o", "loop,noatime", image], target)
+
+
+def make_card(root, photos=400, photo_kb=8000, raws=200, raw_mb=24, clips=4, clip_mb=1024, seed=1):
+    """Builds a camera card tree under root. Returns {"files", "bytes"}."""
+    photo_dir = os.path.join(root, offload_engine.PHOTO_REL_PATH)
+    clip_dir = os.path.join(root, offload_engine.VIDEO_REL_PATH)
+    os.makedirs(photo_dir, exist_ok=True)
+    os.makedirs(clip_dir, exist_ok=True)
+    start = time.time() - 3600
+    files = []
+    for i in range(photos):
+        files.append((os.path.join(photo_dir, f"DSC{i + 1:05d}.JPG"), photo_kb * 1024))
+    for i in range(raws):
+        files.append((os.path.join(photo_dir, f"DSC{photos + i + 1:05d}.ARW"), raw_mb * 1024 * 1024))
+    for i in range(clips):
+        files.append((os.path.join(clip_dir, f"C{i + 1:04d}.MP4"), clip_mb * 1024 * 1024))
+        with open(os.path.join(clip_dir, f"C{i + 1:04d}M01.XML"), "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<NonRealTimeMeta>\n'
+                    '<Device manufacturer="Sony" modelName="BENCH" serialNo="0000001"/>\n</NonRealTimeMeta>\n')
+    total = 0
+    for n, (path, size) in enumerate(files):
+        _write_file(path, size, seed * 1000003 + n, start + n)
+        total += size
+    logger.info(f"Synthetic card at {root}: {photos} JPG, {raws} ARW, {clips} MP4, {total / 1024**3:.2f} GB.")
+    return {"files": len(files), "bytes": total}
+
+
+# --- Measurement ---
+class ResourceMonitor:
+    """Samples CPU time and RSS of this process and its rclone children for one phase."""
+
+    def __init__(self):
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+        self.peak_rss = 0
+        self.peak_child_rss = 0
+
+    def _sample(self):
+        try:
+            self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+            children = 0
+            for child in self._process.children(recursive=True):
+                try:
+                    children += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak_child_rss = max(self.peak_child_rss, children)
+        except psutil.Error:
+            pass
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_SECONDS):
+            self._sample()
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        self._cpu = self._cpu_seconds()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="benchmark-monitor", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.monotonic() - self._started
+        self.cpu_seconds = self._cpu_seconds() - self._cpu
+        return False
+
+    @staticmethod
+    def _cpu_seconds():
+        # RUSAGE_CHILDREN only counts rclone processes once they have exited,
+        # which every upload's rclone has by the end of its phase.
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _phase(name, monitor, files, nbytes):
+    seconds = monitor.seconds
+    return {"phase": name, "seconds": round(seconds, 3), "files": files, "bytes": nbytes,
+            "mb_per_s": round(nbytes / 1024**2 / seconds, 2) if seconds > 0 else 0.0,
+            "files_per_s": round(files / seconds, 2) if seconds > 0 else 0.0,
+            "cpu_percent": round(100 * monitor.cpu_seconds / seconds, 1) if seconds > 0 else 0.0,
+            "peak_rss_mb": round(monitor.peak_rss / 1024**2, 1),
+            "peak_rclone_rss_mb": round(monitor.peak_child_rss / 1024**2, 1)}
+
+
+# --- Runs ---
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _isolate(work_dir, remote, transfers):
+    """Points the transfer modules at a scratch index, remote and rc port for this run."""
+    offload_index.INDEX_DB_PATH = os.path.join(work_dir, "index.db")
+    if remote == "memory":
+        uploader.RCLONE_REMOTE_NAME, uploader.RCLONE_BASE_PATH = ":memory", "benchmark"
+    else:
+        uploader.RCLONE_REMOTE_NAME, uploader.RCLONE_BASE_PATH = ":local", os.path.join(work_dir, "remote")
+        os.makedirs(uploader.RCLONE_BASE_PATH, exist_ok=True)
+    upload_scheduler.RC_ADDR = f"127.0.0.1:{_free_port()}"
+    # Unthrottled, whatever upload_schedule.json says; the benchmark measures the code, not the timetable.
+    upload_scheduler.load_schedule = lambda: dict(upload_scheduler.DEFAULT_SCHEDULE, max_transfers=transfers)
+    # Never delete anything to make room, and never queue behind a real upload's uplink lock.
+    eviction.evict = lambda *args, **kwargs: {"files_evicted": 0, "bytes_freed": 0, "requeued": 0,
+                                              "free_bytes": 0}
+    offload_pipeline.uplink = job_manager.UplinkArbiter(use_flock=False)
+
+
+def _upload_staged(local_base):
+    conn = offload_index.connect()
+    files = nbytes = 0
+    errors = []
+    try:
+        for category in uploader.CATEGORIES:
+            rows = offload_index.pending_uploads(conn, category)
+            if not rows:
+                continue
+            count, exit_code = uploader.upload_rows(conn, category, rows, local_base=local_base)
+            if exit_code != 0:
+                errors.append(f"{category} upload failed (exit code {exit_code})")
+            files += len(rows)
+            nbytes += sum(row["size"] for row in rows)
+    finally:
+        conn.close()
+    return files, nbytes, errors
+
+
+def run_once(card, mode="pipeline", remote="local", workers=offload_engine.DEFAULT_WORKERS, chunk_mb=8,
+             hash_on_copy=True, transfers=upload_scheduler.MAX_TRANSFERS, keep=False):
+    """Offloads and uploads card once in a scratch directory. Returns the result record."""
+    if mode == "stream" and remote == "memory":
+        raise ValueError("Stream mode verifies each clip with a second rclone, which cannot see a :memory remote.")
+    work_dir = tempfile.mkdtemp(prefix="sdtransfer-bench-")
+    local_base = os.path.join(work_dir, "footage")
+    _isolate(work_dir, remote, transfers)
+    offload_engine.CHUNK_SIZE = chunk_mb * 1024 * 1024
+    offload_engine.HASH_ON_COPY = hash_on_copy
+    phases = []
+    errors = []
+    try:
+        if not uploader.check_remote():
+            raise RuntimeError(f"rclone cannot list the {remote} remote; is rclone installed?")
+        if mode == "staged":
+            with ResourceMonitor() as monitor:
+                copy = offload_engine.run_offload(card, local_base, workers)
+            phases.append(_phase("offload", monitor, copy["files_copied"], copy["bytes_copied"]))
+            errors += copy["errors"]
+            with ResourceMonitor() as monitor:
+                files, nbytes, upload_errors = _upload_staged(local_base)
+            phases.append(_phase("upload", monitor, files, nbytes))
+            errors += upload_errors
+        else:
+            with ResourceMonitor() as monitor:
+                result = offload_pipeline.run_pipeline(card, local_base, workers,
+                                                       mode="stream" if mode == "stream" else "local",
+                                                       preflight=False)
+            copy = result["copy"]
+            phases.append(_phase(mode, monitor, copy["files_copied"] + copy["files_streamed"],
+                                 copy["bytes_copied"]))
+            errors += copy["errors"] + result["upload"]["errors"]
+    finally:
+        if keep:
+            logger.info(f"Kept scratch directory {work_dir}.")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    total_seconds = sum(p["seconds"] for p in phases)
+    total_bytes = phases[0]["bytes"] if phases else 0
+    return {"mode": mode, "remote": remote, "workers": workers, "chunk_mb": chunk_mb, "hash": hash_on_copy,
+            "transfers": transfers, "phases": phases, "errors": errors,
+            "total": {"seconds": round(total_seconds, 3), "bytes": total_bytes,
+                      "mb_per_s": round(total_bytes / 1024**2 / total_seconds, 2) if total_seconds else 0.0}}
+
+
+def _version():
+    try:
+        result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BASE_DIR,
+                                capture_output=True, text=True, timeout=10)
+        return result.stdout.strip() or "unknown"
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+
+
+def save_result(record, path=RESULTS_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def load_results(path=RESULTS_PATH):
+    records = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def _format_row(record):
+    phases = ", ".join(f"{p['phase']} {p['mb_per_s']:.1f} MB/s {p['files_per_s']:.1f} f/s "
+                       f"{p['cpu_percent']:.0f}% cpu {p['peak_rss_mb']:.0f}+{p['peak_rclone_rss_mb']:.0f} MB"
+                       for p in record["phases"])
+    return (f"{record['started_at'][:19]}  {record['version']:<14} {record.get('label') or '-':<12} "
+            f"{record['mode']:<8} w={record['workers']:<2} chunk={record['chunk_mb']:<3} "
+            f"{'hash' if record['hash'] else 'nohash':<6} {record['total']['mb_per_s']:>8.1f} MB/s  {phases}")
+
+
+# --- CLI ---
+def _parser():
+    parser = argparse.ArgumentParser(description="Benchmark the offload and upload path.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    make = commands.add_parser("make-card", help="build a synthetic camera card")
+    make.add_argument("dir")
+    make.add_argument("--photos", type=int, default=400, help="JPG count")
+    make.add_argument("--photo-kb", type=int, default=8000)
+    make.add_argument("--raws", type=int, default=200, help="ARW count")
+    make.add_argument("--raw-mb", type=int, default=24)
+    make.add_argument("--clips", type=int, default=4, help="MP4 count")
+    make.add_argument("--clip-mb", type=int, default=1024)
+    make.add_argument("--tmpfs", type=int, metavar="MB", help="mount a tmpfs of this size at DIR first (root)")
+    make.add_argument("--image", metavar="FILE", help="loop-mount a FAT image at DIR first (root)")
+    make.add_argument("--image-mb", type=int, default=8192)
+    make.add_argument("--fs", choices=("vfat", "exfat"), default="vfat")
+
+    run = commands.add_parser("run", help="offload and upload a card, recording the result")
+    run.add_argument("--card", help="card to use (default: a small synthetic one, built and removed)")
+    run.add_argument("--mode", choices=MODES, default="pipeline")
+    run.add_argument("--remote", choices=REMOTES, default="local")
+    run.add_argument("--workers", default=str(offload_engine.DEFAULT_WORKERS), help="count, or a list like 1,2,4")
+    run.add_argument("--chunk-mb", default="8", help="copy chunk size, or a list like 1,8,32")
+    run.add_argument("--transfers", type=int, default=upload_scheduler.MAX_TRANSFERS)
+    run.add_argument("--no-hash", action="store_true", help="copy with copy_file_range instead of hashing")
+    run.add_argument("--label", default="")
+    run.add_argument("--results", default=RESULTS_PATH)
+    run.add_argument("--keep", action="store_true", help="keep the scratch footage and remote")
+
+    compare = commands.add_parser("compare", help="print stored results")
+    compare.add_argument("--results", default=RESULTS_PATH)
+    compare.add_argument("--last", type=int, default=20)
+    compare.add_argument("--label")
+    return parser
+
+
+def main(argv):
+    args = _parser().parse_args(argv)
+    if args.command == "make-card":
+        if args.tmpfs:
+            mount_tmpfs(args.dir, args.tmpfs)
+        elif args.image:
+            mount_image(args.image, args.dir, args.image_mb, args.fs)
+        make_card(args.dir, args.photos, args.photo_kb, args.raws, args.raw_mb, args.clips, args.clip_mb)
+        return 0
+    if args.command == "compare":
+        records = [r for r in load_results(args.results) if not args.label or r.get("label") == args.label]
+        for record in records[-args.last:]:
+            print(_format_row(record))
+        return 0
+
+    card = args.card
+    scratch_card = None
+    if not card:
+        scratch_card = card = tempfile.mkdtemp(prefix="sdtransfer-card-")
+        make_card(card, photos=100, photo_kb=4000, raws=20, raw_mb=24, clips=2, clip_mb=256)
+    failed = False
+    try:
+        for workers in [int(w) for w in args.workers.split(",")]:
+            for chunk_mb in [int(c) for c in args.chunk_mb.split(",")]:
+                record = {"started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                          "version": _version(), "label": args.label, "host": socket.gethostname(),
+                          "card": os.path.abspath(card)}
+                record.update(run_once(card, args.mode, args.remote, workers, chunk_mb, not args.no_hash,
+                                       args.transfers, args.keep))
+                save_result(record, args.results)
+                print(_format_row(record))
+                for error in record["errors"]:
+                    print(f"  error: {error}")
+                failed = failed or bool(record["errors"])
+    finally:
+        if scratch_card:
+            shutil.rmtree(scratch_card, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    logging.getLogger("benchmark").setLevel(logging.INFO)
+    sys.exit(main(sys.argv[1:]))
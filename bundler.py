@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# bundler.py
+# Packs small photos into tar bundles so they reach Drive as a few large objects.
+# Thousands of JPG/ARW files cost one Drive API object each, and per-object
+# latency and rate limits, not bandwidth, cap the upload. With PHOTO_BUNDLE_MB
+# set, uploader.py groups pending photos of one folder (camera/card/date) into
+# uncompressed tar archives of up to that size and streams each one into
+# `rclone rcat` as it is read, so nothing is staged twice. Every bundle gets a
+# JSON index next to it on the remote (bundles/.../<name>.tar.json) listing each
+# member's offset, size and hash; the same rows go in the offload index's
+# bundle_members table. A single photo is restored with one ranged read
+# (rclone cat --offset --count) and checked against the hash taken off the card.
+#   ./bundler.py restore <LOCAL_PATH> [DEST]    fetch one photo back out of its bundle
+#   ./bundler.py list [BUNDLE]                  bundles, or the members of one
+#   ./bundler.py reindex                        rebuild bundle_members from the remote indexes
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import tarfile
+import subprocess
+
+import checksums
+import config
+import offload_index
+
+# --- Configuration ---
+BUNDLE_MAX_BYTES = config.get_int("PHOTO_BUNDLE_MB", 0) * 1024 * 1024  # 0 = upload photos one by one
+FILE_MAX_BYTES = config.get_int("BUNDLE_FILE_MAX_MB", 64) * 1024 * 1024  # larger files go up on their own
+MIN_FILES = config.get_int("BUNDLE_MIN_FILES", 4)  # fewer than this in a folder is not worth a bundle
+CATEGORIES = ("photos",)
+BUNDLE_DIR = "bundles"  # below RCLONE_BASE_PATH, mirroring footage/<category>/...
+INDEX_SUFFIX = ".json"
+READ_SIZE = 1024 * 1024
+_rclone = config.rclone_settings()
+
+logger = logging.getLogger("bundler")
+
+
+class BundleError(Exception):
+    pass
+
+
+def enabled(category):
+    return BUNDLE_MAX_BYTES > 0 and category in CATEGORIES
+
+
+def remote_path(rel_path=""):
+    return f"{_rclone['remote_name']}:{_rclone['base_path']}/{BUNDLE_DIR}/{rel_path}"
+
+
+# --- Planning ---
+def plan(rows, max_bytes=BUNDLE_MAX_BYTES, file_max=FILE_MAX_BYTES, min_files=MIN_FILES):
+    """Splits index rows into bundles (lists of rows from one folder) and the rows that go up loose."""
+    by_folder = {}
+    loose = []
+    for row in rows:
+        if row["size"] > file_max:
+            loose.append(row)
+        else:
+            by_folder.setdefault(os.path.dirname(row["local_path"]), []).append(row)
+    bundles = []
+    for folder_rows in by_folder.values():
+        current, size = [], 0
+        for row in folder_rows:
+            if current and size + row["size"] > max_bytes:
+                bundles.append(current)
+                current, size = [], 0
+            current.append(row)
+            size += row["size"]
+        bundles.append(current)
+    planned = [rows for rows in bundles if len(rows) >= min_files]
+    loose += [row for rows in bundles if len(rows) < min_files for row in rows]
+    return planned, loose
+
+
+def indexed_rows(conn, rows, local_base=offload_index.DEFAULT_LOCAL_BASE):
+    """Full clips rows for rows that may carry only category, local_path and size (the pipeline's queue)."""
+    full = []
+    for row in rows:
+        found = conn.execute("SELECT * FROM clips WHERE local_path = ?", (row["local_path"],)).fetchone()
+        if found is None:
+            try:
+                mtime_ns = os.stat(os.path.join(local_base, row["local_path"])).st_mtime_ns
+            except OSError:
+                mtime_ns = 0
+            found = {"local_path": row["local_path"], "category": row["category"], "size": row["size"],
+                     "mtime_ns": mtime_ns, "algo": None, "digest": None}
+        full.append(found)
+    return full
+
+
+def _header(name, row):
+    info = tarfile.TarInfo(name)
+    info.size = row["size"]
+    info.mtime = row["mtime_ns"] // 1_000_000_000
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _padding(size):
+    return -size % tarfile.BLOCKSIZE
+
+
+class Bundle:
+    """One tar archive. Headers and offsets are laid out up front, so the exact size is known before streaming."""
+
+    def __init__(self, rows, local_base):
+        self.local_base = local_base
+        folder = os.path.dirname(rows[0]["local_path"])
+        self.path = f"{folder}/bundle-{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}.tar"
+        self.rows = rows
+        self.members = []
+        offset = 0
+        for row in rows:
+            header = _header(os.path.basename(row["local_path"]), row)
+            offset += len(header)
+            self.members.append((row, header, offset))
+            offset += row["size"] + _padding(row["size"])
+        self.size = offset + 2 * tarfile.BLOCKSIZE
+        self.md5 = None
+        self.entries = []
+
+    def write(self, out, checkpoint=None):
+        """Streams the archive into out, hashing each member and the whole bundle on the way.
+
+        checkpoint(nbytes) is called per read; returning False aborts with BundleError.
+        A member whose bytes no longer match the hash recorded at offload also aborts it.
+        """
+        bundle_md5 = hashlib.md5()  # Drive reports md5Checksum, so the upload can be checked
+
+        def emit(data):
+            bundle_md5.update(data)
+            out.write(data)
+
+        self.entries = []
+        for row, header, offset in self.members:
+            emit(header)
+            algo = row["algo"] or checksums.available_algorithm()
+            try:
+                hasher = checksums.new_hasher(algo)
+            except ValueError:
+                algo = checksums.available_algorithm()
+                hasher = checksums.new_hasher(algo)
+            path = os.path.join(self.local_base, row["local_path"])
+            remaining = row["size"]
+            with open(path, "rb") as f:
+                while remaining > 0:
+                    data = f.read(min(READ_SIZE, remaining))
+                    if not data:
+                        raise BundleError(f"{row['local_path']} is shorter than the {row['size']} bytes indexed")
+                    hasher.update(data)
+                    emit(data)
+                    remaining -= len(data)
+                    if checkpoint is not None and checkpoint(len(data)) is False:
+                        raise BundleError("cancelled")
+            digest = hasher.hexdigest()
+            if row["digest"] and row["algo"] == algo and row["digest"] != digest:
+                raise BundleError(f"{row['local_path']} no longer matches the hash taken off the card")
+            emit(b"\0" * _padding(row["size"]))
+            self.entries.append({"path": row["local_path"], "name": os.path.basename(row["local_path"]),
+                                 "offset": offset, "size": row["size"], "mtime_ns": row["mtime_ns"],
+                                 "algo": algo, "digest": digest})
+        emit(b"\0" * (2 * tarfile.BLOCKSIZE))
+        self.md5 = bundle_md5.hexdigest()
+        return self.md5
+
+    def index(self):
+        """The sidecar uploaded next to the bundle; enough to restore any member without the local database."""
+        return {"bundle": self.path, "size": self.size, "md5": self.md5, "created_at": time.time(),
+                "members": self.entries}
+
+
+# --- bundle_members table ---
+def record(conn, index):
+    """Stores a bundle's index (as returned by Bundle.index) in the offload index."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO bundle_members (local_path, bundle, bundle_size, bundle_md5, offset, size, "
+        "mtime_ns, algo, digest, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(m["path"], index["bundle"], index["size"], index.get("md5"), m["offset"], m["size"], m["mtime_ns"],
+          m["algo"], m["digest"], index["created_at"]) for m in index["members"]])
+    conn.commit()
+
+
+def lookup(conn, local_path):
+    """Returns the bundle_members row for a photo, or None if it was not uploaded in a bundle."""
+    return conn.execute("SELECT * FROM bundle_members WHERE local_path = ?", (local_path,)).fetchone()
+
+
+def _rclone_cmd(*args):
+    return ["rclone", *args, "--config", _rclone["config_path"]]
+
+
+def restore(conn, local_path, dest):
+    """Fetches one photo out of its bundle with a ranged read and checks it against its hash."""
+    member = lookup(conn, local_path)
+    if member is None:
+        raise BundleError(f"{local_path} is not in any bundle (./bundler.py reindex rebuilds the list)")
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    tmp = dest + ".part"
+    try:
+        hasher = checksums.new_hasher(member["algo"])
+    except ValueError:
+        hasher = None
+        logger.warning(f"{member['algo']} is not available here; {local_path} will not be verified.")
+    cmd = _rclone_cmd("cat", "--offset", str(member["offset"]), "--count", str(member["size"]),
+                      remote_path(member["bundle"]))
+    written = 0
+    with open(tmp, "wb") as out:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for data in iter(lambda: process.stdout.read(READ_SIZE), b""):
+            if hasher is not None:
+                hasher.update(data)
+            out.write(data)
+            written += len(data)
+        stderr = process.stderr.read().decode("utf-8", errors="replace")
+        exit_code = process.wait()
+    try:
+        if exit_code != 0:
+            raise BundleError(f"rclone cat exited with code {exit_code}: {stderr.strip()[-200:]}")
+        if written != member["size"]:
+            raise BundleError(f"Got {written} of {member['size']} bytes for {local_path}")
+        if hasher is not None and member["digest"] and hasher.hexdigest() != member["digest"]:
+            raise BundleError(f"{local_path} from {member['bundle']} does not match its {member['algo']} hash")
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    mtime = member["mtime_ns"] / 1e9
+    os.utime(dest, (mtime, mtime))
+    logger.info(f"Restored {local_path} from {member['bundle']} to {dest}.")
+    return dest
+
+
+def reindex(conn):
+    """Re-reads every bundle index on the remote into bundle_members. Returns the number of bundles."""
+    result = subprocess.run(_rclone_cmd("lsf", "-R", "--files-only", "--include", f"*.tar{INDEX_SUFFIX}",
+                                        remote_path()), capture_output=True, text=True, timeout=600)
+    if result.returncode != 0:
+        raise BundleError(f"rclone lsf exited with code {result.returncode}: {result.stderr.strip()[-200:]}")
+    count = 0
+    for name in result.stdout.split():
+        fetched = subprocess.run(_rclone_cmd("cat", remote_path(name)), capture_output=True, timeout=600)
+        try:
+            index = json.loads(fetched.stdout)
+        except ValueError:
+            logger.warning(f"Skipping unreadable bundle index {name}.")
+            continue
+        record(conn, index)
+        count += 1
+    logger.info(f"Re-indexed {count} bundles from {remote_path()}.")
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    conn = offload_index.connect()
+    try:
+        if command == "restore" and len(sys.argv) > 2:
+            local_path = sys.argv[2]
+            dest = sys.argv[3] if len(sys.argv) > 3 else os.path.join(offload_index.DEFAULT_LOCAL_BASE, local_path)
+            restore(conn, local_path, dest)
+        elif command == "list":
+            if len(sys.argv) > 2:
+                for row in conn.execute("SELECT * FROM bundle_members WHERE bundle = ? ORDER BY offset",
+                                        (sys.argv[2],)):
+                    print(f"{row['offset']:>12} {row['size']:>10} {row['local_path']}")
+            else:
+                for row in conn.execute("SELECT bundle, bundle_size, COUNT(*) AS n FROM bundle_members "
+                                        "GROUP BY bundle ORDER BY bundle"):
+                    print(f"{row['bundle']}  {row['n']} files, {row['bundle_size'] / 1024**2:.1f} MB")
+        elif command == "reindex":
+            print(f"Re-indexed {reindex(conn)} bundles.")
+        else:
+            print("Usage: ./bundler.py restore <LOCAL_PATH> [DEST] | list [BUNDLE] | reindex")
+            sys.exit(1)
+    except BundleError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
@@ -0,0 +1,64 @@
+# cached_task.py
+# Runs slow commands (Wi-Fi scans, rclone authorize) off the request path.
+# A CachedTask keeps the last result of its function and re-runs it on a daemon
+# thread when asked and the result is older than ttl; request handlers read the
+# cached state at once and pages poll a small JSON endpoint until it is ready.
+# At most one run per task is in flight, however many requests ask for it.
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger("cached_task")
+
+IDLE, RUNNING, READY, ERROR = "idle", "running", "ready", "error"
+
+
+class CachedTask:
+    """The cached result of func(*args), refreshed in the background."""
+
+    def __init__(self, name, func, ttl):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._running = False
+        self._value = None
+        self._error = None
+        self._updated_at = None
+
+    def _stale(self):
+        return self._updated_at is None or time.time() - self._updated_at >= self.ttl
+
+    def refresh(self, *args, force=False):
+        """Starts a run if none is in flight and the result is stale (or force). Returns state()."""
+        with self._lock:
+            if not self._running and (force or self._stale()):
+                self._running = True
+                threading.Thread(target=self._run, args=args, name=f"task-{self.name}", daemon=True).start()
+        return self.state()
+
+    def _run(self, *args):
+        try:
+            value, error = self.func(*args), None
+        except Exception as e:
+            value, error = None, str(e) or type(e).__name__
+            logger.warning(f"{self.name} failed: {error}")
+        with self._lock:
+            if error is None:
+                self._value = value
+            self._error = error
+            self._updated_at = time.time()
+            self._running = False
+
+    def state(self):
+        """Returns {"state", "value", "error", "age"}; value is the last good result, even while refreshing."""
+        with self._lock:
+            if self._running:
+                state = RUNNING
+            elif self._updated_at is None:
+                state = IDLE
+            else:
+                state = ERROR if self._error else READY
+            age = round(time.time() - self._updated_at, 1) if self._updated_at is not None else None
+            return {"state": state, "value": self._value, "error": self._error, "age": age}
@@ -0,0 +1,176 @@
+# card_stream.py
+# Direct card -> cloud streaming for the offload engine.
+# In "stream" mode (or "auto" once local disk runs low) a clip is read from the
+# card once, hashed on the way through, and piped into `rclone rcat`, which
+# uploads it to Drive in resumable chunks (--drive-chunk-size) without ever
+# touching footage/. The remote copy is then checked against the size (and the
+# md5 when that is the hash in use) before the clip counts as uploaded.
+#   OFFLOAD_MODE=local    always stage in footage/ (the default)
+#   OFFLOAD_MODE=stream   never keep a local copy
+#   OFFLOAD_MODE=auto     keep local copies while EVICT_MIN_FREE_GB would remain free
+#                         (the reserve eviction.py and planner.py keep too)
+
+import os
+import time
+import shutil
+import logging
+import threading
+import subprocess
+
+import checksums
+import config
+import event_bus
+import eviction
+import uploader
+import upload_scheduler
+
+# --- Configuration ---
+OFFLOAD_MODE = config.get_str("OFFLOAD_MODE", "local")
+STREAM_CONCURRENCY = config.get_int("STREAM_CONCURRENCY", 1)
+CHUNK_SIZE = 8 * 1024 * 1024
+MODES = ("local", "stream", "auto")
+
+logger = logging.getLogger("card_stream")
+
+
+class StreamFailed(Exception):
+    pass
+
+
+class StreamPolicy:
+    """Decides per clip whether to stage locally, and streams the ones that are not."""
+
+    def __init__(self, local_base, mode=OFFLOAD_MODE, min_free=eviction.MIN_FREE_BYTES,
+                 concurrency=STREAM_CONCURRENCY):
+        if mode not in MODES:
+            raise ValueError(f"Unknown OFFLOAD_MODE '{mode}' (expected one of {', '.join(MODES)}).")
+        self.mode = mode
+        self.local_base = local_base
+        self._lock = threading.Lock()
+        # One rcat per slot: the bwlimit timetable applies per rclone process.
+        self._slots = threading.Semaphore(max(1, concurrency))
+        self.min_free = min_free
+        self._local_budget = None
+
+    def _measure_budget(self):
+        # local_base may not exist before the first offload; measure the filesystem it will live on.
+        probe = os.path.abspath(self.local_base)
+        while not os.path.exists(probe) and os.path.dirname(probe) != probe:
+            probe = os.path.dirname(probe)
+        try:
+            free = shutil.disk_usage(probe).free
+        except OSError:
+            free = 0
+        return free - self.min_free
+
+    def keep_local(self, task):
+        if self.mode == "local":
+            return True
+        if self.mode == "stream":
+            return False
+        with self._lock:
+            if self._local_budget is None:
+                # Measured once per run, at the first clip (after any eviction);
+                # each clip kept locally is charged against it.
+                self._local_budget = self._measure_budget()
+            if task["size"] <= self._local_budget:
+                self._local_budget -= task["size"]
+                return True
+            return False
+
+    def stream(self, task, checkpoint=None):
+        """Uploads task["src"] straight to the remote. Returns a result dict like offload_engine's.
+
+        checkpoint(nbytes) is called per chunk; it may block (pause) or raise (cancel).
+        """
+        with self._slots:
+            return self._stream(task, checkpoint)
+
+    def _stream(self, task, checkpoint):
+        category = task["category"]
+        name = os.path.relpath(task["rel_path"], category)
+        target = uploader.remote_path(category) + name
+        hasher = checksums.new_hasher()
+        event_bus.publish("transfer", event="file_started", name=task["rel_path"], size=task["size"],
+                          streamed=True)
+        cmd = (["rclone", "rcat", "--size", str(task["size"]), target] + uploader.RCLONE_OPTS
+               + upload_scheduler.rclone_args(remote_control=False))
+        start = time.monotonic()
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                   text=False, start_new_session=True)
+        stderr_lines = []
+        reader = threading.Thread(target=self._drain, args=(process, stderr_lines), daemon=True)
+        reader.start()
+        sent = 0
+        try:
+            with open(task["src"], "rb", buffering=0) as fsrc:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                buf = bytearray(CHUNK_SIZE)
+                view = memoryview(buf)
+                while True:
+                    n = fsrc.readinto(buf)
+                    if not n:
+                        break
+                    hasher.update(view[:n])
+                    process.stdin.write(view[:n])
+                    sent += n
+                    if checkpoint is not None:
+                        checkpoint(n)
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            process.stdin.close()
+            exit_code = process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            reader.join()
+        if exit_code != 0:
+            raise StreamFailed(f"rclone rcat exited with code {exit_code}: {' | '.join(stderr_lines[-3:])}")
+        if sent != task["size"]:
+            raise StreamFailed(f"Short read from card: {sent} of {task['size']} bytes")
+        digest = hasher.hexdigest()
+        self._verify(category, name, task, digest)
+        self._set_modtime(target, task["mtime_ns"])
+        seconds = time.monotonic() - start
+        uploader.UPLOADED_BYTES.inc(sent, category=category)
+        uploader.UPLOADED_FILES.inc(category=category, method="rcat")
+        return {"category": category, "src": task["src"], "dst": target, "rel_path": task["rel_path"],
+                "bytes": sent, "seconds": seconds, "method": f"rcat:{checksums.available_algorithm()}",
+                "mb_per_s": (sent / 1024**2) / seconds if seconds > 0 else 0.0, "digest": digest,
+                "streamed": True}
+
+    @staticmethod
+    def _drain(process, lines):
+        for raw in process.stderr:
+            line = raw.decode("utf-8", errors="replace").strip()
+            if line:
+                entry = uploader.parse_log_line(line)
+                if entry.get("level") == "error":
+                    lines.append(entry.get("msg", "").strip())
+
+    @staticmethod
+    def _verify(category, name, task, digest):
+        try:
+            record = uploader.remote_stat(category, name)
+        except uploader.RemoteError as e:
+            raise StreamFailed(f"Could not verify {name} on the remote: {e}") from e
+        if record is None:
+            raise StreamFailed(f"{name} not found on the remote after upload")
+        if record.get("Size") != task["size"]:
+            raise StreamFailed(f"Remote size {record.get('Size')} != card size {task['size']} for {name}")
+        remote_md5 = (record.get("Hashes") or {}).get("md5")
+        if checksums.available_algorithm() == "md5" and remote_md5 and remote_md5 != digest:
+            raise StreamFailed(f"Remote md5 {remote_md5} != card md5 {digest} for {name}")
+
+    @staticmethod
+    def _set_modtime(target, mtime_ns):
+        # rcat stamps the upload time; keep the clip's recording time like `rclone copy` would.
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(mtime_ns / 1e9))
+        try:
+            subprocess.run(["rclone", "touch", "--no-create", "--timestamp", stamp, "--config",
+                            uploader.RCLONE_CONFIG_PATH, target], capture_output=True, timeout=120)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"Could not set modification time on {target}: {e}")
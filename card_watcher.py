@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# card_watcher.py
+# Long-running card detection daemon (card-watcher.service).
+# Listens for block-device events over udev netlink (pyudev), or polls
+# /dev/disk/by-uuid once a second when pyudev is not installed. A new
+# vfat/exfat partition is identified by its filesystem UUID, mounted if no
+# automounter got there first, given a large read-ahead for sequential clip
+# reads, and handed to the web app (POST /internal/card_event), which queues
+# the offload. Those calls carry INTERNAL_NOTIFY_TOKEN from .env
+# (install_sdtransfer.sh generates it); without one cards are mounted but not
+# reported. Once the job finishes cleanly (every clip hashed on copy and
+# confirmed on the remote) the watcher ejects the card: safe_eject.sh runs as
+# the project user, like the web UI's Eject, and only an unmount it cannot do
+# is finished here as root.
+#   ./card_watcher.py            run the watcher (as root, to mount and tune)
+#   ./card_watcher.py --once     report cards present now and exit
+
+import os
+import pwd
+import sys
+import json
+import time
+import logging
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+
+import config
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_URL = config.get_str("CARD_APP_URL", "http://127.0.0.1:5000")
+AUTO_EJECT = config.get_bool("CARD_AUTO_EJECT", True)
+EJECT_SCRIPT = os.path.join(BASE_DIR, "safe_eject.sh")
+JOB_POLL_SECONDS = 5
+CARD_UUIDS = [u.strip() for u in config.get_str("CARD_UUIDS", "").split(",") if u.strip()]
+CARD_FS_TYPES = ("vfat", "exfat")
+MOUNT_BASE = config.get_str("CARD_MOUNT_BASE", "/media/sdcards")
+MOUNT_OPTIONS = config.get_str("CARD_MOUNT_OPTIONS", "noatime")
+READ_AHEAD_KB = config.get_int("CARD_READ_AHEAD_KB", 4096)
+CARD_DIRS = (config.get_str("VIDEO_REL_PATH", "PRIVATE/M4ROOT/CLIP"),
+             config.get_str("PHOTO_REL_PATH", "DCIM/100MSDCF"))
+POLL_SECONDS = 1.0
+BY_UUID = "/dev/disk/by-uuid"
+NOTIFY_ATTEMPTS = 5
+
+logger = logging.getLogger("card_watcher")
+
+
+# --- Devices ---
+def _blkid(device, tag):
+    try:
+        result = subprocess.run(["blkid", "-o", "value", "-s", tag, device],
+                                capture_output=True, text=True, timeout=5)
+        return result.stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+
+def mount_point(device):
+    """Returns where device is mounted, or None."""
+    device = os.path.realpath(device)
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and os.path.realpath(fields[0]) == device:
+                    return fields[1].replace("\\040", " ")
+    except OSError:
+        pass
+    return None
+
+
+def set_read_ahead(device, kb=READ_AHEAD_KB):
+    """Raises the read-ahead of the disk holding device; card readers default to 128 KB."""
+    sys_path = os.path.realpath(f"/sys/class/block/{os.path.basename(os.path.realpath(device))}")
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        sys_path = os.path.dirname(sys_path)
+    try:
+        with open(os.path.join(sys_path, "queue", "read_ahead_kb"), "w") as f:
+            f.write(str(kb))
+        return True
+    except OSError as e:
+        logger.warning(f"Could not set read-ahead on {sys_path}: {e}")
+        return False
+
+
+def mount_card(device, uuid):
+    """Mounts device under MOUNT_BASE unless something already has. Returns the mount point or None."""
+    existing = mount_point(device)
+    if existing:
+        return existing
+    target = os.path.join(MOUNT_BASE, uuid)
+    os.makedirs(target, exist_ok=True)
+    # FAT/exFAT have no owners; hand the files to the project user so the web
+    # app can wipe verified clips.
+    owner = os.stat(BASE_DIR)
+    options = f"{MOUNT_OPTIONS},uid={owner.st_uid},gid={owner.st_gid}"
+    result = subprocess.run(["mount", "-o", options, device, target], capture_output=True, text=True,
+                            timeout=30)
+    if result.returncode != 0:
+        # An automounter may have won the race.
+        existing = mount_point(device)
+        if existing:
+            return existing
+        logger.error(f"Could not mount {device} at {target}: {result.stderr.strip()}")
+        return None
+    return target
+
+
+def is_camera_card(mount):
+    return any(os.path.isdir(os.path.join(mount, rel)) for rel in CARD_DIRS)
+
+
+# --- Web app ---
+def _app_request(path, body=None):
+    request = urllib.request.Request(f"{APP_URL}{path}", method="POST" if body is not None else "GET",
+                                     data=json.dumps(body).encode() if body is not None else None,
+                                     headers={"Content-Type": "application/json",
+                                              "X-Notify-Token": config.internal_notify_token()})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read() or b"{}")
+
+
+def notify_app(event, **fields):
+    """Posts a card event to the web app, retrying while it starts up. Returns the reply or None."""
+    if not config.internal_notify_token():
+        logger.error(f"Not reporting card event '{event}': INTERNAL_NOTIFY_TOKEN is not set in .env.")
+        return None
+    for attempt in range(1, NOTIFY_ATTEMPTS + 1):
+        try:
+            return _app_request("/internal/card_event", dict(fields, event=event))
+        except urllib.error.HTTPError as e:
+            logger.error(f"Web app rejected card event '{event}': HTTP {e.code}")
+            return None
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            logger.warning(f"Web app not reachable for card event '{event}' (attempt {attempt}): {e}")
+            time.sleep(min(2 ** attempt, 30))
+    return None
+
+
+def wait_for_job(job_id):
+    """Polls the web app until the job finishes. Returns its final state, or None if it vanished."""
+    while True:
+        try:
+            job = _app_request(f"/internal/jobs/{job_id}")
+        except urllib.error.HTTPError:
+            # The app runs one worker and keeps jobs in memory: a 404 means it
+            # restarted and the job is gone, so the card is not ejected.
+            return None
+        except (urllib.error.URLError, OSError, ValueError):
+            job = {}
+        if job.get("state") in ("done", "failed", "cancelled"):
+            return job["state"]
+        time.sleep(JOB_POLL_SECONDS)
+
+
+def _project_user():
+    try:
+        return pwd.getpwuid(os.stat(BASE_DIR).st_uid).pw_name
+    except (KeyError, OSError):
+        return None
+
+
+def eject(mount):
+    """Ejects a verified card. Returns True once it is no longer mounted."""
+    env = dict(os.environ, SD_MOUNT_PATH=mount)
+    cmd = ["bash", EJECT_SCRIPT, mount]
+    user = _project_user()
+    as_root = os.geteuid() == 0
+    if as_root and user:
+        # Run as root, safe_eject.sh's log writer would leave logs/eject.log and its
+        # segments root-owned, and the web UI's Eject jobs could no longer write them.
+        cmd = ["runuser", "-u", user, "--"] + cmd
+    result = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=120)
+    if not os.path.ismount(mount):
+        return result.returncode == 0
+    if not as_root:
+        return False
+    # A card the watcher mounted as root is not the project user's to unmount.
+    subprocess.run(["sync"], timeout=120)
+    umount = subprocess.run(["umount", mount], capture_output=True, text=True, timeout=60)
+    if umount.returncode != 0:
+        logger.error(f"Could not unmount {mount}: {umount.stderr.strip()}")
+        return False
+    logger.info(f"Unmounted {mount} as root; safe_eject.sh could not as {user}.")
+    return True
+
+
+class CardWatcher:
+    """Tracks cards by filesystem UUID and reports insertions and removals."""
+
+    def __init__(self):
+        self.cards = {}  # uuid -> {"device", "mount"}
+
+    def card_added(self, device, uuid, fs_type):
+        if not uuid or uuid in self.cards:
+            return
+        # Ignored devices are remembered too, so polling does not probe them every second.
+        self.cards[uuid] = {"device": device, "mount": None}
+        if fs_type not in CARD_FS_TYPES or (CARD_UUIDS and uuid not in CARD_UUIDS):
+            logger.debug(f"Ignoring {device} ({fs_type}, UUID {uuid}).")
+            return
+        started = time.monotonic()
+        already_mounted = mount_point(device) is not None
+        mount = mount_card(device, uuid)
+        if mount is None:
+            del self.cards[uuid]  # try again on the next event
+            return
+        if not is_camera_card(mount):
+            logger.info(f"{device} (UUID {uuid}) at {mount} has no camera folders; ignoring it.")
+            if not already_mounted:
+                subprocess.run(["umount", mount], capture_output=True, timeout=30)
+            return
+        set_read_ahead(device)
+        self.cards[uuid] = {"device": device, "mount": mount}
+        logger.info(f"Card {uuid} on {device} ready at {mount} in {time.monotonic() - started:.2f}s.")
+        reply = notify_app("inserted", uuid=uuid, device=device, mount=mount)
+        if reply and reply.get("job"):
+            logger.info(f"Offload job {reply['job']['id']} queued for card {uuid}.")
+            if AUTO_EJECT:
+                threading.Thread(target=self._eject_when_verified, args=(uuid, mount, reply["job"]["id"]),
+                                 name=f"eject-{uuid}", daemon=True).start()
+
+    def _eject_when_verified(self, uuid, mount, job_id):
+        state = wait_for_job(job_id)
+        if uuid not in self.cards:
+            return  # pulled out already
+        if state != "done":
+            logger.warning(f"Offload job {job_id} for card {uuid} ended {state or 'unknown'}; leaving it mounted.")
+            return
+        if eject(mount):
+            logger.info(f"Card {uuid} verified and ejected; safe to remove.")
+        else:
+            logger.error(f"Card {uuid} verified but safe_eject.sh failed; see logs/eject.log.")
+
+    def card_removed(self, uuid):
+        card = self.cards.pop(uuid, None)
+        if card and card["mount"]:
+            logger.info(f"Card {uuid} removed from {card['device']}.")
+            notify_app("removed", uuid=uuid, device=card["device"], mount=card["mount"])
+
+    # --- Event sources ---
+    def run_udev(self):
+        context = pyudev.Context()
+        monitor = pyudev.Monitor.from_netlink(context)
+        monitor.filter_by(subsystem="block")
+        for device in context.list_devices(subsystem="block"):
+            if device.get("ID_FS_UUID"):
+                self.card_added(device.device_node, device.get("ID_FS_UUID"), device.get("ID_FS_TYPE"))
+        for device in iter(monitor.poll, None):
+            uuid = device.get("ID_FS_UUID")
+            if device.action in ("add", "change") and uuid:
+                self.card_added(device.device_node, uuid, device.get("ID_FS_TYPE"))
+            elif device.action == "remove":
+                for known, card in list(self.cards.items()):
+                    if card["device"] == device.device_node:
+                        self.card_removed(known)
+
+    def poll_once(self):
+        try:
+            present = {uuid: os.path.realpath(os.path.join(BY_UUID, uuid)) for uuid in os.listdir(BY_UUID)}
+        except OSError:
+            present = {}
+        for uuid, device in present.items():
+            if uuid not in self.cards:
+                self.card_added(device, uuid, _blkid(device, "TYPE"))
+        for uuid in list(self.cards):
+            if uuid not in present:
+                self.card_removed(uuid)
+
+    def run_polling(self):
+        while True:
+            self.poll_once()
+            time.sleep(POLL_SECONDS)
+
+    def run(self):
+        if pyudev is not None:
+            logger.info("Watching for cards via udev.")
+            self.run_udev()
+        else:
+            logger.info(f"pyudev not installed; polling {BY_UUID} every {POLL_SECONDS:.0f}s.")
+            self.run_polling()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    if "--once" in sys.argv[1:]:
+        for uuid in sorted(os.listdir(BY_UUID)) if os.path.isdir(BY_UUID) else []:
+            device = os.path.realpath(os.path.join(BY_UUID, uuid))
+            print(f"{uuid}\t{device}\t{_blkid(device, 'TYPE') or '?'}\t{mount_point(device) or '(not mounted)'}")
+        sys.exit(0)
+    if not config.internal_notify_token():
+        logger.error("INTERNAL_NOTIFY_TOKEN is not set in .env (or is the placeholder); cards will be mounted "
+                     "but no offloads queued. Re-run install_sdtransfer.sh or set it by hand.")
+    CardWatcher().run()
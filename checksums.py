@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# checksums.py
+# Fast content hashing and the sidecar manifest written during offload.
+# Prefers xxhash, then BLAKE3, and falls back to hashlib's blake2b so the
+# offloader still works on a bare Python install.
+#   ./checksums.py verify [LOCAL_BASE]   re-hash local copies against the manifest
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+import config
+import offload_index
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_NAME = "manifest.jsonl"
+# "auto" picks the fastest available; "md5" matches Google Drive's md5Checksum.
+HASH_ALGO = config.get_str("OFFLOAD_HASH_ALGO", "auto")
+READ_SIZE = 8 * 1024 * 1024
+
+_manifest_lock = threading.Lock()
+
+
+# --- Hashers ---
+def available_algorithm():
+    """Returns the name of the algorithm new_hasher() will use."""
+    if HASH_ALGO != "auto":
+        return HASH_ALGO
+    if xxhash is not None:
+        return "xxh3_128"
+    if blake3 is not None:
+        return "blake3"
+    return "blake2b"
+
+
+def new_hasher(algo=None):
+    """Returns a hashlib-style object with update() and hexdigest()."""
+    algo = algo or available_algorithm()
+    if algo == "xxh3_128":
+        if xxhash is None:
+            raise ValueError("xxhash is not installed")
+        return xxhash.xxh3_128()
+    if algo == "blake3":
+        if blake3 is None:
+            raise ValueError("blake3 is not installed")
+        return blake3.blake3()
+    if algo == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(algo)
+
+
+def hash_file(path, algo=None):
+    """Hashes a file from disk. Only used for later verification, never during copy."""
+    hasher = new_hasher(algo)
+    buf = bytearray(READ_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+# --- Manifest ---
+def manifest_path(local_base):
+    return os.path.join(local_base, MANIFEST_NAME)
+
+
+def append_manifest(local_base, entry):
+    """Appends one record ({path, size, mtime_ns, algo, digest}) to the manifest."""
+    record = dict(entry, ts=time.strftime("%Y-%m-%d %H:%M:%S"))
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _manifest_lock:
+        with open(manifest_path(local_base), "a") as f:
+            f.write(line)
+
+
+def load_manifest(local_base):
+    """Returns {relative path: latest record} from the manifest."""
+    records = {}
+    try:
+        with open(manifest_path(local_base), "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn last line after a power cut
+                records[record["path"]] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def verify_local(local_base):
+    """Re-hashes every manifest entry still on disk. Returns (ok, mismatched, missing) lists."""
+    ok, mismatched, missing = [], [], []
+    for rel_path, record in load_manifest(local_base).items():
+        path = os.path.join(local_base, rel_path)
+        if not os.path.exists(path):
+            missing.append(rel_path)
+        elif hash_file(path, record["algo"]) == record["digest"]:
+            ok.append(rel_path)
+        else:
+            mismatched.append(rel_path)
+    return ok, mismatched, missing
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "verify":
+        print("Usage: ./checksums.py verify [LOCAL_BASE]")
+        sys.exit(1)
+    base = sys.argv[2] if len(sys.argv) > 2 else config.get_str("OFFLOAD_PATH", os.path.join(BASE_DIR, "footage"))
+    ok, mismatched, missing = verify_local(base)
+    conn = offload_index.connect()
+    ok_paths = set(ok)
+    verified = [row["local_path"] for row in offload_index.pending_uploads(conn) if row["local_path"] in ok_paths]
+    offload_index.mark_local(conn, verified, offload_index.STATE_VERIFIED)
+    for rel_path in mismatched:
+        print(f"MISMATCH {rel_path}")
+    for rel_path in missing:
+        print(f"MISSING  {rel_path}")
+    print(f"{len(ok)} ok, {len(mismatched)} mismatched, {len(missing)} missing")
+    sys.exit(1 if mismatched else 0)
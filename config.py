@@ -0,0 +1,175 @@
+# config.py
+# Cached access to .env, email_config.json and the rclone settings.
+# Each file is parsed once and re-parsed only when its inode, size or mtime
+# changes; the stat itself is skipped if the file was checked within the last
+# CHECK_INTERVAL seconds, so hot paths like auth checks cost no disk I/O.
+
+import os
+import json
+import time
+import threading
+
+from dotenv import dotenv_values
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DOTENV_PATH = os.path.join(BASE_DIR, ".env")
+CHECK_INTERVAL = 1.0
+
+_TRUE_VALUES = ("1", "true", "yes", "on")
+
+
+class _CachedFile:
+    """Holds the parsed contents of one file, reloading when it changes on disk."""
+
+    def __init__(self, path, loader, empty):
+        self.path = path
+        self._loader = loader
+        self._empty = empty
+        self._value = empty
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked_at < CHECK_INTERVAL:
+            return self._value
+        with self._lock:
+            self._checked_at = now
+            try:
+                st = os.stat(self.path)
+                signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+            except OSError:
+                signature = None
+            if signature != self._signature:
+                self._signature = signature
+                try:
+                    self._value = self._loader(self.path) if signature else self._empty
+                except Exception:
+                    self._value = self._empty
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = 0.0
+            self._signature = ()
+
+
+def _load_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+_dotenv = _CachedFile(DOTENV_PATH, lambda path: dict(dotenv_values(path)), {})
+
+
+# --- .env accessors ---
+def get_str(key, default=""):
+    """Returns key from .env, falling back to the process environment, then default."""
+    value = _dotenv.get().get(key)
+    if value is None:
+        value = os.environ.get(key)
+    return default if value is None else value
+
+
+def get_int(key, default=0):
+    try:
+        return int(get_str(key, str(default)))
+    except ValueError:
+        return default
+
+
+def get_float(key, default=0.0):
+    try:
+        return float(get_str(key, str(default)))
+    except ValueError:
+        return default
+
+
+def get_bool(key, default=False):
+    value = get_str(key, "")
+    return value.strip().lower() in _TRUE_VALUES if value else default
+
+
+def dotenv_exists():
+    return os.path.exists(DOTENV_PATH)
+
+
+def update_env(updates):
+    """Rewrites KEY=value lines in .env (appending missing keys) and refreshes the cache."""
+    lines = []
+    if os.path.exists(DOTENV_PATH):
+        with open(DOTENV_PATH, "r") as f:
+            lines = f.readlines()
+    remaining = dict(updates)
+    updated = []
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("export "):
+            stripped = stripped[len("export "):]
+        key = stripped.split("=", 1)[0].strip() if "=" in stripped else None
+        if key in remaining:
+            updated.append(f"{key}={remaining.pop(key)}\n")
+        else:
+            updated.append(line)
+    for key, value in remaining.items():
+        updated.append(f"{key}={value}\n")
+    with open(DOTENV_PATH, "w") as f:
+        f.writelines(updated)
+    _dotenv.invalidate()
+
+
+# --- Internal token (web app <-> card_watcher.py) ---
+NOTIFY_TOKEN_PLACEHOLDER = "replace_with_your_generated_secure_random_notify_token"
+
+
+def internal_notify_token():
+    """INTERNAL_NOTIFY_TOKEN, or "" while it is unset or still the published placeholder."""
+    token = get_str("INTERNAL_NOTIFY_TOKEN", "").strip()
+    return "" if token == NOTIFY_TOKEN_PLACEHOLDER else token
+
+
+# --- email_config.json ---
+EMAIL_CONFIG_PATH = get_str("EMAIL_CONFIG", os.path.join(BASE_DIR, "email_config.json"))
+_email = _CachedFile(EMAIL_CONFIG_PATH, _load_json, None)
+
+
+def email_config():
+    """Returns a copy of email_config.json, or None if it is missing or invalid."""
+    value = _email.get()
+    return dict(value) if value is not None else None
+
+
+def save_email_config(settings):
+    with open(EMAIL_CONFIG_PATH, "w") as f:
+        json.dump(settings, f, indent=4)
+    _email.invalidate()
+
+
+# --- rclone ---
+def rclone_settings():
+    return {
+        "config_path": get_str("RCLONE_CONFIG", os.path.join(BASE_DIR, "rclone.conf")),
+        "remote_name": get_str("RCLONE_REMOTE_NAME", "gdrive"),
+        "base_path": get_str("RCLONE_BASE_PATH", "FX3_Backups"),
+    }
+
+
+# --- upload_schedule.json ---
+UPLOAD_SCHEDULE_PATH = get_str("UPLOAD_SCHEDULE", os.path.join(BASE_DIR, "upload_schedule.json"))
+_schedule = _CachedFile(UPLOAD_SCHEDULE_PATH, _load_json, None)
+
+
+def upload_schedule():
+    """Returns a copy of upload_schedule.json, or None if it is missing or invalid."""
+    value = _schedule.get()
+    return json.loads(json.dumps(value)) if value is not None else None
+
+
+def save_upload_schedule(schedule):
+    tmp = UPLOAD_SCHEDULE_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(schedule, f, indent=4)
+    os.replace(tmp, UPLOAD_SCHEDULE_PATH)
+    _schedule.invalidate()
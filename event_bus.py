@@ -0,0 +1,66 @@
+# event_bus.py
+# In-process publish/subscribe bus behind the /stream SSE endpoint.
+# Publishers append to one shared ring buffer; every SSE client keeps only the
+# sequence number it has seen and blocks on a condition variable until newer
+# events arrive, so fan-out costs no per-client queue or polling loop. Each
+# event is serialised once, at publish time, however many clients read it.
+
+import json
+import time
+import threading
+from collections import deque
+
+# --- Configuration ---
+BUFFER_SIZE = 500
+
+_events = deque(maxlen=BUFFER_SIZE)
+_cond = threading.Condition()
+_seq = 0
+
+
+def publish(channel, **data):
+    """Publishes data on a named channel (sent as the SSE 'event:' line) to all clients."""
+    global _seq
+    with _cond:
+        _seq += 1
+        payload = dict(data, ts=time.time())
+        _events.append((_seq, channel, payload, format_sse(_seq, channel, payload)))
+        _cond.notify_all()
+    return _seq
+
+
+def notify(message, msg_type="info"):
+    """Publishes an unnamed event, which base.html shows as a toast."""
+    return publish("message", message=message, type=msg_type)
+
+
+def latest_seq():
+    with _cond:
+        return _seq
+
+
+def wait(after_seq, timeout=None):
+    """Returns [(seq, channel, data)] newer than after_seq, waiting up to timeout for one.
+
+    If the client fell further behind than the buffer holds, it resumes from the
+    oldest event still buffered.
+    """
+    with _cond:
+        _cond.wait_for(lambda: _seq > after_seq, timeout)
+        return [event[:3] for event in _events if event[0] > after_seq]
+
+
+def wait_formatted(after_seq, timeout=None):
+    """Like wait(), but returns [(seq, SSE text)] already serialised."""
+    with _cond:
+        _cond.wait_for(lambda: _seq > after_seq, timeout)
+        return [(event[0], event[3]) for event in _events if event[0] > after_seq]
+
+
+def format_sse(seq, channel, data):
+    """Serialises one event in text/event-stream framing."""
+    lines = [f"id: {seq}"]
+    if channel != "message":
+        lines.append(f"event: {channel}")
+    lines.append("data: " + json.dumps(data))
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# eviction.py
+# Frees local disk by deleting footage/ copies that are safely on the remote.
+# Nothing is deleted on the index's word alone: each clip is looked up on the
+# remote first and must match by md5 (when that is the hash the offload
+# recorded) or by size and modification time. Clips are evicted oldest
+# recording first, only once free space drops below EVICT_MIN_FREE_GB, and
+# until EVICT_TARGET_FREE_GB is free again. A clip whose remote copy is
+# missing or different goes back to the upload queue instead. Photos that went
+# up in a bundle (bundler.py) are checked against their bundle's size and md5.
+# With WIPE_CARD_AFTER_UPLOAD=true the card's own copies can be removed too,
+# after a second, independent check: the card file is re-hashed against the
+# digest taken while it was copied.
+#   ./eviction.py                     evict if below the watermark
+#   ./eviction.py --needed <bytes>    make room for an offload of that size
+#   ./eviction.py wipe-card <SD_MOUNT>
+
+import os
+import re
+import sys
+import shutil
+import logging
+import datetime
+
+import bundler
+import checksums
+import config
+import offload_index
+import remote_cache
+import uploader
+
+# --- Configuration ---
+MIN_FREE_BYTES = config.get_int("EVICT_MIN_FREE_GB", 20) * 1024**3
+TARGET_FREE_BYTES = config.get_int("EVICT_TARGET_FREE_GB", 40) * 1024**3
+WIPE_CARD = config.get_bool("WIPE_CARD_AFTER_UPLOAD", False)
+MODTIME_TOLERANCE = 1.0  # seconds; Drive keeps millisecond modtimes
+
+logger = logging.getLogger("eviction")
+
+
+def _free_bytes(path):
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return 0
+
+
+def _parse_modtime(value):
+    """Parses rclone's RFC 3339 ModTime (nanosecond precision, Z or offset) to epoch seconds."""
+    if not value:
+        return None
+    value = re.sub(r"(\.\d{1,6})\d*", r"\1", value.replace("Z", "+00:00"))
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def verify_remote(row, conn=None):
+    """Checks a clip's remote copy against the index. Returns (matches, reason).
+
+    With conn, a photo uploaded inside a bundle is checked through its bundle.
+    Raises uploader.RemoteError if the remote cannot be asked.
+    """
+    member = bundler.lookup(conn, row["local_path"]) if conn is not None else None
+    if member is not None:
+        return _verify_bundled(row, member)
+    name = os.path.relpath(row["local_path"], row["category"])
+    record = uploader.remote_stat(row["category"], name)
+    if record is None:
+        return False, "not found on the remote"
+    if record.get("Size") != row["size"]:
+        return False, f"remote size {record.get('Size')} != {row['size']}"
+    remote_md5 = (record.get("Hashes") or {}).get("md5")
+    if row["algo"] == "md5" and row["digest"] and remote_md5:
+        if remote_md5 != row["digest"]:
+            return False, f"remote md5 {remote_md5} != {row['digest']}"
+        return True, "md5"
+    modtime = _parse_modtime(record.get("ModTime"))
+    if modtime is None or abs(modtime - row["mtime_ns"] / 1e9) > MODTIME_TOLERANCE:
+        return False, f"remote modtime {record.get('ModTime')} differs"
+    return True, "size+modtime"
+
+
+def _verify_bundled(row, member):
+    if row["digest"] and row["algo"] == member["algo"] and row["digest"] != member["digest"]:
+        return False, f"bundled copy hash {member['digest']} != {row['digest']}"
+    record = uploader.remote_stat(bundler.BUNDLE_DIR, member["bundle"])
+    if record is None:
+        return False, f"bundle {member['bundle']} not found on the remote"
+    if record.get("Size") != member["bundle_size"]:
+        return False, f"bundle size {record.get('Size')} != {member['bundle_size']}"
+    remote_md5 = (record.get("Hashes") or {}).get("md5")
+    if remote_md5 and member["bundle_md5"] and remote_md5 != member["bundle_md5"]:
+        return False, f"bundle md5 {remote_md5} != {member['bundle_md5']}"
+    return True, "bundle"
+
+
+def _requeue(conn, row, reason):
+    logger.warning(f"Not evicting {row['local_path']}: {reason}; queued for upload again.")
+    offload_index.mark_local(conn, [row["local_path"]], offload_index.STATE_COPIED)
+    remote_cache.forget(conn, [row["local_path"]])
+
+
+def _prune_dirs(path, stop):
+    parent = os.path.dirname(path)
+    while parent.startswith(stop + os.sep) and parent != stop:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
+
+
+def evict(local_base=offload_index.DEFAULT_LOCAL_BASE, needed=0, min_free=MIN_FREE_BYTES,
+          target_free=TARGET_FREE_BYTES):
+    """Deletes verified local copies until target_free (+ needed) is free.
+
+    Does nothing while free space minus needed stays above min_free.
+    Returns {"files_evicted", "bytes_freed", "requeued", "free_bytes"}.
+    """
+    summary = {"files_evicted": 0, "bytes_freed": 0, "requeued": 0, "free_bytes": _free_bytes(local_base)}
+    if summary["free_bytes"] - needed >= min_free:
+        return summary
+    goal = max(target_free, min_free) + needed
+    logger.info(f"Free space {summary['free_bytes'] / 1024**3:.1f} GB is below the "
+                f"{(min_free + needed) / 1024**3:.1f} GB watermark; evicting uploaded footage "
+                f"until {goal / 1024**3:.1f} GB is free.")
+    conn = offload_index.connect()
+    try:
+        rows = conn.execute("SELECT * FROM clips WHERE state = ? ORDER BY mtime_ns",
+                            (offload_index.STATE_UPLOADED,)).fetchall()
+        for row in rows:
+            if summary["free_bytes"] >= goal:
+                break
+            path = os.path.join(local_base, row["local_path"])
+            if not os.path.exists(path):
+                offload_index.mark_local(conn, [row["local_path"]], offload_index.STATE_DELETED)
+                continue
+            try:
+                matches, reason = verify_remote(row, conn)
+            except uploader.RemoteError as e:
+                logger.error(f"Stopping eviction, the remote cannot be checked: {e}")
+                break
+            if not matches:
+                _requeue(conn, row, reason)
+                summary["requeued"] += 1
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Could not evict {path}: {e}")
+                continue
+            _prune_dirs(path, os.path.abspath(local_base))
+            offload_index.mark_local(conn, [row["local_path"]], offload_index.STATE_DELETED)
+            summary["files_evicted"] += 1
+            summary["bytes_freed"] += row["size"]
+            summary["free_bytes"] = _free_bytes(local_base)
+            logger.info(f"Evicted {row['local_path']} ({row['size'] / 1024**2:.1f} MB, "
+                        f"remote matched by {reason}).")
+    finally:
+        conn.close()
+    log = logger.warning if summary["free_bytes"] < goal else logger.info
+    log(f"Eviction finished: {summary['files_evicted']} files, {summary['bytes_freed'] / 1024**3:.2f} GB freed, "
+        f"{summary['requeued']} re-queued; {summary['free_bytes'] / 1024**3:.1f} GB free.")
+    return summary
+
+
+def wipe_card(sd_mount):
+    """Deletes card files that are hash-verified against their copy and confirmed on the remote.
+
+    Returns {"files_wiped", "bytes_wiped", "skipped"}.
+    """
+    summary = {"files_wiped": 0, "bytes_wiped": 0, "skipped": 0}
+    conn = offload_index.connect()
+    try:
+        volume_id = offload_index.get_volume_id(sd_mount)
+        for row in offload_index.load_volume(conn, volume_id).values():
+            if row["state"] not in (offload_index.STATE_UPLOADED, offload_index.STATE_DELETED):
+                continue
+            path = os.path.join(sd_mount, row["path"])
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # already gone from the card
+            if not row["digest"] or st.st_size != row["size"] or st.st_mtime_ns != row["mtime_ns"]:
+                summary["skipped"] += 1
+                continue
+            # First check: the card still holds exactly the bytes that were copied.
+            try:
+                if checksums.hash_file(path, row["algo"]) != row["digest"]:
+                    logger.warning(f"Keeping {path} on the card: it no longer matches its offload hash.")
+                    summary["skipped"] += 1
+                    continue
+            except (OSError, ValueError) as e:
+                logger.warning(f"Keeping {path} on the card: cannot re-hash it ({e}).")
+                summary["skipped"] += 1
+                continue
+            # Second check: the remote copy is there and matches.
+            try:
+                matches, reason = verify_remote(row, conn)
+            except uploader.RemoteError as e:
+                logger.error(f"Stopping card wipe, the remote cannot be checked: {e}")
+                break
+            if not matches:
+                if row["state"] == offload_index.STATE_UPLOADED:
+                    _requeue(conn, row, reason)
+                else:
+                    # The card holds the only good copy; forget the clip so the next offload takes it again.
+                    logger.warning(f"Keeping {path} on the card: {reason}, and the local copy is evicted.")
+                    offload_index.forget(conn, volume_id, row["path"])
+                summary["skipped"] += 1
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Could not wipe {path}: {e}")
+                summary["skipped"] += 1
+                continue
+            summary["files_wiped"] += 1
+            summary["bytes_wiped"] += row["size"]
+    finally:
+        conn.close()
+    logger.info(f"Card wipe finished: {summary['files_wiped']} files "
+                f"({summary['bytes_wiped'] / 1024**3:.2f} GB) removed from {sd_mount}, {summary['skipped']} kept.")
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    args = sys.argv[1:]
+    if args[:1] == ["wipe-card"] and len(args) > 1:
+        wipe_card(args[1])
+    elif not args or (args[0] == "--needed" and len(args) > 1):
+        result = evict(needed=int(args[1]) if args else 0)
+        sys.exit(1 if result["free_bytes"] < MIN_FREE_BYTES else 0)
+    else:
+        print("Usage: ./eviction.py [--needed <bytes>] | wipe-card <SD_MOUNT>")
+        sys.exit(1)
@@ -53,7 +53,7 @@ echo "Step 5: Installing Python packages into the virtual environment..."
 # Activate venv, upgrade pip, install requirements, deactivate
 source "${PROJECT_DIR}/venv/bin/activate"
 pip install --upgrade pip
-pip install flask Flask-HTTPAuth python-dotenv gunicorn psutil
+pip install -r "${PROJECT_DIR}/requirements.txt"
 deactivate
 echo "Python packages installed successfully in venv."
 
@@ -120,6 +120,19 @@ sudo -u "${PROJECT_USER}" mkdir -p "${PROJECT_DIR}/config_backups"
 sudo -u "${PROJECT_USER}" mkdir -p "${PROJECT_DIR}/logs"
 echo "Directories ensured."
 
+echo "Step 8b: Generating the internal token shared by the web app and the card watcher..."
+# /internal/* endpoints are off until this is set; never ship the placeholder.
+ENV_FILE="${PROJECT_DIR}/.env"
+if ! grep -qsE '^(export )?INTERNAL_NOTIFY_TOKEN=.+' "${ENV_FILE}" || \
+   grep -qs 'replace_with_your_generated_secure_random_notify_token' "${ENV_FILE}"; then
+    [ -f "${ENV_FILE}" ] && sed -i -E '/^(export )?INTERNAL_NOTIFY_TOKEN=/d' "${ENV_FILE}"
+    echo "INTERNAL_NOTIFY_TOKEN=$(${PYTHON_EXECUTABLE} -c 'import secrets; print(secrets.token_hex(32))')" >> "${ENV_FILE}"
+    echo "Generated INTERNAL_NOTIFY_TOKEN in ${ENV_FILE}."
+else
+    echo "INTERNAL_NOTIFY_TOKEN already set in ${ENV_FILE}."
+fi
+chmod 600 "${ENV_FILE}"
+
 echo "Step 9: Setting ownership and permissions..."
 # Set ownership of the entire project directory to the specified user
 # Do this AFTER creating dirs and installing venv
@@ -147,7 +160,10 @@ User=${PROJECT_USER}
 # Group=www-data
 WorkingDirectory=${PROJECT_DIR}
 # ExecStart must use the Gunicorn from the virtual environment
-ExecStart=${GUNICORN_EXECUTABLE} --workers 3 --bind 127.0.0.1:5000 app:app
+# One process with threads: jobs, the sampler and the event bus live in that process,
+# and an open /stream page costs a thread instead of a whole worker. Log follow
+# streams take threads too; LOG_FOLLOW_MAX_STREAMS (default 4) caps them.
+ExecStart=${GUNICORN_EXECUTABLE} --worker-class gthread --workers 1 --threads 16 --bind 127.0.0.1:5000 app:app
 Restart=always
 RestartSec=3
 # Log Gunicorn output to the project's log directory (ensure it's writable by User)
@@ -179,6 +195,31 @@ if ! systemctl is-active --quiet pi-gunicorn; then
 fi
 echo "Gunicorn service started successfully."
 
+echo "Step 11b: Setting up the card watcher service (card-watcher.service)..."
+# Runs as root: it mounts cards, tunes their read-ahead and unmounts them.
+# safe_eject.sh itself runs as ${PROJECT_USER} (runuser), so its logs stay theirs.
+cat > /etc/systemd/system/card-watcher.service <<EOF
+[Unit]
+Description=SDTransfer Offloader card detection
+After=pi-gunicorn.service
+Wants=pi-gunicorn.service
+
+[Service]
+WorkingDirectory=${PROJECT_DIR}
+ExecStart=${PROJECT_DIR}/venv/bin/python3 ${PROJECT_DIR}/card_watcher.py
+Restart=always
+RestartSec=3
+StandardOutput=append:${PROJECT_DIR}/logs/card_watcher.log
+StandardError=append:${PROJECT_DIR}/logs/card_watcher.log
+
+[Install]
+WantedBy=multi-user.target
+EOF
+systemctl daemon-reload
+systemctl enable card-watcher
+systemctl restart card-watcher
+echo "Card watcher service started."
+
 echo "Step 12: Configuring Nginx as a reverse proxy..."
 # Create Nginx config file for the site
 cat > /etc/nginx/sites-available/sdtransfer <<EOF
@@ -233,9 +274,10 @@ echo "Step 16: Setting up cron jobs for user '${PROJECT_USER}'..."
 ( \
     crontab -u "${PROJECT_USER}" -l 2>/dev/null | \
     grep -vF "${PROJECT_DIR}/offload.sh" | \
-    grep -vF "${PROJECT_DIR}/upload_and_cleanup.sh" ; \
-    echo "@reboot sleep 60 && bash ${PROJECT_DIR}/offload.sh >> ${PROJECT_DIR}/logs/cron_offload.log 2>&1" ; \
-    echo "0 2 * * * bash ${PROJECT_DIR}/upload_and_cleanup.sh >> ${PROJECT_DIR}/logs/cron_upload.log 2>&1" \
+    grep -vF "${PROJECT_DIR}/upload_and_cleanup.sh" | \
+    grep -vF "${PROJECT_DIR}/retry_offload.sh" ; \
+    echo "0 2 * * * bash ${PROJECT_DIR}/upload_and_cleanup.sh >> ${PROJECT_DIR}/logs/cron_upload.log 2>&1" ; \
+    echo "*/15 * * * * bash ${PROJECT_DIR}/retry_offload.sh >> ${PROJECT_DIR}/logs/cron_retry.log 2>&1" \
 ) | crontab -u "${PROJECT_USER}" -
 
 echo "Cron jobs updated for user '${PROJECT_USER}'."
@@ -265,6 +307,7 @@ echo "7. Configure Email Notifications via the '/notifications' page (optional).
 echo ""
 echo "Troubleshooting:"
 echo "- Gunicorn service: 'systemctl status pi-gunicorn.service'"
+echo "- Card watcher service: 'systemctl status card-watcher.service' (log: ${PROJECT_DIR}/logs/card_watcher.log)"
 echo "- Gunicorn logs: '${PROJECT_DIR}/logs/gunicorn.error.log', '${PROJECT_DIR}/logs/gunicorn.log'"
 echo "- Nginx service: 'systemctl status nginx.service'"
 echo "- Nginx logs: '/var/log/nginx/error.log', '/var/log/nginx/access.log'"
@@ -0,0 +1,358 @@
+# job_manager.py
+# In-process job queue for offload, upload, retry and eject actions.
+# Jobs that share a device (the SD card or the uplink) run one at a time; a
+# per-device flock in logs/ also serialises against cron and shell runs of
+# upload_and_cleanup.sh, which takes the same locks. Concurrent offloads from
+# several cards share the uplink batch by batch through UplinkArbiter.
+
+import os
+import time
+import fcntl
+import signal
+import logging
+import threading
+import itertools
+
+import event_bus
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCK_DIR = os.path.join(BASE_DIR, "logs")
+UPLINK_DEVICE = "uplink"
+MAX_FINISHED_JOBS = 50
+RETRY_LOCK_SECONDS = 5
+PROGRESS_EVENT_INTERVAL = 1.0
+CANCEL_POLL_SECONDS = 1.0
+
+QUEUED, RUNNING, PAUSED, DONE, FAILED, CANCELLED = "queued", "running", "paused", "done", "failed", "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+logger = logging.getLogger("job_manager")
+
+
+def device_for_mount(mount_path):
+    """Device key for a card; matches $(basename "${SD_MOUNT}") in the shell scripts."""
+    return os.path.basename(os.path.normpath(mount_path)) or "sdcard"
+
+
+def lock_path(device):
+    return os.path.join(LOCK_DIR, f".lock-{device}")
+
+
+class Job:
+    """One queued action. The target receives the job and reports progress through it."""
+
+    def __init__(self, job_id, kind, devices, target):
+        self.id = job_id
+        self.kind = kind
+        self.devices = list(devices)
+        self.target = target
+        self.state = QUEUED
+        self.error = None
+        self.result = None
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.files_total = 0
+        self.phase = None
+        self._phase_started = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._paused_seconds = 0.0
+        self._paused_at = None
+        self._lock = threading.Lock()
+        self._resume = threading.Event()
+        self._resume.set()
+        self._cancel = threading.Event()
+        self._process = None
+        self._last_event_at = time.monotonic()
+        self._last_event_bytes = 0
+
+    # --- Progress reporting (called from the job's own threads) ---
+    def set_phase(self, phase):
+        """Starts a new phase (e.g. copy, upload); progress counters restart from zero."""
+        with self._lock:
+            self.phase = phase
+            self._phase_started = time.time()
+            self._last_event_at = time.monotonic()
+            self.bytes_done = self.bytes_total = 0
+            self.files_done = self.files_total = 0
+            self._last_event_bytes = 0
+            # eta_seconds() measures the phase, so only pauses within it count.
+            self._paused_seconds = 0.0
+            if self._paused_at is not None:
+                self._paused_at = time.monotonic()
+        event_bus.publish("transfer", event="phase", job_id=self.id, kind=self.kind, phase=phase)
+
+    def begin(self, bytes_total, files_total):
+        with self._lock:
+            self.bytes_total += bytes_total
+            self.files_total += files_total
+
+    def checkpoint(self, nbytes=0):
+        """Records copied bytes, blocks while paused. Returns False once cancelled."""
+        if nbytes:
+            with self._lock:
+                self.bytes_done += nbytes
+                now = time.monotonic()
+                elapsed = now - self._last_event_at
+                publish = elapsed >= PROGRESS_EVENT_INTERVAL
+                if publish:
+                    rate = (self.bytes_done - self._last_event_bytes) / elapsed
+                    self._last_event_at, self._last_event_bytes = now, self.bytes_done
+            if publish:
+                event_bus.publish("transfer", event="progress", job_id=self.id, phase=self.phase,
+                                  bytes_done=self.bytes_done, bytes_total=self.bytes_total,
+                                  files_done=self.files_done, files_total=self.files_total,
+                                  bytes_per_sec=int(rate), eta_seconds=self.eta_seconds())
+        while not self._resume.wait(1.0):
+            if self._cancel.is_set():
+                break
+        return not self._cancel.is_set()
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+
+    def attach_process(self, process):
+        """Registers a child (started with start_new_session=True) for pause/cancel signals."""
+        self._process = process
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    # --- Control (called from request handlers) ---
+    def cancel(self):
+        self._cancel.set()
+        self._resume.set()
+        self._signal(signal.SIGCONT)
+        self._signal(signal.SIGTERM)
+
+    def pause(self):
+        if self.state == RUNNING:
+            self._resume.clear()
+            self._paused_at = time.monotonic()
+            self.state = PAUSED
+            self._signal(signal.SIGSTOP)
+
+    def resume(self):
+        if self.state == PAUSED:
+            self._paused_seconds += time.monotonic() - self._paused_at
+            self._paused_at = None
+            self.state = RUNNING
+            self._signal(signal.SIGCONT)
+            self._resume.set()
+
+    def _signal(self, sig):
+        process = self._process
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def eta_seconds(self):
+        if self.state not in (RUNNING, PAUSED) or not self.bytes_done or not self.bytes_total:
+            return None
+        elapsed = time.time() - (self._phase_started or self.started_at) - self._paused_seconds
+        if self._paused_at is not None:
+            elapsed -= time.monotonic() - self._paused_at
+        rate = self.bytes_done / elapsed if elapsed > 0 else 0
+        return int((self.bytes_total - self.bytes_done) / rate) if rate > 0 else None
+
+    def to_dict(self):
+        return {
+            "id": self.id, "kind": self.kind, "devices": self.devices, "state": self.state, "phase": self.phase,
+            "error": self.error, "bytes_done": self.bytes_done, "bytes_total": self.bytes_total,
+            "files_done": self.files_done, "files_total": self.files_total,
+            "eta_seconds": self.eta_seconds(), "created_at": self.created_at,
+            "started_at": self.started_at, "finished_at": self.finished_at,
+        }
+
+
+class UplinkArbiter:
+    """Shares the uplink between concurrent offloads, one upload batch at a time.
+
+    Turns are granted in request order, so a card that just finished a batch
+    queues behind every card already waiting. Each turn also holds the uplink
+    flock, which keeps upload/retry jobs and shell runs out while it lasts.
+    """
+
+    def __init__(self, device=UPLINK_DEVICE, use_flock=True):
+        self.device = device
+        self.use_flock = use_flock
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()  # tickets of waiters that were cancelled; skipped when their turn comes
+
+    def acquire(self, cancelled=None):
+        """Waits for a turn. Returns a token for release(), or None if cancelled() turned true first."""
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                if cancelled is not None and cancelled():
+                    self._abandoned.add(ticket)
+                    return None
+                self._cond.wait(CANCEL_POLL_SECONDS)
+        if not self.use_flock:
+            return ticket
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        f = open(lock_path(self.device), "w")
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except OSError:
+                if cancelled is not None and cancelled():
+                    f.close()
+                    self._advance()
+                    return None
+                time.sleep(1.0)
+
+    def release(self, token):
+        if self.use_flock:
+            fcntl.flock(token, fcntl.LOCK_UN)
+            token.close()
+        self._advance()
+
+    def _advance(self):
+        with self._cond:
+            self._serving += 1
+            while self._serving in self._abandoned:
+                self._abandoned.discard(self._serving)
+                self._serving += 1
+            self._cond.notify_all()
+
+
+class JobManager:
+    """FIFO per device: a job starts once every device it needs is free.
+
+    on_finished(job), if set, is called on the job's thread after it ends.
+    """
+
+    def __init__(self, on_finished=None):
+        self.on_finished = on_finished
+        self._jobs = {}
+        self._queue = []
+        self._busy = {}
+        self._locks = {}
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="job-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, kind, devices, target):
+        """Queues target(job) and returns the Job. Duplicates of a queued/running kind are refused."""
+        with self._cond:
+            for job in self._jobs.values():
+                if job.kind == kind and job.devices == list(devices) and job.state not in FINISHED_STATES:
+                    raise ValueError(f"A '{kind}' job is already {job.state} (job {job.id}).")
+            job = Job(next(self._ids), kind, devices, target)
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            self._prune()
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        with self._cond:
+            return [job.to_dict() for job in sorted(self._jobs.values(), key=lambda j: j.id, reverse=True)]
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        with self._cond:
+            if job.state == QUEUED:
+                self._queue.remove(job)
+                job.state = CANCELLED
+                job.finished_at = time.time()
+                return job
+        job.cancel()
+        return job
+
+    # --- Internals ---
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.state in FINISHED_STATES]
+        for job in sorted(finished, key=lambda j: j.id)[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
+
+    def _try_lock(self, device):
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        f = open(lock_path(device), "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._locks[device] = f
+        return True
+
+    def _release(self, device):
+        f = self._locks.pop(device, None)
+        if f is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+        self._busy.pop(device, None)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                blocked = set()
+                for job in list(self._queue):
+                    # Keep FIFO order: a waiting job also blocks later jobs on its devices.
+                    if any(d in self._busy or d in blocked for d in job.devices):
+                        blocked.update(job.devices)
+                        continue
+                    acquired = []
+                    for device in job.devices:
+                        if not self._try_lock(device):
+                            break
+                        acquired.append(device)
+                    if len(acquired) != len(job.devices):
+                        for device in acquired:
+                            self._release(device)
+                        blocked.update(job.devices)
+                        continue
+                    for device in job.devices:
+                        self._busy[device] = job.id
+                    self._queue.remove(job)
+                    job.state = RUNNING
+                    job.started_at = time.time()
+                    threading.Thread(target=self._run, args=(job,), name=f"job-{job.id}", daemon=True).start()
+                # Another process may hold a device; poll for it instead of waiting forever.
+                self._cond.wait(RETRY_LOCK_SECONDS if self._queue else None)
+
+    def _run(self, job):
+        logger.info(f"Job {job.id} ({job.kind}) started on {', '.join(job.devices)}.")
+        event_bus.publish("job", **job.to_dict())
+        try:
+            job.result = job.target(job)
+            job.state = CANCELLED if job.cancelled else DONE
+        except Exception as e:
+            job.error = str(e)
+            job.state = CANCELLED if job.cancelled else FAILED
+            logger.error(f"Job {job.id} ({job.kind}) failed: {e}", exc_info=True)
+        job.finished_at = time.time()
+        logger.info(f"Job {job.id} ({job.kind}) finished: {job.state}.")
+        event_bus.publish("job", **job.to_dict())
+        if job.state == FAILED:
+            event_bus.notify(f"Job {job.id} ({job.kind}) failed: {job.error}", "error")
+        else:
+            event_bus.notify(f"Job {job.id} ({job.kind}) {job.state}.", "success" if job.state == DONE else "info")
+        if self.on_finished is not None:
+            try:
+                self.on_finished(job)
+            except Exception as e:
+                logger.error(f"Job {job.id} finish hook failed: {e}", exc_info=True)
+        with self._cond:
+            for device in job.devices:
+                self._release(device)
+            self._cond.notify_all()
@@ -0,0 +1,28 @@
+#!/bin/bash
+# log_common.sh
+# Logging shared by the shell scripts. Set LOG_FILE and LOG_SOURCE, then
+# source this file; with LOG_ECHO=1 log_msg also echoes each line (errors to
+# stderr). One buffered structured_log.py writer (fd 7) per run instead of
+# reopening the log for every line; it also rotates and compresses the log.
+#   source "${SCRIPT_DIR}/log_common.sh"
+
+LOG_COMMON_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
+if [ -z "${PYTHON_BIN}" ]; then
+  PYTHON_BIN="${LOG_COMMON_DIR}/venv/bin/python3"
+  [ -x "${PYTHON_BIN}" ] || PYTHON_BIN="python3"
+fi
+mkdir -p "$(dirname "${LOG_FILE}")"
+
+exec 7> >("${PYTHON_BIN}" "${LOG_COMMON_DIR}/structured_log.py" pipe "${LOG_FILE}" --source "${LOG_SOURCE}")
+
+log_msg() {
+  local line="[$(date '+%Y-%m-%d %H:%M:%S')] [$1] $2"
+  echo "${line}" >&7
+  if [ "${LOG_ECHO:-0}" = "1" ]; then
+    if [ "$1" = "ERROR" ]; then
+      echo "${line}" >&2
+    else
+      echo "${line}"
+    fi
+  fi
+}
@@ -0,0 +1,187 @@
+# log_tail.py
+# In-process log tailing for the /logs page.
+# tail() seeks backwards from the end of a file in blocks instead of forking
+# `tail`, and remembers where it stopped per file so a repeat view only reads
+# the bytes appended since. read_since() serves the incremental endpoint and
+# SSE follow mode. Followers do not poll: one thread stats the followed logs
+# once per FOLLOW_POLL_SECONDS and wakes them through a condition, as
+# event_bus.py does for /stream. Each open follow stream still holds one of
+# gunicorn's threads, so at most LOG_FOLLOW_MAX_STREAMS are served at once;
+# further ones get 503 and the /logs page polls instead.
+
+import os
+import time
+import threading
+
+import config
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(BASE_DIR, "logs")
+BLOCK_SIZE = 8192
+MAX_CHUNK_BYTES = 256 * 1024  # cap for one incremental read; older bytes are skipped
+FOLLOW_POLL_SECONDS = 1.0
+MAX_FOLLOWERS = config.get_int("LOG_FOLLOW_MAX_STREAMS", 4)  # of the web app's 16 threads
+
+# name -> (file in logs/, title, icon, lines shown on page load)
+LOG_FILES = {
+    "upload": ("upload.log", "Upload Log", "fa-upload", 200),
+    "offload": ("offload.log", "Offload Log (Wrapper Script)", "fa-download", 200),
+    "retry": ("retry.log", "Retry Log", "fa-redo", 100),
+    "eject": ("eject.log", "Eject Log", "fa-eject", 50),
+    "notification": ("notification.log", "Notification Log", "fa-envelope", 100),
+    "card": ("card_watcher.log", "Card Watcher Log", "fa-sd-card", 50),
+}
+
+_cache = {}  # path -> (inode, end offset, lines kept, raw tail bytes)
+_cache_lock = threading.Lock()
+
+_follow_cond = threading.Condition()
+_followers = {}  # path -> open follow streams
+_changes = {}  # path -> ((inode, size) last seen, change count)
+_follow_thread = None
+
+
+class TooManyFollowers(Exception):
+    pass
+
+
+def log_path(name):
+    """Returns the path of a registered log, or None for unknown names."""
+    entry = LOG_FILES.get(name)
+    return os.path.join(LOG_DIR, entry[0]) if entry else None
+
+
+def _last_lines(data, lines):
+    """Returns the trailing lines of data, byte for byte (a final partial line counts)."""
+    pos = len(data) - 1 if data.endswith(b"\n") else len(data)
+    for _ in range(lines):
+        pos = data.rfind(b"\n", 0, pos)
+        if pos < 0:
+            return data
+    return data[pos + 1:]
+
+
+def _read_tail(f, size, lines):
+    """Reads blocks backwards from size until lines newlines have been seen."""
+    pos = size
+    chunks = []
+    newlines = 0
+    while pos > 0 and newlines <= lines:
+        step = min(BLOCK_SIZE, pos)
+        pos -= step
+        f.seek(pos)
+        chunk = f.read(step)
+        chunks.append(chunk)
+        newlines += chunk.count(b"\n")
+    return _last_lines(b"".join(reversed(chunks)), lines)
+
+
+def tail(path, lines=100):
+    """Returns (last lines of path as text, end offset). Raises OSError if unreadable."""
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        with _cache_lock:
+            cached = _cache.get(path)
+        if (cached and cached[0] == st.st_ino and cached[2] == lines
+                and cached[1] <= size <= cached[1] + MAX_CHUNK_BYTES):
+            if cached[1] == size:
+                return cached[3].decode("utf-8", errors="replace"), size
+            # Same file, grown: only read what was appended since the last view.
+            f.seek(cached[1])
+            data = _last_lines(cached[3] + f.read(size - cached[1]), lines)
+        else:
+            data = _read_tail(f, size, lines)
+    with _cache_lock:
+        _cache[path] = (st.st_ino, size, lines, data)
+    return data.decode("utf-8", errors="replace"), size
+
+
+def read_since(path, offset):
+    """Returns (text appended after offset, new offset, reset).
+
+    reset is True when the file shrank (truncated or rotated) and the text
+    starts from the beginning of the new file. At most MAX_CHUNK_BYTES are
+    returned; a reader that fell further behind resumes at a line boundary.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        reset = offset > size
+        if reset:
+            offset = 0
+        skipped = size - offset > MAX_CHUNK_BYTES
+        if skipped:
+            offset = size - MAX_CHUNK_BYTES
+        f.seek(offset)
+        data = f.read(size - offset)
+    if skipped:
+        cut = data.find(b"\n") + 1
+        data = data[cut:]
+        offset += cut
+    # Hold back a partially written last line until its newline arrives.
+    end = data.rfind(b"\n") + 1
+    return data[:end].decode("utf-8", errors="replace"), offset + end, reset
+
+
+# --- Follow mode ---
+def _change_count(path):
+    return _changes.get(path, (None, 0))[1]
+
+
+def _watch():
+    while True:
+        with _follow_cond:
+            _follow_cond.wait_for(lambda: _followers)
+            paths = list(_followers)
+        changed = False
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp = (st.st_ino, st.st_size)
+            except OSError:
+                stamp = None  # not created yet, or mid-rotation
+            with _follow_cond:
+                seen = _changes.get(path)
+                if seen is None:
+                    _changes[path] = (stamp, 0)  # first look; followers read the file as they start
+                elif seen[0] != stamp:
+                    _changes[path] = (stamp, seen[1] + 1)
+                    changed = True
+        if changed:
+            with _follow_cond:
+                _follow_cond.notify_all()
+        time.sleep(FOLLOW_POLL_SECONDS)
+
+
+def start_follow(path):
+    """Registers a follow stream for path and returns its change count.
+
+    Raises TooManyFollowers once MAX_FOLLOWERS streams are open.
+    """
+    global _follow_thread
+    with _follow_cond:
+        if sum(_followers.values()) >= MAX_FOLLOWERS:
+            raise TooManyFollowers(f"{MAX_FOLLOWERS} logs are already being followed.")
+        _followers[path] = _followers.get(path, 0) + 1
+        if _follow_thread is None:
+            _follow_thread = threading.Thread(target=_watch, name="log-follow", daemon=True)
+            _follow_thread.start()
+        _follow_cond.notify_all()
+        return _change_count(path)
+
+
+def stop_follow(path):
+    with _follow_cond:
+        left = _followers.get(path, 0) - 1
+        if left > 0:
+            _followers[path] = left
+        else:
+            _followers.pop(path, None)
+
+
+def wait_change(path, count, timeout=None):
+    """Blocks until path changed after change count (or timeout); returns the current count."""
+    with _follow_cond:
+        _follow_cond.wait_for(lambda: _change_count(path) != count, timeout)
+        return _change_count(path)
@@ -0,0 +1,331 @@
+# metrics.py
+# Counters, gauges and histograms for the /metrics endpoint (Prometheus text format).
+# Updating a metric is a dict update under one lock, cheap enough for per-chunk
+# hot paths. Each process (every gunicorn worker, and scripts like uploader.py
+# run from cron) writes its values to logs/metrics/<pid>-<token>.json at most
+# every METRICS_FLUSH_SECONDS and at exit; /metrics merges all of them, so a
+# scrape sees the whole Pi whichever worker answers. Counters and histograms
+# of processes that have exited are folded into one file so their totals keep
+# counting; their gauges are dropped. Values computed at scrape time (the
+# system sampler) come from collectors registered in the serving process.
+
+import os
+import json
+import time
+import fcntl
+import atexit
+import bisect
+import logging
+import threading
+
+import config
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+METRICS_DIR = config.get_str("METRICS_DIR", os.path.join(BASE_DIR, "logs", "metrics"))
+FLUSH_SECONDS = config.get_float("METRICS_FLUSH_SECONDS", 5.0)
+PREFIX = "sdtransfer_"
+DEAD_FILE = "_exited.json"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TRANSFER_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+logger = logging.getLogger("metrics")
+
+_lock = threading.Lock()
+_families = {}
+_collectors = []
+_dirty = False
+_token = os.urandom(4).hex()
+_flusher = None
+
+
+class _Family:
+    def __init__(self, kind, name, help_text, labels, buckets=None):
+        self.kind = kind
+        self.name = PREFIX + name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) if buckets else None
+        self.values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def to_dict(self):
+        return {"kind": self.kind, "help": self.help, "labels": list(self.labels),
+                "buckets": list(self.buckets) if self.buckets else None,
+                "values": [[list(key), value] for key, value in self.values.items()]}
+
+
+class Counter(_Family):
+    def inc(self, amount=1, **labels):
+        global _dirty
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            _dirty = True
+        _ensure_flusher()
+
+
+class Gauge(_Family):
+    def set(self, value, **labels):
+        global _dirty
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = value
+            _dirty = True
+        _ensure_flusher()
+
+    def inc(self, amount=1, **labels):
+        global _dirty
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            _dirty = True
+        _ensure_flusher()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Family):
+    def observe(self, value, **labels):
+        global _dirty
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            entry["counts"][index] += 1
+            entry["sum"] += value
+            _dirty = True
+        _ensure_flusher()
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.monotonic() - self._start, **self._labels)
+        return False
+
+
+def _register(cls, kind, name, help_text, labels=(), buckets=None):
+    with _lock:
+        family = _families.get(PREFIX + name)
+        if family is None:
+            family = _families[PREFIX + name] = cls(kind, name, help_text, labels, buckets)
+        return family
+
+
+def counter(name, help_text, labels=()):
+    return _register(Counter, "counter", name, help_text, labels)
+
+
+def gauge(name, help_text, labels=()):
+    """Gauges from several processes are summed, e.g. queue depth across workers."""
+    return _register(Gauge, "gauge", name, help_text, labels)
+
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, "histogram", name, help_text, labels, sorted(buckets))
+
+
+def register_collector(collect):
+    """collect() returns [(name, kind, help, {labels}, value)], read at scrape time and never stored."""
+    _collectors.append(collect)
+
+
+# --- Snapshots ---
+def _snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, f"{pid or os.getpid()}-{_token}.json")
+
+
+def flush(force=False):
+    """Writes this process's values to its snapshot file if they changed."""
+    global _dirty
+    with _lock:
+        if not _dirty and not force:
+            return
+        data = {"pid": os.getpid(), "families": {name: f.to_dict() for name, f in _families.items() if f.values}}
+        _dirty = False
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _snapshot_path()
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"Could not write metrics snapshot: {e}")
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        flush()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None:
+        with _lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+                _flusher.start()
+
+
+def _after_fork():
+    # A forked child (a gunicorn worker of a preloaded app) starts from zero
+    # under its own file; the parent's values stay in the parent's.
+    global _token, _flusher, _dirty, _lock
+    _lock = threading.Lock()
+    _token = os.urandom(4).hex()
+    _flusher = None
+    _dirty = False
+    for family in _families.values():
+        family.values = {}
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(flush)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(target, families, include_gauges=True):
+    for name, family in families.items():
+        if family["kind"] == "gauge" and not include_gauges:
+            continue
+        merged = target.setdefault(name, dict(family, values={}))
+        for key, value in family["values"]:
+            key = tuple(key)
+            if family["kind"] == "histogram":
+                entry = merged["values"].setdefault(key, {"counts": [0] * len(value["counts"]), "sum": 0.0})
+                if len(entry["counts"]) == len(value["counts"]):
+                    entry["counts"] = [a + b for a, b in zip(entry["counts"], value["counts"])]
+                    entry["sum"] += value["sum"]
+            else:
+                merged["values"][key] = merged["values"].get(key, 0) + value
+
+
+def _fold_exited(names):
+    """Moves counters and histograms of exited processes into DEAD_FILE, then deletes their files."""
+    dead_path = os.path.join(METRICS_DIR, DEAD_FILE)
+    exited = {}
+    _merge(exited, (_read(dead_path) or {}).get("families", {}))
+    for name in names:
+        data = _read(os.path.join(METRICS_DIR, name))
+        if data is not None:
+            _merge(exited, data.get("families", {}), include_gauges=False)
+    serialisable = {name: dict(f, values=[[list(k), v] for k, v in f["values"].items()])
+                    for name, f in exited.items()}
+    tmp = f"{dead_path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"families": serialisable}, f)
+    os.replace(tmp, dead_path)
+    for name in names:
+        try:
+            os.remove(os.path.join(METRICS_DIR, name))
+        except OSError:
+            pass
+
+
+def collect_all():
+    """Returns every process's metrics merged: {name: {"kind", "help", "labels", "buckets", "values"}}."""
+    flush(force=True)
+    merged = {}
+    try:
+        # One scrape at a time, so a fold in progress is never counted twice.
+        with open(os.path.join(METRICS_DIR, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            names = [n for n in os.listdir(METRICS_DIR) if n.endswith(".json") and n != DEAD_FILE]
+            exited = [n for n in names if n.split("-", 1)[0].isdigit() and not _alive(int(n.split("-", 1)[0]))]
+            if exited:
+                _fold_exited(exited)
+            for name in [n for n in names if n not in exited] + [DEAD_FILE]:
+                data = _read(os.path.join(METRICS_DIR, name))
+                if data is not None:
+                    _merge(merged, data.get("families", {}))
+    except OSError as e:
+        logger.warning(f"Could not read metrics snapshots: {e}")
+    return merged
+
+
+# --- Exposition ---
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Returns the Prometheus text exposition of all processes plus the registered collectors."""
+    lines = []
+    for name, family in sorted(collect_all().items()):
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        for key, value in sorted(family["values"].items()):
+            if family["kind"] != "histogram":
+                lines.append(f"{name}{_labels(family['labels'], key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family["buckets"]) + [float("inf")], value["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(family['labels'], key, ('le', _number(bound)))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(family['labels'], key)} {_number(value['sum'])}")
+            lines.append(f"{name}_count{_labels(family['labels'], key)} {cumulative}")
+    seen = set()
+    for collect in _collectors:
+        try:
+            samples = list(collect())
+        except Exception as e:
+            logger.error(f"Metrics collector failed: {e}")
+            continue
+        for name, kind, help_text, labels, value in samples:
+            name = PREFIX + name
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+    return "\n".join(lines) + "\n"
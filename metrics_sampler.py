@@ -0,0 +1,131 @@
+# metrics_sampler.py
+# Background sampler for the dashboard's system metrics.
+# One daemon thread takes a sample every STATUS_SAMPLE_INTERVAL seconds into a
+# ring buffer, so request handlers return the latest snapshot without ever
+# blocking on psutil.cpu_percent() or touching the disk.
+
+import os
+import time
+import shutil
+import logging
+import threading
+from collections import deque
+
+import psutil
+
+import config
+
+# --- Configuration ---
+SAMPLE_INTERVAL = config.get_float("STATUS_SAMPLE_INTERVAL", 5.0)
+HISTORY_SIZE = config.get_int("STATUS_HISTORY_SIZE", 360)  # 30 minutes at 5 s
+
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+
+logger = logging.getLogger("metrics_sampler")
+
+
+def cpu_temperature():
+    """SoC temperature in degrees C, or None where there is no thermal zone."""
+    try:
+        with open(THERMAL_ZONE, "r") as f:
+            return int(f.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+
+class MetricsSampler:
+    """Samples system metrics on a daemon thread.
+
+    probes are extra callables whose returned dicts are merged into every sample.
+    on_sample, if given, is called with each new sample (the web app broadcasts it over SSE).
+    """
+
+    def __init__(self, disk_path, sd_mount_path="", interval=SAMPLE_INTERVAL, history_size=HISTORY_SIZE,
+                 probes=(), on_sample=None):
+        self.disk_path = disk_path
+        self.sd_mount_path = sd_mount_path
+        self.probes = list(probes)
+        self.on_sample = on_sample
+        self.interval = interval
+        self._history = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_net = None
+
+    def start(self):
+        if self._thread is None:
+            psutil.cpu_percent(interval=None)  # prime; the first call always returns 0.0
+            self._sample()
+            self._thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    def latest(self):
+        """Returns the most recent sample (a dict), or {} before the first one."""
+        with self._lock:
+            return dict(self._history[-1]) if self._history else {}
+
+    def history(self, count):
+        """Returns up to count most recent samples, oldest first."""
+        with self._lock:
+            samples = list(self._history)
+        return samples[-count:] if count > 0 else []
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._sample()
+            except Exception as e:
+                logger.error(f"Metrics sample failed: {e}", exc_info=True)
+
+    def _sample(self):
+        now = time.time()
+        sample = {"ts": now}
+        try:
+            usage = shutil.disk_usage(self.disk_path)
+            sample['free_space_mb'] = usage.free // (1024**2)
+            sample['disk_percent'] = int(usage.used / usage.total * 100) if usage.total > 0 else "N/A"
+        except Exception as e:
+            logger.error(f"Error reading disk usage: {e}")
+            sample['free_space_mb'] = 'N/A'
+            sample['disk_percent'] = 'N/A'
+        try:
+            # Non-blocking: CPU use since the previous sample.
+            sample['cpu_usage'] = psutil.cpu_percent(interval=None)
+        except Exception as e:
+            logger.error(f"Error reading CPU usage: {e}")
+            sample['cpu_usage'] = 'N/A'
+        temp = cpu_temperature()
+        sample['cpu_temp'] = round(temp, 1) if temp is not None else 'N/A'
+        try:
+            sample['mem_usage'] = psutil.virtual_memory().percent
+        except Exception as e:
+            logger.error(f"Error reading memory usage: {e}")
+            sample['mem_usage'] = 'N/A'
+        try:
+            net = psutil.net_io_counters()
+            if self._last_net is not None:
+                last_ts, last = self._last_net
+                elapsed = max(now - last_ts, 1e-6)
+                sample['net_sent_bps'] = int((net.bytes_sent - last.bytes_sent) / elapsed)
+                sample['net_recv_bps'] = int((net.bytes_recv - last.bytes_recv) / elapsed)
+            else:
+                sample['net_sent_bps'] = sample['net_recv_bps'] = 0
+            self._last_net = (now, net)
+        except Exception as e:
+            logger.error(f"Error reading network counters: {e}")
+            sample['net_sent_bps'] = sample['net_recv_bps'] = 'N/A'
+        try:
+            sample['sd_card_mounted'] = os.path.ismount(self.sd_mount_path) if self.sd_mount_path else False
+            sample['sd_card_path_exists'] = os.path.exists(self.sd_mount_path) if self.sd_mount_path else False
+        except Exception as e:
+            logger.error(f"Error checking SD mount status: {e}")
+            sample['sd_card_mounted'] = False
+            sample['sd_card_path_exists'] = False
+        for probe in self.probes:
+            sample.update(probe())
+        with self._lock:
+            self._history.append(sample)
+        if self.on_sample is not None:
+            self.on_sample(dict(sample))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# network_monitor.py
+# Wi-Fi link health for the uploads and the /wifi page.
+# A daemon thread in the web app samples the link every NETWORK_SAMPLE_SECONDS:
+# signal strength (RSSI) from /proc/net/wireless and the link rate from
+# `iw dev <iface> link`, both cheap reads that need no root, plus the speed and
+# active transfers the running rclone reports. Network scans (`sudo iwlist scan`, up to 20 s) go
+# through a CachedTask: /wifi renders the last list at once, and the monitor
+# refreshes it every WIFI_SCAN_SECONDS while no upload runs (a scan takes the
+# radio off channel for seconds at a time).
+# upload_scheduler.tuned_options asks limits() how much concurrency the link
+# can carry: one transfer with small chunks on a weak link, half on a fair one,
+# the configured maximum on a strong one or a wired connection. The rclone
+# samples cap that further: once more parallel transfers stop raising the
+# achieved speed, limits() allows one more than where it flattened. Every
+# rclone run reads it as it starts, so the pipeline's batches follow the link.
+#   ./network_monitor.py         print the link and its quality
+#   ./network_monitor.py scan    scan for networks
+
+import re
+import sys
+import time
+import logging
+import threading
+import statistics
+import subprocess
+from collections import deque
+
+import cached_task
+import config
+import metrics
+
+# --- Configuration ---
+INTERFACE = config.get_str("WIFI_INTERFACE", "wlan0")
+SAMPLE_SECONDS = config.get_float("NETWORK_SAMPLE_SECONDS", 15)
+SCAN_SECONDS = config.get_float("WIFI_SCAN_SECONDS", 600)  # 0 = scan only when /wifi asks
+SCAN_TTL = config.get_int("WIFI_SCAN_TTL", 60)
+WEAK_DBM = config.get_int("NETWORK_WEAK_DBM", -75)
+STRONG_DBM = config.get_int("NETWORK_STRONG_DBM", -60)
+WEAK_LINK_MBPS = config.get_float("NETWORK_WEAK_LINK_MBPS", 12)  # below this link rate the link counts as weak
+WEAK_CHUNK_MB = 32  # a chunk lost on a weak link is re-sent whole; keep them small
+SMOOTHING = 4  # samples; one dip should not throttle a whole run
+THROUGHPUT_SAMPLES = 40  # rclone samples kept, about ten minutes of uploading
+FLAT_GAIN = 0.1  # more transfers must raise the median speed by this share to be worth running
+WIRELESS_PROC = "/proc/net/wireless"
+
+WEAK, FAIR, STRONG, UNKNOWN = "weak", "fair", "strong", "unknown"
+
+SIGNAL_DBM = metrics.gauge("wifi_signal_dbm", "Wi-Fi signal strength (RSSI).")
+LINK_MBPS = metrics.gauge("wifi_link_mbps", "Wi-Fi transmit link rate.")
+LINK_QUALITY = metrics.gauge("wifi_link_quality", "Wi-Fi link quality: 0 unknown, 1 weak, 2 fair, 3 strong.")
+QUALITY_LEVELS = {UNKNOWN: 0, WEAK: 1, FAIR: 2, STRONG: 3}
+
+logger = logging.getLogger("network_monitor")
+
+_monitor = None  # the running NetworkMonitor in this process, if any
+
+
+# --- Link readings ---
+def read_signal(interface=INTERFACE):
+    """RSSI in dBm from /proc/net/wireless, or None without a wireless link."""
+    try:
+        with open(WIRELESS_PROC, "r") as f:
+            lines = f.readlines()[2:]
+    except OSError:
+        return None
+    for line in lines:
+        name, _, fields = line.partition(":")
+        if name.strip() != interface:
+            continue
+        try:
+            level = float(fields.split()[2].rstrip("."))
+        except (IndexError, ValueError):
+            return None
+        # Some drivers report an unsigned byte (256 - |dBm|); 0 means not associated.
+        if level > 0:
+            level -= 256
+        return int(level) if level < 0 else None
+    return None
+
+
+def read_link_rate(interface=INTERFACE):
+    """Transmit link rate in Mbit/s from `iw dev <iface> link`, or None when not connected."""
+    try:
+        result = subprocess.run(["iw", "dev", interface, "link"], capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = re.search(r"tx bitrate:\s*([\d.]+)\s*MBit/s", result.stdout)
+    return float(match.group(1)) if match else None
+
+
+def classify(signal_dbm, link_mbps):
+    if signal_dbm is None:
+        return UNKNOWN  # no Wi-Fi (wired, or not Linux): leave uploads alone
+    if signal_dbm <= WEAK_DBM or (link_mbps is not None and link_mbps < WEAK_LINK_MBPS):
+        return WEAK
+    return STRONG if signal_dbm >= STRONG_DBM else FAIR
+
+
+def scan(interface=INTERFACE):
+    """Networks in range as [{"ssid", "signal_dbm"}], strongest first; one entry per SSID."""
+    if not sys.platform.startswith("linux"):
+        return []
+    result = subprocess.run(["sudo", "/sbin/iwlist", interface, "scan"], capture_output=True, text=True, timeout=20)
+    if result.returncode != 0:
+        raise RuntimeError(f"iwlist scan failed with code {result.returncode}")
+    networks = {}
+    for cell in re.split(r"\n\s*Cell \d+ - ", result.stdout)[1:]:
+        ssid = re.search(r'ESSID:"(.*)"', cell)
+        if not ssid or not ssid.group(1) or ssid.group(1) == "\\x00":
+            continue
+        level = re.search(r"Signal level[=:](-?\d+)", cell)
+        signal = int(level.group(1)) if level else None
+        known = networks.get(ssid.group(1))
+        if known is None or (signal is not None and (known["signal_dbm"] is None or signal > known["signal_dbm"])):
+            networks[ssid.group(1)] = {"ssid": ssid.group(1), "signal_dbm": signal}
+    return sorted(networks.values(), key=lambda n: (n["signal_dbm"] is None, -(n["signal_dbm"] or 0), n["ssid"]))
+
+
+# --- Upload limits ---
+def current(interface=INTERFACE):
+    """The link as {"quality", "signal_dbm", "link_mbps"}: smoothed by the monitor when one runs here."""
+    if _monitor is not None and _monitor.interface == interface:
+        link = _monitor.link()
+        if link is not None:
+            return link
+    signal, rate = read_signal(interface), read_link_rate(interface)
+    return {"quality": classify(signal, rate), "signal_dbm": signal, "link_mbps": rate}
+
+
+def throughput_cap(samples):
+    """Transfers worth running, from (active transfers, bytes/s) samples; None without enough data.
+
+    Each concurrency seen at least twice is compared by its median speed. The
+    cap is one above the lowest concurrency within FLAT_GAIN of the best, so a
+    later run can still find out whether more transfers help; None when the
+    best speed came from the most transfers tried.
+    """
+    speeds = {}
+    for active, speed in samples:
+        if active and speed:
+            speeds.setdefault(active, []).append(speed)
+    levels = sorted((active, statistics.median(s)) for active, s in speeds.items() if len(s) >= 2)
+    if len(levels) < 2:
+        return None
+    best = max(speed for _active, speed in levels)
+    flat = next(active for active, speed in levels if speed >= best * (1 - FLAT_GAIN))
+    return flat + 1 if flat < levels[-1][0] else None
+
+
+def limits(max_transfers, link=None):
+    """Transfers and largest drive chunk (MB, None = no cap) the link allows, given the configured maximum."""
+    link = link or current()
+    quality = link["quality"]
+    if quality == WEAK:
+        transfers, chunk_mb = 1, WEAK_CHUNK_MB
+    elif quality == FAIR:
+        transfers, chunk_mb = max(1, max_transfers // 2), None
+    else:
+        transfers, chunk_mb = max_transfers, None
+    cap = _monitor.throughput_cap() if _monitor is not None else None
+    if cap is not None and cap < transfers:
+        transfers = cap
+    return {"quality": quality, "transfers": transfers, "chunk_mb": chunk_mb, "throughput_cap": cap}
+
+
+class NetworkMonitor:
+    """Samples the link on a daemon thread and keeps the network scan fresh.
+
+    rclone_stats, if given, returns the running rclone's core/stats reply (None when idle).
+    """
+
+    def __init__(self, interface=INTERFACE, sample_seconds=SAMPLE_SECONDS, scan_seconds=SCAN_SECONDS,
+                 rclone_stats=None):
+        self.interface = interface
+        self.sample_seconds = sample_seconds
+        self.scan_seconds = scan_seconds
+        self.rclone_stats = rclone_stats
+        self.scan_task = cached_task.CachedTask("wifi-scan", lambda: scan(interface), SCAN_TTL)
+        self._samples = deque(maxlen=SMOOTHING)
+        self._throughput = deque(maxlen=THROUGHPUT_SAMPLES)  # (active transfers, bytes/s)
+        self._upload_speed = None
+        self._sampled_at = None
+        self._thread = None
+
+    def start(self):
+        global _monitor
+        if self._thread is None:
+            _monitor = self
+            self._thread = threading.Thread(target=self._run, name="network-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        last_scan = None
+        while True:
+            try:
+                self._sample()
+                if (self.scan_seconds > 0 and self._upload_speed is None
+                        and (last_scan is None or time.monotonic() - last_scan >= self.scan_seconds)):
+                    last_scan = time.monotonic()
+                    self.scan_task.refresh()
+            except Exception as e:
+                logger.error(f"Network sample failed: {e}", exc_info=True)
+            time.sleep(self.sample_seconds)
+
+    def _sample(self):
+        signal, rate = read_signal(self.interface), read_link_rate(self.interface)
+        stats = self.rclone_stats() if self.rclone_stats else None
+        speed = stats.get("speed") if stats else None
+        active = len(stats.get("transferring") or []) if stats else 0
+        previous = self.link()
+        self._samples.append((signal, rate))
+        self._upload_speed = speed
+        if active and speed:
+            self._throughput.append((active, speed))
+        self._sampled_at = time.time()
+        link = self.link()
+        if signal is not None:
+            SIGNAL_DBM.set(signal)
+        if rate is not None:
+            LINK_MBPS.set(rate)
+        LINK_QUALITY.set(QUALITY_LEVELS[link["quality"]])
+        if previous is not None and previous["quality"] != link["quality"]:
+            logger.info(f"Wi-Fi link is now {link['quality']} ({link['signal_dbm']} dBm, "
+                        f"{link['link_mbps']} Mbit/s).")
+
+    def link(self):
+        """The smoothed link (median of the last samples), or None before the first sample."""
+        samples = list(self._samples)
+        if not samples:
+            return None
+        signals = [s for s, _ in samples if s is not None]
+        rates = [r for _, r in samples if r is not None]
+        signal = int(statistics.median(signals)) if signals else None
+        rate = statistics.median(rates) if rates else None
+        return {"quality": classify(signal, rate), "signal_dbm": signal, "link_mbps": rate}
+
+    def throughput_cap(self):
+        return throughput_cap(list(self._throughput))
+
+    def status(self):
+        link = self.link() or current(self.interface)
+        return dict(link, interface=self.interface, upload_bytes_per_s=self._upload_speed,
+                    throughput_cap=self.throughput_cap(), sampled_at=self._sampled_at)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "scan":
+        for network in scan():
+            signal = f"{network['signal_dbm']} dBm" if network["signal_dbm"] is not None else "?"
+            print(f"{signal:>8}  {network['ssid']}")
+        sys.exit(0)
+    link = current()
+    print(f"Interface: {INTERFACE}")
+    print(f"Signal:    {link['signal_dbm'] if link['signal_dbm'] is not None else 'n/a'} dBm")
+    print(f"Link rate: {link['link_mbps'] if link['link_mbps'] is not None else 'n/a'} Mbit/s")
+    print(f"Quality:   {link['quality']} (./upload_scheduler.py shows the transfers it allows)")
@@ -0,0 +1,224 @@
+# notifier.py
+# Non-blocking email notifications for the web app.
+# Callers queue a message (send) or a line of a digest (add_to_digest) and
+# return at once; one daemon thread per process does the SMTP work. That thread
+# keeps its SMTP session open between messages (checked with NOOP before reuse,
+# closed after SMTP_IDLE_SECONDS idle or when email_config.json changes), so a
+# burst costs one TLS handshake and login instead of one per message. Digest
+# lines sharing a key are collected for NOTIFY_DIGEST_SECONDS and sent as one
+# email, e.g. one summary for several cards offloaded at once. Failed sends are
+# retried with exponential backoff, up to NOTIFY_MAX_ATTEMPTS.
+# send_notification.py stays the command-line sender and uses SmtpSession too.
+
+import time
+import heapq
+import logging
+import smtplib
+import itertools
+import threading
+from email.mime.text import MIMEText
+
+import config
+import metrics
+
+# --- Configuration ---
+SMTP_TIMEOUT = 30
+IDLE_SECONDS = config.get_float("SMTP_IDLE_SECONDS", 60)
+DIGEST_SECONDS = config.get_float("NOTIFY_DIGEST_SECONDS", 120)
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 30 * 60
+MAX_ATTEMPTS = config.get_int("NOTIFY_MAX_ATTEMPTS", 6)
+REQUIRED_FIELDS = ("smtp_server", "smtp_port", "smtp_username", "smtp_password", "target_email")
+
+SEND_SECONDS = metrics.histogram("smtp_send_seconds", "Time to send one email, including any connect and login.",
+                                 ("result",))
+
+logger = logging.getLogger("notifier")
+
+
+class NotConfigured(Exception):
+    pass
+
+
+def missing_fields(settings):
+    return [field for field in REQUIRED_FIELDS if not (settings or {}).get(field)]
+
+
+def recipients(settings):
+    """target_email may list several addresses, separated by commas or semicolons."""
+    return [a.strip() for a in settings["target_email"].replace(";", ",").split(",") if a.strip()]
+
+
+class SmtpSession:
+    """One SMTP connection, reused across messages while it stays alive and the settings stay the same."""
+
+    def __init__(self):
+        self._server = None
+        self._signature = None
+        self.last_used = 0.0
+
+    @property
+    def connected(self):
+        return self._server is not None
+
+    def _connect(self, settings):
+        server_name, port = settings["smtp_server"], int(settings["smtp_port"])
+        logger.info(f"Connecting to SMTP server {server_name}:{port}...")
+        # STARTTLS on 587, implicit TLS on 465, plain otherwise.
+        if port == 465:
+            server = smtplib.SMTP_SSL(server_name, port, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(server_name, port, timeout=SMTP_TIMEOUT)
+            if port == 587:
+                server.starttls()
+        try:
+            server.login(settings["smtp_username"], settings["smtp_password"])
+        except BaseException:
+            server.close()
+            raise
+        self._server = server
+        self._signature = tuple(str(settings[field]) for field in REQUIRED_FIELDS)
+
+    def _alive(self):
+        try:
+            return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, settings, subject, body):
+        """Sends one message, connecting or reconnecting as needed. Raises on failure."""
+        missing = missing_fields(settings)
+        if missing:
+            raise NotConfigured(f"Missing required fields in email_config.json: {', '.join(missing)}")
+        if not str(settings["smtp_port"]).strip().isdigit():
+            raise NotConfigured(f"Invalid SMTP port '{settings['smtp_port']}'. Must be an integer.")
+        message = MIMEText(body, "plain")
+        message["Subject"] = subject
+        message["From"] = settings["smtp_username"]
+        message["To"] = settings["target_email"]
+        started = time.monotonic()
+        try:
+            signature = tuple(str(settings[field]) for field in REQUIRED_FIELDS)
+            if self._server is not None and (signature != self._signature or not self._alive()):
+                self.close()
+            if self._server is None:
+                self._connect(settings)
+            self._server.sendmail(settings["smtp_username"], recipients(settings), message.as_string())
+        except BaseException:
+            SEND_SECONDS.observe(time.monotonic() - started, result="error")
+            self.close()
+            raise
+        SEND_SECONDS.observe(time.monotonic() - started, result="ok")
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                self._server.close()
+            except OSError:
+                pass
+        self._server = None
+        self._signature = None
+
+
+class Notifier:
+    """Background sender: immediate messages, digests and retries, all on one thread."""
+
+    def __init__(self, digest_seconds=DIGEST_SECONDS, idle_seconds=IDLE_SECONDS, settings=config.email_config):
+        self.digest_seconds = digest_seconds
+        self.idle_seconds = idle_seconds
+        self._settings = settings
+        self._session = SmtpSession()
+        self._heap = []  # (due, seq, message)
+        self._digests = {}  # key -> {"title", "lines", "failures", "due"}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+            self._thread.start()
+        return self
+
+    def configured(self):
+        return not missing_fields(self._settings())
+
+    def send(self, subject, body):
+        """Queues one email to go out as soon as possible."""
+        self._push(time.time(), {"subject": subject, "body": body, "attempts": 0})
+
+    def add_to_digest(self, key, title, line, failed=False):
+        """Adds a line to the digest for key, which is sent digest_seconds after its first line."""
+        with self._cond:
+            digest = self._digests.get(key)
+            if digest is None:
+                digest = self._digests[key] = {"title": title, "lines": [], "failures": 0,
+                                               "due": time.time() + self.digest_seconds}
+            digest["lines"].append(line)
+            digest["failures"] += 1 if failed else 0
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap) + len(self._digests)
+
+    def _push(self, due, message):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), message))
+            self._cond.notify()
+
+    @staticmethod
+    def _digest_message(digest):
+        count = len(digest["lines"])
+        subject = f"{digest['title']}: {count} update{'s' if count != 1 else ''}"
+        if digest["failures"]:
+            subject += f", {digest['failures']} failed"
+        return {"subject": subject, "body": "\n".join(digest["lines"]) + "\n", "attempts": 0}
+
+    def _next_message(self):
+        """Waits for the next due message. Returns None when the idle SMTP session should be closed."""
+        with self._cond:
+            while True:
+                now = time.time()
+                for key, digest in list(self._digests.items()):
+                    if digest["due"] <= now:
+                        del self._digests[key]
+                        heapq.heappush(self._heap, (now, next(self._seq), self._digest_message(digest)))
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                wake = [self._heap[0][0]] if self._heap else []
+                wake += [d["due"] for d in self._digests.values()]
+                timeout = min(wake) - now if wake else None
+                if self._session.connected:
+                    idle_left = self._session.last_used + self.idle_seconds - time.monotonic()
+                    if idle_left <= 0:
+                        return None  # closed outside the lock; QUIT can take a while
+                    timeout = idle_left if timeout is None else min(timeout, idle_left)
+                self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            message = self._next_message()
+            if message is None:
+                self._session.close()
+                logger.info("SMTP connection closed (idle).")
+                continue
+            try:
+                self._session.send(self._settings(), message["subject"], message["body"])
+                logger.info(f"Email sent: {message['subject']}")
+            except NotConfigured as e:
+                logger.error(f"Cannot send email '{message['subject']}': {e}")
+            except Exception as e:
+                message["attempts"] += 1
+                if message["attempts"] >= MAX_ATTEMPTS:
+                    logger.error(f"Giving up on email '{message['subject']}' after {message['attempts']} "
+                                 f"attempts: {e}")
+                    continue
+                delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (message["attempts"] - 1))
+                logger.warning(f"Email '{message['subject']}' failed ({e}); retrying in {delay}s.")
+                self._push(time.time() + delay, message)
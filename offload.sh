@@ -6,18 +6,19 @@
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
 UPLOAD_SCRIPT="${SCRIPT_DIR}/upload_and_cleanup.sh"
 LOG_FILE="${SCRIPT_DIR}/logs/offload.log" # Log wrapper activity
+LOG_SOURCE="offload.sh"
+source "${SCRIPT_DIR}/log_common.sh"
 
-echo "--------------------" >> "${LOG_FILE}"
-echo "$(date): Offload script triggered." >> "${LOG_FILE}"
+log_msg INFO "Offload script triggered."
 
 if [ -f "$UPLOAD_SCRIPT" ]; then
-  echo "$(date): Executing ${UPLOAD_SCRIPT}..." >> "${LOG_FILE}"
+  log_msg INFO "Executing ${UPLOAD_SCRIPT}..."
   # Execute the main script, its output will go to its own log (rclone.log)
   bash "$UPLOAD_SCRIPT"
   EXIT_CODE=$?
-  echo "$(date): ${UPLOAD_SCRIPT} finished with exit code ${EXIT_CODE}." >> "${LOG_FILE}"
+  log_msg INFO "${UPLOAD_SCRIPT} finished with exit code ${EXIT_CODE}."
   exit ${EXIT_CODE}
 else
-  echo "$(date): Error: Upload script not found at ${UPLOAD_SCRIPT}" >> "${LOG_FILE}"
+  log_msg ERROR "Upload script not found at ${UPLOAD_SCRIPT}"
   exit 1
 fi
\ No newline at end of file
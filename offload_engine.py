@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# offload_engine.py
+# Parallel SD card -> local offload engine.
+# Copies the video and photo trees concurrently using a bounded worker pool.
+# With hashing on (the default) each chunk is hashed from the same buffer that
+# is written, so the card is read exactly once; with OFFLOAD_HASH=0 the copy is
+# done kernel-side (copy_file_range / sendfile) and never enters user space.
+# Several cards can offload at once: each run has its own worker pool and an
+# optional read-rate cap, and lands its clips under DEST_LAYOUT
+# (camera/card/date by default) so identically named clips never collide.
+# Importable from app.py, or runnable from the shell:
+#   ./offload_engine.py [SD_MOUNT] [LOCAL_BASE]
+
+import os
+import re
+import sys
+import time
+import errno
+import glob
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import checksums
+import config
+import event_bus
+import eviction
+import job_manager
+import metrics
+import offload_index
+import remote_cache
+import throughput
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VIDEO_REL_PATH = config.get_str("VIDEO_REL_PATH", "PRIVATE/M4ROOT/CLIP")
+PHOTO_REL_PATH = config.get_str("PHOTO_REL_PATH", "DCIM/100MSDCF")
+DEFAULT_LOCAL_BASE = config.get_str("OFFLOAD_PATH", os.path.join(BASE_DIR, "footage"))
+DEFAULT_WORKERS = config.get_int("OFFLOAD_WORKERS", 4)
+# Large, page-aligned chunks keep the card reader streaming sequentially.
+CHUNK_SIZE = config.get_int("OFFLOAD_CHUNK_MB", 8) * 1024 * 1024
+PART_SUFFIX = ".part"
+HASH_ON_COPY = config.get_bool("OFFLOAD_HASH", True)
+# Per-card read cap in MB/s (0 = unlimited), so a fast reader cannot hog the
+# local disk and hashing CPU while a slow one waits.
+CARD_READ_MBPS = config.get_float("CARD_READ_MBPS", 0)
+# Where clips land below footage/<category>/; "" keeps the old flat layout.
+DEST_LAYOUT = config.get_str("DEST_LAYOUT", "{camera}/{card}/{date}")
+# Optional "UUID=Name,UUID=Name" names for cards' cameras; otherwise read from clip metadata.
+CARD_CAMERAS = dict(item.split("=", 1) for item in config.get_str("CARD_CAMERAS", "").split(",") if "=" in item)
+
+# (category, path relative to the card root); category is the folder under LOCAL_BASE
+SOURCES = [
+    ("videos", VIDEO_REL_PATH),
+    ("photos", PHOTO_REL_PATH),
+]
+
+logger = logging.getLogger("offload_engine")
+
+CARD_BYTES = metrics.counter("card_read_bytes_total", "Bytes read off cards into footage/ or streamed to the remote.",
+                             ("source", "category"))
+CARD_FILES = metrics.counter("card_files_total", "Files offloaded from cards.", ("source", "category", "method"))
+FILE_SECONDS = metrics.histogram("offload_file_seconds", "Time to copy (or stream) one file off the card.",
+                                 ("category", "method"), metrics.TRANSFER_BUCKETS)
+
+
+class OffloadCancelled(Exception):
+    pass
+
+
+def _checkpoint(control, nbytes):
+    """Reports progress to an optional job control object; raises once it is cancelled."""
+    if control is not None and not control.checkpoint(nbytes):
+        raise OffloadCancelled()
+
+
+class TokenBucket:
+    """Caps a byte rate across threads; consume() sleeps once the one-second burst is spent."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate) - nbytes
+            self._updated = now
+            deficit = -self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+
+class _ThrottledControl:
+    """Wraps a job control (or none) so every checkpoint first waits for read budget."""
+
+    def __init__(self, control, bucket):
+        self._control = control
+        self._bucket = bucket
+
+    def checkpoint(self, nbytes=0):
+        if nbytes:
+            self._bucket.consume(nbytes)
+        return self._control.checkpoint(nbytes) if self._control is not None else True
+
+    def __getattr__(self, name):
+        if self._control is None:
+            raise AttributeError(name)
+        return getattr(self._control, name)
+
+
+# --- Destination namespace ---
+def _safe_name(value):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value).strip("_") or "unknown"
+
+
+def camera_id(sd_mount, volume_id):
+    """Names the camera a card came from: CARD_CAMERAS, else the model/serial in a clip's XML sidecar."""
+    if volume_id in CARD_CAMERAS:
+        return _safe_name(CARD_CAMERAS[volume_id])
+    for sidecar in sorted(glob.glob(os.path.join(sd_mount, VIDEO_REL_PATH, "*M01.XML")))[:1]:
+        try:
+            with open(sidecar, "r", errors="replace") as f:
+                head = f.read(4096)
+        except OSError:
+            break
+        match = re.search(r'<Device[^>]*modelName="([^"]+)"[^>]*serialNo="([^"]+)"', head)
+        if match:
+            return _safe_name(f"{match.group(1)}-{match.group(2)}")
+    return "camera"
+
+
+def destination_prefix(task, camera, card):
+    """Directory below footage/<category>/ for a clip, from DEST_LAYOUT."""
+    if not DEST_LAYOUT:
+        return ""
+    date = time.strftime("%Y-%m-%d", time.localtime(task["mtime_ns"] / 1e9))
+    return DEST_LAYOUT.format(camera=camera, card=_safe_name(card), date=date)
+
+
+# --- Copy Primitives ---
+def _copy_range(src_fd, dst_fd, size, control=None):
+    """Copies size bytes with copy_file_range, then sendfile, then a read/write loop."""
+    copied = 0
+    method = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+    while copied < size:
+        count = min(CHUNK_SIZE, size - copied)
+        try:
+            if method == "copy_file_range":
+                n = os.copy_file_range(src_fd, dst_fd, count)
+            elif method == "sendfile":
+                n = os.sendfile(dst_fd, src_fd, None, count)
+            else:
+                buf = os.read(src_fd, count)
+                n = os.write(dst_fd, buf) if buf else 0
+        except OSError as e:
+            # Cross-filesystem copies (exFAT card -> ext4) are refused by newer
+            # kernels; drop to the next method without losing our position.
+            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) and method != "readwrite":
+                method = "sendfile" if method == "copy_file_range" else "readwrite"
+                continue
+            raise
+        if n == 0:
+            break
+        copied += n
+        _checkpoint(control, n)
+    return copied, method
+
+
+def _copy_hashed(src_file, dst_fd, hasher, control=None):
+    """Copies through one reusable buffer, feeding the hasher from the bytes written."""
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    copied = 0
+    while True:
+        n = src_file.readinto(buf)
+        if not n:
+            break
+        chunk = view[:n]
+        hasher.update(chunk)
+        while chunk:
+            written = os.write(dst_fd, chunk)
+            chunk = chunk[written:]
+        copied += n
+        _checkpoint(control, n)
+    return copied, f"hashed:{checksums.available_algorithm()}"
+
+
+def copy_file(src, dst, hasher=None, control=None):
+    """Copies src to dst atomically via a .part file. Returns (bytes, seconds, method).
+
+    When a hasher is passed the copy goes through user space and updates it.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + PART_SUFFIX
+    start = time.monotonic()
+    st = os.stat(src)
+    try:
+        with open(src, "rb", buffering=0) as fsrc, open(tmp, "wb") as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if hasher is not None:
+                copied, method = _copy_hashed(fsrc, dst_fd, hasher, control)
+            else:
+                copied, method = _copy_range(src_fd, dst_fd, st.st_size, control)
+            if copied != st.st_size:
+                raise IOError(f"Short copy for {src}: {copied} of {st.st_size} bytes")
+            if hasattr(os, "posix_fadvise"):
+                # Footage is read once; don't let it evict the web app from page cache.
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, dst)
+    return copied, time.monotonic() - start, method
+
+
+# --- Planning ---
+def scan_sources(sd_mount, local_base, camera="camera", card="card"):
+    """Returns a list of copy task dicts for the files on the card."""
+    tasks = []
+    for category, rel_path in SOURCES:
+        src_root = os.path.join(sd_mount, rel_path)
+        if not os.path.isdir(src_root):
+            logger.warning(f"Source directory {src_root} not found. Skipping {category}.")
+            continue
+        for dirpath, _dirnames, filenames in os.walk(src_root):
+            for name in filenames:
+                if name.startswith("."):
+                    continue
+                src = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(src)
+                except OSError as e:
+                    logger.warning(f"Cannot stat {src}: {e}")
+                    continue
+                task = {"category": category, "src": src, "card_path": os.path.relpath(src, sd_mount),
+                        "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+                rel_path = os.path.join(category, destination_prefix(task, camera, card),
+                                        os.path.relpath(src, src_root))
+                task.update(rel_path=rel_path, dst=os.path.join(local_base, rel_path))
+                tasks.append(task)
+    return tasks
+
+
+def _interleave(tasks):
+    """Alternates categories so videos and photos are copied at the same time."""
+    by_category = {}
+    for task in tasks:
+        by_category.setdefault(task["category"], []).append(task)
+    queues = list(by_category.values())
+    ordered = []
+    while any(queues):
+        for q in queues:
+            if q:
+                ordered.append(q.pop(0))
+    return ordered
+
+
+def _indexed_state(task, known):
+    """Returns the index state for an unchanged clip, or None if it must be looked at."""
+    row = known.get(task["card_path"])
+    if row is None or row["size"] != task["size"] or row["mtime_ns"] != task["mtime_ns"]:
+        return None
+    return row["state"]
+
+
+def _already_present(task, record):
+    """A file is present if its local copy matches the card's size and mtime.
+
+    A copy the index recorded at that path (record) must also match the size
+    it recorded, so a file replaced on disk since it was hashed is copied again.
+    """
+    try:
+        st = os.stat(task["dst"])
+    except OSError:
+        return False
+    if record is not None and record["size"] != task["size"]:
+        return False
+    return st.st_size == task["size"] and st.st_mtime_ns == task["mtime_ns"]
+
+
+def new_summary():
+    return {"files_copied": 0, "files_streamed": 0, "files_skipped": 0, "bytes_copied": 0,
+            "errors": [], "files": [], "seconds": 0.0, "cancelled": False}
+
+
+def select_tasks(conn, sd_mount, local_base):
+    """Scans the card against the offload index, without writing anything.
+
+    Returns (camera, volume_id, tasks to copy, files skipped, adopted), where
+    adopted are skipped tasks already in footage/ that the index does not know
+    for this card yet; they carry the algo and digest recorded for that copy, if any.
+    """
+    volume_id = offload_index.get_volume_id(sd_mount)
+    known = offload_index.load_volume(conn, volume_id)
+    camera = camera_id(sd_mount, volume_id)
+    tasks, adopted, skipped = [], [], 0
+    for task in scan_sources(sd_mount, local_base, camera, volume_id):
+        row = known.get(task["card_path"])
+        if row is not None:
+            # Keep a known clip where it already is, whatever DEST_LAYOUT says now.
+            task.update(rel_path=row["local_path"], dst=os.path.join(local_base, row["local_path"]))
+        state = _indexed_state(task, known)
+        if state in (offload_index.STATE_UPLOADED, offload_index.STATE_DELETED):
+            # Already safe on the remote; the local copy may have been evicted.
+            skipped += 1
+        else:
+            # Not this card's yet: whatever the index recorded at that path (one indexed lookup).
+            record = row if row is not None else offload_index.find_local(conn, task["rel_path"])
+            if not _already_present(task, record):
+                tasks.append(task)
+                continue
+            skipped += 1
+            if state is None:
+                task.update(algo=record["algo"] if record else None, digest=record["digest"] if record else None)
+                adopted.append(task)
+    return camera, volume_id, tasks, skipped, adopted
+
+
+# --- Main Entry Point ---
+def run_offload(sd_mount, local_base=DEFAULT_LOCAL_BASE, workers=DEFAULT_WORKERS, on_progress=None,
+                control=None, stream_policy=None, read_mbps=CARD_READ_MBPS):
+    """Copies new files from the card to local_base. Returns a summary dict.
+
+    on_progress, if given, is called with a per-file result dict after every file.
+    control, if given, is a job_manager.Job (or anything with begin/checkpoint/
+    file_done) used to report bytes, pause between chunks and cancel.
+    stream_policy, if given, is a card_stream.StreamPolicy; clips it does not
+    keep locally are streamed to the remote instead (result["streamed"] is True).
+    read_mbps caps how fast this card is read (0 = unlimited).
+    """
+    started = time.monotonic()
+    summary = new_summary()
+    if not os.path.isdir(sd_mount):
+        summary["errors"].append(f"SD mount {sd_mount} not found")
+        logger.error(f"SD mount {sd_mount} not found.")
+        return summary
+
+    os.makedirs(local_base, exist_ok=True)
+    conn = offload_index.connect()
+    camera, volume_id, tasks, summary["files_skipped"], adopted = select_tasks(conn, sd_mount, local_base)
+    summary["volume_id"] = volume_id
+    summary["camera"] = camera
+    source = job_manager.device_for_mount(sd_mount)
+    # Copies report through copy_control, which adds the read cap when one is set.
+    copy_control = _ThrottledControl(control, TokenBucket(read_mbps * 1024 * 1024)) if read_mbps > 0 else control
+    for task in adopted:
+        offload_index.record_copied(conn, volume_id, task["card_path"], task["rel_path"], task["category"],
+                                    task["size"], task["mtime_ns"], task["algo"], task["digest"])
+    total_bytes = sum(t["size"] for t in tasks)
+    logger.info(f"Offload plan: {len(tasks)} files ({total_bytes / 1024**2:.1f} MB) to copy, "
+                f"{summary['files_skipped']} already present, {workers} workers.")
+    if control is not None:
+        control.begin(total_bytes, len(tasks))
+    if tasks and (stream_policy is None or stream_policy.mode != "stream"):
+        # Make room up front rather than hitting ENOSPC halfway through the card.
+        eviction.evict(local_base, needed=total_bytes)
+
+    def _copy(task):
+        if stream_policy is not None and not stream_policy.keep_local(task):
+            return stream_policy.stream(task, lambda n: _checkpoint(copy_control, n))
+        event_bus.publish("transfer", event="file_started", name=task["rel_path"], size=task["size"])
+        hasher = checksums.new_hasher() if HASH_ON_COPY else None
+        copied, seconds, method = copy_file(task["src"], task["dst"], hasher, copy_control)
+        result = {"category": task["category"], "src": task["src"], "dst": task["dst"],
+                  "rel_path": task["rel_path"], "bytes": copied, "seconds": seconds, "method": method,
+                  "mb_per_s": (copied / 1024**2) / seconds if seconds > 0 else 0.0, "digest": None}
+        if hasher is not None:
+            result["digest"] = hasher.hexdigest()
+            checksums.append_manifest(local_base, {
+                "path": task["rel_path"], "size": copied, "mtime_ns": task["mtime_ns"],
+                "algo": checksums.available_algorithm(), "digest": result["digest"]})
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="offload") as pool:
+        futures = {pool.submit(_copy, task): task for task in _interleave(tasks)}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                result = future.result()
+            except OffloadCancelled:
+                summary["cancelled"] = True
+                logger.warning("Offload cancelled; abandoning remaining files.")
+                # as_completed() never yields futures cancelled here, so stop
+                # iterating; running copies abort at their next checkpoint.
+                for pending in futures:
+                    pending.cancel()
+                break
+            except Exception as e:
+                logger.error(f"Copy failed for {task['src']}: {e}")
+                summary["errors"].append(f"{task['src']}: {e}")
+                continue
+            streamed = result.get("streamed", False)
+            logger.info(f"{'Streamed' if streamed else 'Copied'} {result['src']} "
+                        f"({result['bytes'] / 1024**2:.1f} MB in {result['seconds']:.1f}s, "
+                        f"{result['mb_per_s']:.1f} MB/s, {result['method']})")
+            offload_index.record_copied(conn, volume_id, task["card_path"], task["rel_path"], task["category"],
+                                        result["bytes"], task["mtime_ns"],
+                                        checksums.available_algorithm() if result["digest"] else None,
+                                        result["digest"],
+                                        # A streamed clip has no local copy for eviction to free.
+                                        offload_index.STATE_DELETED if streamed else offload_index.STATE_COPIED)
+            if streamed:
+                # rcat gives the remote copy the upload time, not the clip's modtime.
+                md5 = result["digest"] if checksums.available_algorithm() == "md5" else None
+                remote_cache.record(conn, [(task["rel_path"], result["bytes"], None, md5)], source="stream")
+            method = "streamed" if streamed else "copied"
+            CARD_BYTES.inc(result["bytes"], source=source, category=task["category"])
+            CARD_FILES.inc(source=source, category=task["category"], method=method)
+            FILE_SECONDS.observe(result["seconds"], category=task["category"], method=method)
+            # Results are collected on this thread only; the pool workers never touch summary.
+            summary["files_streamed" if streamed else "files_copied"] += 1
+            summary["bytes_copied"] += result["bytes"]
+            summary["files"].append(result)
+            event_bus.publish("transfer", event="file_finished", name=result["rel_path"], size=result["bytes"],
+                              seconds=round(result["seconds"], 2), mb_per_s=round(result["mb_per_s"], 1),
+                              streamed=streamed)
+            if control is not None:
+                control.file_done()
+            if on_progress:
+                on_progress(result)
+
+    summary["seconds"] = time.monotonic() - started
+    if not summary["cancelled"] and not summary["files_streamed"]:
+        # Streamed clips move at upload speed, so only all-local runs say how fast cards read.
+        throughput.record(conn, throughput.CARD_READ, summary["bytes_copied"], summary["seconds"])
+    conn.close()
+    rate = (summary["bytes_copied"] / 1024**2) / summary["seconds"] if summary["seconds"] > 0 else 0.0
+    logger.info(f"Offload finished: {summary['files_copied']} copied, {summary['files_streamed']} streamed, "
+                f"{summary['files_skipped']} skipped, "
+                f"{len(summary['errors'])} errors, {rate:.1f} MB/s overall.")
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    sd_mount = sys.argv[1] if len(sys.argv) > 1 else config.get_str("SD_MOUNT_PATH", "")
+    local_base = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_LOCAL_BASE
+    if not sd_mount:
+        print("Usage: ./offload_engine.py <SD_MOUNT> [LOCAL_BASE]")
+        sys.exit(1)
+    result = run_offload(sd_mount, local_base)
+    sys.exit(1 if result["errors"] else 0)
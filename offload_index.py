@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# offload_index.py
+# Persistent SQLite index of every clip the offloader has seen.
+# Rows are keyed on (card volume ID, path on card) and carry size, mtime and
+# content hash plus the clip's state, so repeat inserts and the upload stage
+# only touch the delta instead of rescanning footage/ and the remote.
+# Uploads that failed wait in failed_transfers; retry_queue.py owns that table.
+# Photos uploaded inside a tar bundle are listed in bundle_members (bundler.py),
+# and measured card-read and upload rates in throughput (throughput.py).
+# remote_objects caches what is on the remote (remote_cache.py).
+#   ./offload_index.py counts
+#   ./offload_index.py pending-uploads <category>         paths relative to footage/<category>
+#   ./offload_index.py mark-uploaded <category> <list>    list as printed by pending-uploads
+#   ./offload_index.py import-local [LOCAL_BASE]          register pre-index footage
+
+import os
+import sys
+import time
+import sqlite3
+import subprocess
+
+import config
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_DB_PATH = config.get_str("OFFLOAD_INDEX_DB", os.path.join(BASE_DIR, "offload_index.db"))
+DEFAULT_LOCAL_BASE = config.get_str("OFFLOAD_PATH", os.path.join(BASE_DIR, "footage"))
+
+# Lifecycle of a clip; each state implies the ones before it.
+STATE_COPIED = "copied"
+STATE_VERIFIED = "verified"
+STATE_UPLOADED = "uploaded"
+STATE_DELETED = "deleted"  # on the remote, no local copy (evicted, or streamed straight from the card)
+STATES = (STATE_COPIED, STATE_VERIFIED, STATE_UPLOADED, STATE_DELETED)
+LEGACY_VOLUME_ID = "legacy"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    volume_id  TEXT NOT NULL,
+    path       TEXT NOT NULL,
+    local_path TEXT NOT NULL,
+    category   TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    mtime_ns   INTEGER NOT NULL,
+    algo       TEXT,
+    digest     TEXT,
+    state      TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (volume_id, path)
+);
+CREATE INDEX IF NOT EXISTS clips_state ON clips (state);
+CREATE INDEX IF NOT EXISTS clips_local_path ON clips (local_path);
+CREATE TABLE IF NOT EXISTS failed_transfers (
+    local_path      TEXT PRIMARY KEY,
+    category        TEXT NOT NULL,
+    attempts        INTEGER NOT NULL,
+    last_error      TEXT,
+    first_failed_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bundle_members (
+    local_path  TEXT PRIMARY KEY,
+    bundle      TEXT NOT NULL,
+    bundle_size INTEGER NOT NULL,
+    bundle_md5  TEXT,
+    offset      INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    algo        TEXT,
+    digest      TEXT,
+    created_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bundle_members_bundle ON bundle_members (bundle);
+CREATE TABLE IF NOT EXISTS throughput (
+    kind        TEXT NOT NULL,
+    bytes       INTEGER NOT NULL,
+    seconds     REAL NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS throughput_kind ON throughput (kind, finished_at);
+CREATE TABLE IF NOT EXISTS remote_objects (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    md5      TEXT,
+    modified TEXT,
+    source   TEXT NOT NULL,
+    seen_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remote_listings (
+    prefix    TEXT PRIMARY KEY,
+    listed_at REAL NOT NULL,
+    objects   INTEGER NOT NULL,
+    seconds   REAL NOT NULL
+);
+"""
+
+
+# --- Connection ---
+def connect(db_path=None):
+    """Opens the index, creating the schema on first use. One connection per thread."""
+    conn = sqlite3.connect(db_path or INDEX_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # WAL lets the web UI read counts while an offload is writing.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_volume_id(mount_path):
+    """Identifies a card by filesystem UUID, falling back to the statvfs fsid."""
+    try:
+        result = subprocess.run(["findmnt", "-n", "-o", "UUID", "--target", mount_path],
+                                capture_output=True, text=True, timeout=5)
+        uuid = result.stdout.strip()
+        if result.returncode == 0 and uuid:
+            return uuid
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    try:
+        return f"fsid-{os.statvfs(mount_path).f_fsid:x}"
+    except (OSError, AttributeError):
+        return os.path.basename(os.path.normpath(mount_path))
+
+
+# --- Reads ---
+def load_volume(conn, volume_id):
+    """Returns {path on card: row} for one card, for O(1) skip checks during a scan."""
+    rows = conn.execute("SELECT * FROM clips WHERE volume_id = ?", (volume_id,))
+    return {row["path"]: row for row in rows}
+
+
+def find_local(conn, local_path):
+    """Returns the latest row stored at local_path (relative to footage/), or None."""
+    return conn.execute("SELECT * FROM clips WHERE local_path = ? ORDER BY updated_at DESC LIMIT 1",
+                        (local_path,)).fetchone()
+
+
+def state_counts(conn):
+    """Returns {state: number of clips}, with zeroes for unused states."""
+    counts = dict.fromkeys(STATES, 0)
+    for row in conn.execute("SELECT state, COUNT(*) AS n FROM clips GROUP BY state"):
+        counts[row["state"]] = row["n"]
+    return counts
+
+
+def pending_uploads(conn, category=None):
+    """Returns rows that are on local disk but not yet uploaded."""
+    sql = "SELECT * FROM clips WHERE state IN (?, ?)"
+    args = [STATE_COPIED, STATE_VERIFIED]
+    if category:
+        sql += " AND category = ?"
+        args.append(category)
+    return conn.execute(sql + " ORDER BY local_path", args).fetchall()
+
+
+# --- Writes ---
+def record_copied(conn, volume_id, path, local_path, category, size, mtime_ns, algo=None, digest=None,
+                  state=STATE_COPIED):
+    """Records a clip that landed locally, or with state=STATE_DELETED one streamed straight to the remote."""
+    conn.execute(
+        "INSERT OR REPLACE INTO clips (volume_id, path, local_path, category, size, mtime_ns, "
+        "algo, digest, state, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (volume_id, path, local_path, category, size, mtime_ns, algo, digest, state, time.time()))
+    conn.commit()
+
+
+def mark_local(conn, local_paths, state):
+    """Moves every clip stored at one of local_paths (relative to footage/) to state."""
+    now = time.time()
+    conn.executemany("UPDATE clips SET state = ?, updated_at = ? WHERE local_path = ?",
+                     [(state, now, p) for p in local_paths])
+    conn.commit()
+
+
+def forget(conn, volume_id, path):
+    """Drops a clip from the index so the next offload copies it again."""
+    conn.execute("DELETE FROM clips WHERE volume_id = ? AND path = ?", (volume_id, path))
+    conn.commit()
+
+
+def import_local(conn, local_base):
+    """Registers footage copied before the index existed, so the upload stage sees it."""
+    added = 0
+    for category in ("videos", "photos"):
+        root = os.path.join(local_base, category)
+        for dirpath, _dirnames, filenames in os.walk(root):
+            for name in filenames:
+                full = os.path.join(dirpath, name)
+                local_path = os.path.relpath(full, local_base)
+                if conn.execute("SELECT 1 FROM clips WHERE local_path = ?", (local_path,)).fetchone():
+                    continue
+                st = os.stat(full)
+                conn.execute(
+                    "INSERT OR IGNORE INTO clips (volume_id, path, local_path, category, size, mtime_ns, "
+                    "state, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (LEGACY_VOLUME_ID, local_path, local_path, category, st.st_size, st.st_mtime_ns,
+                     STATE_COPIED, time.time()))
+                added += 1
+    conn.commit()
+    return added
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    conn = connect()
+    if command == "counts":
+        for state, n in state_counts(conn).items():
+            print(f"{state}: {n}")
+    elif command == "pending-uploads" and len(sys.argv) > 2:
+        prefix = sys.argv[2] + "/"
+        for row in pending_uploads(conn, sys.argv[2]):
+            print(row["local_path"][len(prefix):])
+    elif command == "mark-uploaded" and len(sys.argv) > 3:
+        with open(sys.argv[3], "r") as f:
+            paths = [os.path.join(sys.argv[2], line.strip()) for line in f if line.strip()]
+        mark_local(conn, paths, STATE_UPLOADED)
+        print(f"Marked {len(paths)} files uploaded.")
+    elif command == "import-local":
+        base = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_LOCAL_BASE
+        print(f"Registered {import_local(conn, base)} existing local files.")
+    else:
+        print("Usage: ./offload_index.py counts | pending-uploads <category> | "
+              "mark-uploaded <category> <list> | import-local [LOCAL_BASE]")
+        sys.exit(1)
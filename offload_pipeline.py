@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# offload_pipeline.py
+# Overlaps the card read with the upload.
+# offload_engine copies clips as before; every clip that lands (hashed and
+# recorded in the offload index) goes straight onto a priority queue, and an
+# upload thread drains that queue in rclone batches while the card is still
+# being read. End-to-end time approaches max(card read, upload) instead of
+# their sum. Pipelines for several cards can run at once; their upload threads
+# take turns on the uplink (job_manager.UplinkArbiter), one batch of at most
+# PIPELINE_BATCH_MB each, so every card keeps moving. With PROXY_ENABLED,
+# proxies.py builds review proxies of each clip as it lands and uploads them
+# ahead of the originals. Before anything is read, planner.py checks the card
+# fits (evicting or streaming what does not) and estimates how long it takes.
+#   ./offload_pipeline.py [SD_MOUNT] [LOCAL_BASE]
+
+import os
+import sys
+import time
+import heapq
+import logging
+import threading
+import itertools
+
+import card_stream
+import config
+import job_manager
+import metrics
+import offload_engine
+import offload_index
+import planner
+import proxies
+import uploader
+
+# --- Configuration ---
+# largest_first keeps the longest uploads from landing at the end of the run;
+# smallest_first gets the most clips safe soonest; fifo keeps card order.
+UPLOAD_ORDER = config.get_str("UPLOAD_ORDER", "largest_first")
+BATCH_FILES = config.get_int("PIPELINE_BATCH_FILES", 50)
+BATCH_BYTES = config.get_int("PIPELINE_BATCH_MB", 2048) * 1024 * 1024
+RCLONE_ORDER_BY = {"largest_first": "size,descending", "smallest_first": "size,ascending"}
+
+logger = logging.getLogger("offload_pipeline")
+
+QUEUE_DEPTH = metrics.gauge("upload_queue_depth", "Clips copied and waiting in a pipeline's upload queue.")
+SOURCE_UPLOADED = metrics.counter("source_uploaded_bytes_total", "Bytes confirmed on the remote, per card.",
+                                  ("source",))
+
+# Shared by every pipeline in this process. When the caller already holds the
+# uplink lock (upload_and_cleanup.sh, or a job that ran it) only the turn-taking applies.
+uplink = job_manager.UplinkArbiter(use_flock=os.environ.get("OFFLOAD_LOCK_HELD") != "1")
+
+
+class SourceStats:
+    """Throughput accounting for one card's pipeline run."""
+
+    def __init__(self, card, mount):
+        self.card = card
+        self.mount = mount
+        self.started_at = time.time()
+        self.finished_at = None
+        self.files_copied = self.bytes_copied = 0
+        self.files_uploaded = self.bytes_uploaded = 0
+        self._lock = threading.Lock()
+
+    def add_copied(self, nbytes):
+        with self._lock:
+            self.files_copied += 1
+            self.bytes_copied += nbytes
+
+    def add_uploaded(self, nbytes):
+        with self._lock:
+            self.files_uploaded += 1
+            self.bytes_uploaded += nbytes
+        SOURCE_UPLOADED.inc(nbytes, source=self.card)
+
+    def to_dict(self):
+        elapsed = max((self.finished_at or time.time()) - self.started_at, 1e-6)
+        return {"card": self.card, "mount": self.mount, "started_at": self.started_at,
+                "finished_at": self.finished_at, "files_copied": self.files_copied,
+                "bytes_copied": self.bytes_copied, "files_uploaded": self.files_uploaded,
+                "bytes_uploaded": self.bytes_uploaded,
+                "copy_mb_per_s": round(self.bytes_copied / 1024**2 / elapsed, 1),
+                "upload_mb_per_s": round(self.bytes_uploaded / 1024**2 / elapsed, 1)}
+
+
+_sources = {}  # card -> SourceStats of its latest run
+
+
+def source_stats():
+    """Per-card throughput of running and recently finished pipelines."""
+    return [stats.to_dict() for stats in sorted(_sources.values(), key=lambda s: s.started_at, reverse=True)]
+
+
+class UploadQueue:
+    """Priority queue of index rows waiting for upload; closed once the copy stage ends."""
+
+    def __init__(self, order=UPLOAD_ORDER):
+        self.order = order
+        self._heap = []
+        self._seq = itertools.count()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _key(self, row):
+        if self.order == "largest_first":
+            return -row["size"]
+        if self.order == "smallest_first":
+            return row["size"]
+        return 0
+
+    def put(self, row):
+        with self._cond:
+            heapq.heappush(self._heap, (self._key(row), next(self._seq), row))
+            self._cond.notify()
+        QUEUE_DEPTH.inc()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def take_batch(self, limit=BATCH_FILES, max_bytes=BATCH_BYTES):
+        """Blocks until rows are queued; returns up to limit rows (and about max_bytes) in priority order.
+
+        Returns [] once the queue is closed and drained.
+        """
+        with self._cond:
+            while not self._heap and not self._closed:
+                self._cond.wait()
+            batch, size = [], 0
+            while self._heap and len(batch) < limit and (not batch or size < max_bytes):
+                row = heapq.heappop(self._heap)[2]
+                batch.append(row)
+                size += row["size"]
+        if batch:
+            QUEUE_DEPTH.dec(len(batch))
+        return batch
+
+
+class _UploadControl:
+    """Job control for the upload side: pause/cancel pass through, byte totals are counted up front."""
+
+    def __init__(self, control):
+        self._control = control
+
+    def begin(self, bytes_total, files_total):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._control, name)
+
+
+class _CopyControl(_UploadControl):
+    """Job control for the copy side: each planned byte is also an upload byte, so totals count twice."""
+
+    def begin(self, bytes_total, files_total):
+        self._control.begin(bytes_total * 2, files_total * 2)
+
+
+def _upload_worker(queue, local_base, control, summary, stats):
+    """Drains the queue in per-category rclone batches until it is closed and empty."""
+    conn = offload_index.connect()
+    remote_ok = None
+    try:
+        while True:
+            batch = queue.take_batch()
+            if not batch:
+                break
+            if control is not None and control.cancelled:
+                continue  # keep draining so the producer never blocks; rows stay pending
+            if remote_ok is None:
+                remote_ok = uploader.check_remote()
+                if not remote_ok:
+                    summary["errors"].append(f"Remote '{uploader.RCLONE_REMOTE_NAME}:' is not reachable")
+                    logger.error(f"{summary['errors'][-1]}; clips stay queued in the offload index.")
+            if not remote_ok:
+                continue
+            by_category = {}
+            for row in batch:
+                by_category.setdefault(row["category"], []).append(row)
+            turn = uplink.acquire(cancelled=lambda: control is not None and control.cancelled)
+            if turn is None:
+                continue
+            try:
+                for category, rows in by_category.items():
+                    count, exit_code = uploader.upload_rows(
+                        conn, category, rows, _UploadControl(control) if control is not None else None,
+                        order_by=RCLONE_ORDER_BY.get(queue.order), local_base=local_base,
+                        on_uploaded=lambda row: stats.add_uploaded(row["size"]))
+                    summary["files_uploaded"] += count
+                    if exit_code != 0:
+                        summary["errors"].append(f"{category} upload failed (exit code {exit_code})")
+            finally:
+                uplink.release(turn)
+    finally:
+        conn.close()
+
+
+def run_pipeline(sd_mount, local_base=offload_engine.DEFAULT_LOCAL_BASE, workers=offload_engine.DEFAULT_WORKERS,
+                 control=None, order=UPLOAD_ORDER, mode=card_stream.OFFLOAD_MODE, preflight=True):
+    """Copies the card and uploads as clips land.
+
+    Returns {"copy": summary, "upload": summary, "proxies": ..., "plan": ...}.
+
+    mode is card_stream's OFFLOAD_MODE: "local" stages every clip in local_base,
+    "stream" and "auto" send some or all clips straight from the card instead.
+    "proxies" is the proxies.ProxyBuilder summary, or None when proxies are off.
+    With preflight, planner.plan runs first and may switch mode to "auto" or
+    refuse the card ("plan" is its result, or None without preflight).
+    """
+    card_plan = None
+    if preflight:
+        if control is not None:
+            control.set_phase("plan")
+        card_plan = planner.plan(sd_mount, local_base, mode)
+        logger.info(f"Plan for {planner.describe(card_plan)}.")
+        if card_plan["strategy"] == planner.REFUSE:
+            copy_summary = offload_engine.new_summary()
+            copy_summary["errors"].append(f"Not started: {card_plan['reason']}")
+            return {"copy": copy_summary, "upload": {"files_uploaded": 0, "errors": []}, "proxies": None,
+                    "plan": card_plan}
+        mode = card_plan["mode"]
+    if control is not None:
+        control.set_phase("copy+upload")
+    stream_policy = card_stream.StreamPolicy(local_base, mode) if mode != "local" else None
+    stats = SourceStats(job_manager.device_for_mount(sd_mount), sd_mount)
+    _sources[stats.card] = stats
+    queue = UploadQueue(order)
+    upload_summary = {"files_uploaded": 0, "errors": []}
+    # Clips left pending by earlier runs join the queue before anything new.
+    conn = offload_index.connect()
+    try:
+        backlog = offload_index.pending_uploads(conn)
+    finally:
+        conn.close()
+    if control is not None and backlog:
+        control.begin(sum(row["size"] for row in backlog), len(backlog))
+    for row in backlog:
+        queue.put({"category": row["category"], "local_path": row["local_path"], "size": row["size"]})
+
+    consumer = threading.Thread(target=_upload_worker, args=(queue, local_base, control, upload_summary, stats),
+                                name=f"pipeline-upload-{stats.card}", daemon=True)
+    consumer.start()
+    proxy_builder = None
+    if proxies.enabled():
+        proxy_builder = proxies.ProxyBuilder(local_base, cancelled=lambda: control is not None and control.cancelled)
+        proxy_builder.start()
+
+    def on_copied(result):
+        stats.add_copied(result["bytes"])
+        if proxy_builder is not None:
+            proxy_builder.submit(result)
+        if result.get("streamed"):
+            stats.add_uploaded(result["bytes"])
+            # Already on the remote; settle the upload half of its planned bytes.
+            if control is not None:
+                control.checkpoint(result["bytes"])
+                control.file_done()
+            return
+        queue.put({"category": result["category"], "local_path": result["rel_path"], "size": result["bytes"]})
+
+    try:
+        copy_summary = offload_engine.run_offload(sd_mount, local_base, workers, on_progress=on_copied,
+                                                  control=_CopyControl(control) if control is not None else None,
+                                                  stream_policy=stream_policy)
+    finally:
+        queue.close()
+        consumer.join()
+        stats.finished_at = time.time()
+        proxy_summary = None
+        if proxy_builder is not None:
+            # Streamed clips are read back from the card, so finish before the job lets it go.
+            if control is not None and not control.cancelled:
+                control.set_phase("proxies")
+            proxy_summary = proxy_builder.close()
+    logger.info(f"Pipeline finished for {stats.card}: {copy_summary['files_copied']} copied, "
+                f"{copy_summary['files_streamed']} streamed, "
+                f"{upload_summary['files_uploaded']} uploaded, "
+                f"{len(copy_summary['errors']) + len(upload_summary['errors'])} errors.")
+    return {"copy": copy_summary, "upload": upload_summary, "proxies": proxy_summary, "plan": card_plan}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    sd_mount = sys.argv[1] if len(sys.argv) > 1 else config.get_str("SD_MOUNT_PATH", "")
+    local_base = sys.argv[2] if len(sys.argv) > 2 else offload_engine.DEFAULT_LOCAL_BASE
+    if not sd_mount:
+        print("Usage: ./offload_pipeline.py <SD_MOUNT> [LOCAL_BASE]")
+        sys.exit(1)
+    result = run_pipeline(sd_mount, local_base)
+    sys.exit(1 if result["copy"]["errors"] or result["upload"]["errors"] else 0)
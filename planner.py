@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# planner.py
+# Pre-flight plan for an offload, made before any clip is opened.
+# Scans the card's file list against the offload index (the same
+# selection offload_engine makes), totals the new bytes, compares them with the
+# free space in footage/ and what eviction could free, and estimates copy and
+# upload time from the rates throughput.py measured on recent runs. A card that
+# does not fit gets its strategy chosen up front instead of failing half way:
+#   local    fits as it is
+#   evict    fits once uploaded footage is evicted (the engine evicts first)
+#   stream   does not fit even then; the run switches to OFFLOAD_MODE=auto and
+#            streams what does not fit straight to the remote
+#   refuse   does not fit and PLAN_OVERFLOW=refuse; the offload does not start
+# offload_pipeline.py applies the plan; the dashboard shows it from /api/plan.
+#   ./planner.py [SD_MOUNT] [LOCAL_BASE]
+
+import os
+import sys
+import time
+
+import card_stream
+import config
+import eviction
+import offload_engine
+import offload_index
+import throughput
+
+# --- Configuration ---
+OVERFLOW = config.get_str("PLAN_OVERFLOW", "stream")  # "stream" or "refuse"
+DEFAULT_CARD_BYTES_PER_S = config.get_float("PLAN_DEFAULT_CARD_MBPS", 80) * 1024 * 1024
+DEFAULT_UPLOAD_BYTES_PER_S = config.get_float("PLAN_DEFAULT_UPLOAD_MBPS", 2) * 1024 * 1024
+
+LOCAL, EVICT, STREAM, REFUSE = "local", "evict", "stream", "refuse"
+
+
+def _free_bytes(path):
+    """Free space where path is (or will be); footage/ may not exist before the first offload."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return eviction._free_bytes(path)
+
+
+def evictable_bytes(conn, local_base):
+    """Bytes eviction may free: local copies of clips confirmed on the remote that are still on disk."""
+    rows = conn.execute("SELECT local_path, size FROM clips WHERE state = ?", (offload_index.STATE_UPLOADED,))
+    return sum(row["size"] for row in rows if os.path.exists(os.path.join(local_base, row["local_path"])))
+
+
+def _gb(nbytes):
+    return f"{nbytes / 1024**3:.1f} GB"
+
+
+def plan(sd_mount, local_base=offload_engine.DEFAULT_LOCAL_BASE, mode=card_stream.OFFLOAD_MODE,
+         overflow=OVERFLOW):
+    """Returns the plan for offloading sd_mount as a dict; reads the card's file list but writes nothing.
+
+    plan["mode"] is the OFFLOAD_MODE the run should use and plan["strategy"]
+    one of local, evict, stream or refuse. Times are in seconds; the rates come
+    from recent runs where there are any (plan["measured"]), else from defaults.
+    """
+    started = time.monotonic()
+    result = {"mount": sd_mount, "camera": None, "volume_id": None, "files_new": 0, "files_skipped": 0,
+              "bytes_new": 0, "bytes_backlog": 0, "free_bytes": _free_bytes(local_base), "evictable_bytes": 0,
+              "reserve_bytes": eviction.MIN_FREE_BYTES, "strategy": REFUSE, "mode": mode, "reason": "",
+              "card_bytes_per_s": DEFAULT_CARD_BYTES_PER_S, "upload_bytes_per_s": DEFAULT_UPLOAD_BYTES_PER_S,
+              "measured": {"card": False, "upload": False},
+              "copy_seconds": 0.0, "upload_seconds": 0.0, "eta_seconds": 0.0, "planned_at": time.time()}
+    if not os.path.isdir(sd_mount):
+        result["reason"] = f"SD card not found at {sd_mount}"
+        return result
+
+    conn = offload_index.connect()
+    try:
+        camera, volume_id, tasks, skipped, _ = offload_engine.select_tasks(conn, sd_mount, local_base)
+        result["bytes_backlog"] = sum(row["size"] for row in offload_index.pending_uploads(conn))
+        result["evictable_bytes"] = evictable_bytes(conn, local_base)
+        for kind, key in ((throughput.CARD_READ, "card"), (throughput.UPLOAD, "upload")):
+            measured = throughput.rate(conn, kind)
+            if measured:
+                result[f"{key}_bytes_per_s"] = measured
+                result["measured"][key] = True
+    finally:
+        conn.close()
+    new_bytes = sum(task["size"] for task in tasks)
+    result.update(camera=camera, volume_id=volume_id, files_new=len(tasks), files_skipped=skipped,
+                  bytes_new=new_bytes)
+
+    free, reserve, evictable = result["free_bytes"], result["reserve_bytes"], result["evictable_bytes"]
+    if mode == "stream":
+        strategy, reason = STREAM, "OFFLOAD_MODE=stream sends every clip straight to the remote"
+    elif free - new_bytes >= reserve:
+        strategy, reason = LOCAL, f"{_gb(new_bytes)} fits with {_gb(free - new_bytes)} left free"
+    elif free + evictable - new_bytes >= reserve:
+        strategy = EVICT
+        reason = f"{_gb(new_bytes)} fits once {_gb(new_bytes + reserve - free)} of uploaded footage is evicted"
+    elif overflow == STREAM or mode == "auto":
+        strategy, mode = STREAM, "auto"
+        reason = (f"{_gb(new_bytes)} does not fit in {_gb(free + evictable)} "
+                  f"(after eviction, {_gb(reserve)} kept free); "
+                  f"clips that do not fit are streamed to the remote")
+    else:
+        strategy = REFUSE
+        reason = (f"{_gb(new_bytes)} does not fit in {_gb(free + evictable)} "
+                  f"(after eviction, {_gb(reserve)} kept free) "
+                  f"and PLAN_OVERFLOW=refuse")
+    result.update(strategy=strategy, mode=mode, reason=reason)
+
+    # Streamed clips move at the slower of the two; copy and upload overlap in the pipeline.
+    card_rate, upload_rate = result["card_bytes_per_s"], result["upload_bytes_per_s"]
+    result["copy_seconds"] = new_bytes / (min(card_rate, upload_rate) if mode == "stream" else card_rate)
+    result["upload_seconds"] = (new_bytes + result["bytes_backlog"]) / upload_rate
+    result["eta_seconds"] = max(result["copy_seconds"], result["upload_seconds"])
+    result["scan_seconds"] = round(time.monotonic() - started, 2)
+    return result
+
+
+def describe(result):
+    """One line for logs and job output."""
+    return (f"{result['mount']}: {result['strategy']} ({result['reason']}); {result['files_new']} new files, "
+            f"copy ~{result['copy_seconds'] / 60:.0f} min, upload ~{result['upload_seconds'] / 60:.0f} min")
+
+
+if __name__ == "__main__":
+    sd_mount = sys.argv[1] if len(sys.argv) > 1 else config.get_str("SD_MOUNT_PATH", "")
+    local_base = sys.argv[2] if len(sys.argv) > 2 else offload_engine.DEFAULT_LOCAL_BASE
+    if not sd_mount:
+        print("Usage: ./planner.py <SD_MOUNT> [LOCAL_BASE]")
+        sys.exit(1)
+    result = plan(sd_mount, local_base)
+    print(f"Card:       {result['mount']} ({result['camera']}, volume {result['volume_id']})")
+    print(f"New:        {result['files_new']} files, {_gb(result['bytes_new'])} "
+          f"({result['files_skipped']} already offloaded)")
+    print(f"Backlog:    {_gb(result['bytes_backlog'])} waiting to upload")
+    print(f"Free:       {_gb(result['free_bytes'])} ({_gb(result['evictable_bytes'])} evictable, "
+          f"{_gb(result['reserve_bytes'])} kept free)")
+    for key in ("card", "upload"):
+        source = "measured" if result["measured"][key] else "default"
+        print(f"{key.capitalize() + ' rate:':<12}{result[f'{key}_bytes_per_s'] / 1024**2:.1f} MB/s ({source})")
+    print(f"Strategy:   {result['strategy']}, OFFLOAD_MODE={result['mode']} - {result['reason']}")
+    print(f"ETA:        copy {result['copy_seconds'] / 60:.1f} min, upload {result['upload_seconds'] / 60:.1f} min, "
+          f"done in ~{result['eta_seconds'] / 60:.1f} min")
+    sys.exit(1 if result["strategy"] == REFUSE else 0)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# proxies.py
+# Review copies for editors: low-resolution H.264 proxies and JPEG thumbnails
+# of clips, and thumbnails of photos, built with ffmpeg while a card offloads.
+# The pipeline hands over every clip as it lands (the local copy, or the card
+# file for clips that were streamed), the proxies go to footage/proxies/ and a
+# side upload sends them to PROXY_REMOTE_PATH as they finish, so they reach the
+# remote well ahead of the originals. ffmpeg runs niced, single-threaded, in a
+# pool of PROXY_WORKERS; a new run starts only while CPU use and the SoC
+# temperature (the one the status sampler reports) are under PROXY_CPU_BUDGET
+# and PROXY_MAX_TEMP_C, so copying and uploading keep priority.
+# Off unless PROXY_ENABLED=true and ffmpeg is on PATH (apt install ffmpeg).
+#   ./proxies.py [LOCAL_BASE]     build and upload missing proxies for footage/
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import psutil
+
+import config
+import event_bus
+import metrics
+import metrics_sampler
+import offload_engine
+import uploader
+import upload_scheduler
+
+# --- Configuration ---
+ENABLED = config.get_bool("PROXY_ENABLED", False)
+WORKERS = config.get_int("PROXY_WORKERS", 2)
+CPU_BUDGET = config.get_float("PROXY_CPU_BUDGET", 70.0)  # percent of all cores
+MAX_TEMP_C = config.get_float("PROXY_MAX_TEMP_C", 75.0)
+PROXY_HEIGHT = config.get_int("PROXY_HEIGHT", 540)
+PROXY_VIDEO_KBPS = config.get_int("PROXY_VIDEO_KBPS", 1500)
+THUMB_WIDTH = config.get_int("PROXY_THUMB_WIDTH", 480)
+REMOTE_PATH = config.get_str("PROXY_REMOTE_PATH", f"{uploader.RCLONE_BASE_PATH}/proxies")
+PROXY_DIR = "proxies"  # below the local footage base
+NICENESS = 19
+BUDGET_WINDOW_SECONDS = 1.0
+BUDGET_RETRY_SECONDS = 5.0
+THUMB_OFFSET_SECONDS = 1.0
+UPLOAD_GATHER_SECONDS = 10.0  # collect a few proxies per rclone run
+FFMPEG_TIMEOUT = 3600
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mxf")
+# Only formats ffmpeg decodes reliably; RAW files are skipped (shoot RAW+JPEG for thumbnails).
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png")
+PART_SUFFIX = ".part"
+
+logger = logging.getLogger("proxies")
+
+BUILD_SECONDS = metrics.histogram("proxy_build_seconds", "Time to build one proxy or thumbnail.", ("kind",),
+                                  metrics.TRANSFER_BUCKETS)
+BUILT_FILES = metrics.counter("proxy_files_total", "Proxies and thumbnails built.", ("kind", "result"))
+UPLOADED_FILES = metrics.counter("proxy_uploaded_files_total", "Proxies and thumbnails confirmed on the remote.")
+
+
+def enabled():
+    if not ENABLED:
+        return False
+    if shutil.which("ffmpeg") is None:
+        logger.warning("PROXY_ENABLED is set but ffmpeg is not on PATH; no proxies will be built.")
+        return False
+    return True
+
+
+def remote_path():
+    return f"{uploader.RCLONE_REMOTE_NAME}:{REMOTE_PATH}/"
+
+
+def outputs_for(rel_path):
+    """Returns [(kind, proxy rel path)] for a footage/ rel path, [] for files that get no proxy."""
+    stem, ext = os.path.splitext(rel_path)
+    ext = ext.lower()
+    if ext in VIDEO_EXTENSIONS:
+        return [("proxy", f"{stem}.mp4"), ("thumbnail", f"{stem}.jpg")]
+    if ext in PHOTO_EXTENSIONS:
+        return [("thumbnail", f"{stem}.jpg")]
+    return []
+
+
+def _ffmpeg_command(kind, src, dst, offset=THUMB_OFFSET_SECONDS):
+    cmd = ["nice", "-n", str(NICENESS), "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+           "-threads", "1"]
+    if kind == "proxy":
+        return cmd + ["-i", src, "-map", "0:v:0", "-map", "0:a:0?", "-vf", f"scale=-2:{PROXY_HEIGHT}",
+                      "-c:v", "libx264", "-preset", "veryfast", "-b:v", f"{PROXY_VIDEO_KBPS}k",
+                      "-maxrate", f"{PROXY_VIDEO_KBPS * 2}k", "-bufsize", f"{PROXY_VIDEO_KBPS * 2}k",
+                      "-c:a", "aac", "-b:a", "96k", "-ac", "2", "-movflags", "+faststart", "-f", "mp4", dst]
+    if offset and os.path.splitext(src)[1].lower() in VIDEO_EXTENSIONS:
+        cmd += ["-ss", str(offset)]  # before -i: seek by keyframe instead of decoding up to it
+    return cmd + ["-i", src, "-frames:v", "1", "-vf", f"scale={THUMB_WIDTH}:-2", "-q:v", "4", "-f", "image2", dst]
+
+
+def build(kind, src, dst, on_start=None):
+    """Runs ffmpeg for one proxy or thumbnail, writing dst atomically. Raises RuntimeError on failure.
+
+    on_start(process), if given, is called with each ffmpeg Popen so a caller can kill it.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + PART_SUFFIX
+    offsets = (THUMB_OFFSET_SECONDS, 0) if kind == "thumbnail" else (0,)
+    try:
+        for offset in offsets:
+            process = subprocess.Popen(_ffmpeg_command(kind, src, tmp, offset), stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                                       start_new_session=True)
+            if on_start is not None:
+                on_start(process)
+            try:
+                _out, stderr = process.communicate(timeout=FFMPEG_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                raise
+            if process.returncode != 0:
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {stderr.strip()[-200:]}")
+            # A clip shorter than the offset yields no frame; fall back to the first one.
+            if os.path.exists(tmp) and os.path.getsize(tmp) > 0:
+                break
+        else:
+            raise RuntimeError("ffmpeg produced no output")
+        os.replace(tmp, dst)
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"ffmpeg timed out after {FFMPEG_TIMEOUT}s") from e
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class Budget:
+    """Holds new ffmpeg runs back while the Pi is busy or hot."""
+
+    def __init__(self, cpu_percent=CPU_BUDGET, max_temp=MAX_TEMP_C):
+        self.cpu_percent = cpu_percent
+        self.max_temp = max_temp
+
+    @staticmethod
+    def _busy_percent(window):
+        # Measured from cpu_times() rather than psutil.cpu_percent(), whose
+        # shared baseline the status sampler relies on.
+        before = psutil.cpu_times()
+        time.sleep(window)
+        after = psutil.cpu_times()
+        idle = (after.idle - before.idle) + (getattr(after, "iowait", 0) - getattr(before, "iowait", 0))
+        total = sum(after) - sum(before)
+        return 100.0 * (total - idle) / total if total > 0 else 0.0
+
+    def over(self):
+        """Returns why a new run should wait, or None when it may start."""
+        temp = metrics_sampler.cpu_temperature()
+        if temp is not None and temp >= self.max_temp:
+            return f"SoC at {temp:.1f} C"
+        busy = self._busy_percent(BUDGET_WINDOW_SECONDS)
+        if busy > self.cpu_percent:
+            return f"CPU at {busy:.0f}%"
+        return None
+
+    def wait(self, stopped):
+        """Blocks until the budget allows a run. Returns False if stopped is set first."""
+        reported = False
+        while not stopped.is_set():
+            reason = self.over()
+            if reason is None:
+                return True
+            if not reported:
+                logger.info(f"Proxy builds waiting: {reason}.")
+                reported = True
+            stopped.wait(BUDGET_RETRY_SECONDS)
+        return False
+
+
+class ProxyBuilder:
+    """Builds proxies in a budgeted ffmpeg pool and uploads each one as soon as it is ready.
+
+    cancelled, if given, is polled while close() waits; once it returns True,
+    queued builds are dropped and running ffmpegs are killed.
+    """
+
+    def __init__(self, local_base=offload_engine.DEFAULT_LOCAL_BASE, workers=WORKERS, budget=None,
+                 cancelled=None):
+        self.local_base = local_base
+        self.cancelled = cancelled or (lambda: False)
+        self.root = os.path.join(local_base, PROXY_DIR)
+        self.budget = budget or Budget()
+        self.summary = {"built": 0, "skipped": 0, "failed": 0, "uploaded": 0, "errors": []}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="proxy")
+        self._futures = []
+        self._ready = []
+        self._closed = False
+        self._stopped = threading.Event()
+        self._processes = set()
+        self._cond = threading.Condition()
+        self._uploader = threading.Thread(target=self._upload_loop, name="proxy-upload", daemon=True)
+
+    def start(self):
+        self._uploader.start()
+        return self
+
+    def submit(self, result):
+        """Queues proxies for one offload_engine result (a staged or a streamed clip)."""
+        # Streamed clips have no local copy; read them back from the card.
+        src = result["src"] if result.get("streamed") else result["dst"]
+        for kind, rel_path in outputs_for(result["rel_path"]):
+            if os.path.exists(os.path.join(self.root, rel_path)):
+                with self._cond:
+                    self.summary["skipped"] += 1
+                continue
+            self._futures.append(self._pool.submit(self._build, kind, src, rel_path))
+
+    def _build(self, kind, src, rel_path):
+        if not self.budget.wait(self._stopped):
+            return
+        started = time.monotonic()
+        try:
+            build(kind, src, os.path.join(self.root, rel_path), on_start=self._track)
+        except Exception as e:
+            if self._stopped.is_set():
+                return
+            BUILT_FILES.inc(kind=kind, result="error")
+            logger.warning(f"Could not build {kind} for {src}: {e}")
+            with self._cond:
+                self.summary["failed"] += 1
+                self.summary["errors"].append(f"{rel_path}: {e}")
+            return
+        seconds = time.monotonic() - started
+        BUILD_SECONDS.observe(seconds, kind=kind)
+        BUILT_FILES.inc(kind=kind, result="ok")
+        logger.info(f"Built {kind} {rel_path} in {seconds:.1f}s.")
+        event_bus.publish("transfer", event="proxy_built", kind=kind, name=rel_path)
+        with self._cond:
+            self.summary["built"] += 1
+            self._ready.append(rel_path)
+            self._cond.notify()
+
+    def _track(self, process):
+        with self._cond:
+            if self._stopped.is_set():
+                process.kill()
+            self._processes = {p for p in self._processes if p.poll() is None} | {process}
+
+    def _upload_loop(self):
+        # Runs beside the pipeline's uplink turns, like card_stream's rcat:
+        # proxies are a small fraction of the bytes and should not queue
+        # behind a 2 GB batch of originals.
+        while True:
+            with self._cond:
+                while not self._ready and not self._closed:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                if not self._closed:
+                    self._cond.wait(UPLOAD_GATHER_SECONDS)
+                names, self._ready = self._ready, []
+            uploaded = upload(self.root, names)
+            with self._cond:
+                self.summary["uploaded"] += uploaded
+                if uploaded < len(names):
+                    self.summary["errors"].append(f"{len(names) - uploaded} proxies failed to upload")
+
+    def cancel(self):
+        self._stopped.set()
+        for future in self._futures:
+            future.cancel()
+        with self._cond:
+            for process in self._processes:
+                if process.poll() is None:
+                    process.kill()
+
+    def close(self):
+        """Waits for queued builds and the last upload. Returns the summary."""
+        self._pool.shutdown(wait=False)
+        while not self._stopped.is_set():
+            if self.cancelled():
+                self.cancel()
+                break
+            if not wait(self._futures, timeout=1.0).not_done:
+                break
+        self._pool.shutdown(wait=True)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._uploader.is_alive():
+            self._uploader.join()
+        logger.info(f"Proxies: {self.summary['built']} built, {self.summary['skipped']} already present, "
+                    f"{self.summary['failed']} failed, {self.summary['uploaded']} uploaded.")
+        return self.summary
+
+
+def upload(root, names=None):
+    """Copies the named proxies (all of root when None) to the remote.
+
+    Returns how many files the run covered (rclone skips ones already there), 0 if it failed.
+    """
+    args = ["copy", root, remote_path()] + upload_scheduler.rclone_args(remote_control=False)
+    with tempfile.NamedTemporaryFile("w", prefix="proxies_", suffix=".txt") as list_file:
+        if names is not None:
+            # The list names finished proxies only; rclone refuses --exclude next to --files-from-raw.
+            list_file.write("\n".join(names) + "\n")
+            list_file.flush()
+            args += ["--files-from-raw", list_file.name, "--no-traverse"]
+        else:
+            args += ["--exclude", f"*{PART_SUFFIX}"]
+        logger.info(f"Uploading {len(names) if names is not None else 'all'} proxies to {remote_path()}")
+        try:
+            exit_code = uploader.run_rclone(args)
+        except FileNotFoundError:
+            logger.error("rclone command not found in PATH.")
+            return 0
+    if exit_code != 0:
+        logger.error(f"Proxy upload failed (exit code {exit_code}); the next run of ./proxies.py retries it.")
+        return 0
+    count = len(names) if names is not None else sum(1 for _d, _s, files in os.walk(root) for name in files
+                                                       if not name.endswith(PART_SUFFIX))
+    UPLOADED_FILES.inc(count)
+    return count
+
+
+def backfill(local_base=offload_engine.DEFAULT_LOCAL_BASE):
+    """Builds proxies missing for anything in local_base, then uploads the whole proxy tree."""
+    builder = ProxyBuilder(local_base)
+    for category, _rel_path in offload_engine.SOURCES:
+        category_root = os.path.join(local_base, category)
+        for dirpath, _dirnames, filenames in os.walk(category_root):
+            for name in filenames:
+                if name.startswith(".") or name.endswith(offload_engine.PART_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, name)
+                builder.submit({"src": path, "dst": path, "rel_path": os.path.relpath(path, local_base)})
+    summary = builder.close()
+    if os.path.isdir(builder.root):
+        summary["uploaded"] = upload(builder.root)
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg not found in PATH.")
+        sys.exit(1)
+    result = backfill(sys.argv[1] if len(sys.argv) > 1 else offload_engine.DEFAULT_LOCAL_BASE)
+    sys.exit(1 if result["errors"] else 0)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# remote_cache.py
+# What is already on the remote, kept in the offload index's remote_objects table.
+# Every upload the offloader confirms (rclone copy, bundles, streamed clips) is
+# recorded as it happens, and the whole tree is re-listed once every
+# REMOTE_RECONCILE_HOURS with one recursive `rclone lsjson --fast-list` per
+# folder, which also drops objects deleted on the remote. uploader.py skips
+# pending clips the cache lists as the same file, compared the way `rclone
+# check` does: size, then the md5 where both sides have one, else the modtime.
+# Re-sent batches cost no remote lookups at all. The connectivity probe is `rclone about`
+# (a single quota call, not a listing), cached for REMOTE_HEALTH_TTL seconds.
+# Eviction still checks every clip against the remote itself before deleting it.
+#   ./remote_cache.py status       cached objects and when each folder was last listed
+#   ./remote_cache.py reconcile    re-list the remote now
+#   ./remote_cache.py health       run the connectivity check
+
+import re
+import sys
+import json
+import time
+import calendar
+import logging
+import threading
+import subprocess
+
+import bundler
+import config
+import metrics
+import offload_index
+
+# --- Configuration ---
+RECONCILE_SECONDS = config.get_float("REMOTE_RECONCILE_HOURS", 24) * 3600  # 0 = only on demand
+HEALTH_TTL = config.get_float("REMOTE_HEALTH_TTL", 60)
+PREFIXES = ("videos", "photos", bundler.BUNDLE_DIR)  # folders below RCLONE_BASE_PATH
+MODTIME_WINDOW = 1.0  # seconds; Drive keeps modtimes to the millisecond
+RCLONE_EXIT_DIR_NOT_FOUND = 3
+_rclone = config.rclone_settings()
+
+REMOTE_FREE_BYTES = metrics.gauge("remote_free_bytes", "Free space on the remote, from rclone about.")
+CACHED_OBJECTS = metrics.gauge("remote_cache_objects", "Objects listed in the remote cache.")
+LISTING_SECONDS = metrics.histogram("remote_listing_seconds", "Duration of one full remote listing.",
+                                    ("prefix",), metrics.TRANSFER_BUCKETS)
+
+logger = logging.getLogger("remote_cache")
+
+_health_lock = threading.Lock()
+_health = {"ok": None, "checked_at": 0.0}
+
+
+class ListingError(Exception):
+    pass
+
+
+def _remote(prefix=""):
+    return f"{_rclone['remote_name']}:{_rclone['base_path']}/{prefix}"
+
+
+# --- Modtimes ---
+def _rfc3339(mtime_ns):
+    """mtime_ns in rclone's ModTime format (UTC, nanoseconds)."""
+    seconds, nanos = divmod(mtime_ns, 10**9)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + f".{nanos:09d}Z"
+
+
+def _epoch(modtime):
+    """Seconds since the epoch for an rclone ModTime, or None if there is none."""
+    match = re.match(r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$", modtime or "")
+    if not match:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
+    zone = match.group(3)
+    if zone != "Z":
+        offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+        seconds -= offset if zone[0] == "+" else -offset
+    return seconds + float(match.group(2) or 0)
+
+
+# --- Recording ---
+def clip_object(path, row):
+    """The record() entry for a clip uploaded by `rclone copy`, which keeps its modtime."""
+    return path, row["size"], row["mtime_ns"], row["digest"] if row["algo"] == "md5" else None
+
+
+def record(conn, objects, source="upload", commit=True):
+    """Marks objects as present.
+
+    objects holds (path below RCLONE_BASE_PATH, size, mtime_ns, md5) tuples;
+    mtime_ns and md5 are None where the remote copy has no known modtime or md5.
+    """
+    now = time.time()
+    conn.executemany("INSERT OR REPLACE INTO remote_objects (path, size, md5, modified, source, seen_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?)",
+                     [(path, size, md5, _rfc3339(mtime_ns) if mtime_ns is not None else None, source, now)
+                      for path, size, mtime_ns, md5 in objects])
+    if commit:
+        conn.commit()
+
+
+def forget(conn, paths):
+    """Drops objects that turned out to be missing or different on the remote."""
+    conn.executemany("DELETE FROM remote_objects WHERE path = ?", [(path,) for path in paths])
+    conn.commit()
+
+
+def _same_file(cached, row):
+    if cached["size"] != row["size"]:
+        return False
+    if cached["md5"] and row["algo"] == "md5" and row["digest"]:
+        return cached["md5"] == row["digest"]
+    modified = _epoch(cached["modified"])
+    return modified is not None and abs(modified - row["mtime_ns"] / 1e9) <= MODTIME_WINDOW
+
+
+def present(conn, rows):
+    """The clip rows whose remote copy the cache lists as the same file.
+
+    Same size, and the same md5 when both sides have one, else the same modtime.
+    An object with neither recorded does not count; rclone copy checks it instead.
+    """
+    found = []
+    for row in rows:
+        cached = conn.execute("SELECT size, md5, modified FROM remote_objects WHERE path = ?",
+                              (row["local_path"],)).fetchone()
+        if cached is not None and _same_file(cached, row):
+            found.append(row)
+    return found
+
+
+# --- Reconciling ---
+def list_remote(prefix):
+    """Full recursive listing of one folder: [{"Path", "Size", "ModTime", "Hashes"}], empty if it is absent."""
+    started = time.monotonic()
+    try:
+        result = subprocess.run(["rclone", "lsjson", "-R", "--files-only", "--fast-list", "--hash",
+                                 "--no-mimetype", _remote(prefix), "--config", _rclone["config_path"]],
+                                capture_output=True, text=True, timeout=3600)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise ListingError(f"rclone lsjson failed: {e}") from e
+    LISTING_SECONDS.observe(time.monotonic() - started, prefix=prefix)
+    if result.returncode == RCLONE_EXIT_DIR_NOT_FOUND:
+        return []
+    if result.returncode != 0:
+        raise ListingError(f"rclone lsjson exited with code {result.returncode}: {result.stderr.strip()[-200:]}")
+    try:
+        return json.loads(result.stdout)
+    except ValueError as e:
+        raise ListingError(f"Unreadable rclone lsjson output: {e}") from e
+
+
+def reconcile(conn, prefixes=PREFIXES):
+    """Replaces the cache for each prefix with a fresh listing. Returns {prefix: objects listed}."""
+    counts = {}
+    for prefix in prefixes:
+        started = time.time()
+        entries = list_remote(prefix)
+        # Uploads recorded while the listing ran are newer than started and stay.
+        conn.execute("DELETE FROM remote_objects WHERE path LIKE ? AND seen_at < ?", (f"{prefix}/%", started))
+        conn.executemany(
+            "INSERT OR REPLACE INTO remote_objects (path, size, md5, modified, source, seen_at) "
+            "VALUES (?, ?, ?, ?, 'listing', ?)",
+            [(f"{prefix}/{e['Path']}", e["Size"], (e.get("Hashes") or {}).get("md5"), e.get("ModTime"), started)
+             for e in entries])
+        conn.execute("INSERT OR REPLACE INTO remote_listings (prefix, listed_at, objects, seconds) "
+                     "VALUES (?, ?, ?, ?)", (prefix, started, len(entries), time.time() - started))
+        conn.commit()
+        counts[prefix] = len(entries)
+        logger.info(f"Listed {len(entries)} objects in {_remote(prefix)} ({time.time() - started:.1f}s).")
+    CACHED_OBJECTS.set(conn.execute("SELECT COUNT(*) FROM remote_objects").fetchone()[0])
+    return counts
+
+
+def due(conn, now=None):
+    """Prefixes whose last full listing is older than RECONCILE_SECONDS (or that were never listed)."""
+    if RECONCILE_SECONDS <= 0:
+        return []
+    listed = {row["prefix"]: row["listed_at"] for row in conn.execute("SELECT prefix, listed_at FROM remote_listings")}
+    now = now or time.time()
+    return [prefix for prefix in PREFIXES if now - listed.get(prefix, 0) >= RECONCILE_SECONDS]
+
+
+def reconcile_if_due(conn):
+    """Re-lists the folders that are due. A failed listing is logged; the cache stays as it was."""
+    prefixes = due(conn)
+    if not prefixes:
+        return {}
+    try:
+        return reconcile(conn, prefixes)
+    except ListingError as e:
+        logger.warning(f"Remote cache not reconciled: {e}")
+        return {}
+
+
+# --- Health ---
+def health(force=False):
+    """Connectivity check via `rclone about`; the result is reused for HEALTH_TTL seconds.
+
+    Returns {"ok", "free", "used", "total", "error", "checked_at"}.
+    """
+    with _health_lock:
+        if not force and _health["ok"] is not None and time.time() - _health["checked_at"] < HEALTH_TTL:
+            return dict(_health)
+        state = {"ok": False, "free": None, "used": None, "total": None, "error": None, "checked_at": time.time()}
+        try:
+            result = subprocess.run(["rclone", "about", "--json", f"{_rclone['remote_name']}:",
+                                     "--config", _rclone["config_path"]], capture_output=True, text=True, timeout=60)
+            if result.returncode == 0:
+                about = json.loads(result.stdout or "{}")
+                state.update(ok=True, free=about.get("free"), used=about.get("used"), total=about.get("total"))
+                if state["free"] is not None:
+                    REMOTE_FREE_BYTES.set(state["free"])
+            else:
+                state["error"] = f"rclone about exited with code {result.returncode}: {result.stderr.strip()[-200:]}"
+        except FileNotFoundError:
+            state["error"] = "rclone command not found in PATH"
+        except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+            state["error"] = f"rclone about failed: {e}"
+        if state["error"]:
+            logger.error(f"Remote '{_rclone['remote_name']}:' is not reachable: {state['error']}")
+        _health.clear()
+        _health.update(state)
+        return dict(state)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "health":
+        state = health(force=True)
+        if state["ok"] and state["free"] is not None:
+            print(f"OK, {state['free'] / 1024**3:.1f} GB free")
+        else:
+            print("OK" if state["ok"] else f"Error: {state['error']}")
+        sys.exit(0 if state["ok"] else 1)
+    conn = offload_index.connect()
+    try:
+        if command == "reconcile":
+            for prefix, count in reconcile(conn).items():
+                print(f"{prefix}: {count} objects")
+        elif command == "status":
+            for row in conn.execute("SELECT source, COUNT(*) AS n, COALESCE(SUM(size), 0) AS bytes "
+                                    "FROM remote_objects GROUP BY source ORDER BY source"):
+                print(f"{row['source']}: {row['n']} objects, {row['bytes'] / 1024**3:.1f} GB")
+            listed = {row["prefix"]: row for row in conn.execute("SELECT * FROM remote_listings")}
+            for prefix in PREFIXES:
+                row = listed.get(prefix)
+                when = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["listed_at"])) if row else "never"
+                print(f"{prefix}/ last listed: {when}")
+        else:
+            print("Usage: ./remote_cache.py status | reconcile | health")
+            sys.exit(1)
+    except ListingError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
@@ -1,19 +1,36 @@
 #!/bin/bash
 # retry_offload.sh
-# Placeholder script to retry failed offload/upload tasks.
+# Re-sends uploads that failed in earlier runs. Only files in the retry queue
+# (see retry_queue.py) whose backoff has elapsed are sent, so a few failed clips
+# never cost a full rescan of footage/ or the remote. Cron runs this
+# periodically; pass --force to ignore the backoff.
 
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
 LOG_FILE="${SCRIPT_DIR}/logs/retry.log"
+LOG_SOURCE="retry_offload.sh"
+source "${SCRIPT_DIR}/log_common.sh"
 
-echo "$(date): Retry script triggered." >> "${LOG_FILE}"
+log_msg INFO "Retry script triggered."
 
-# --- Add Your Retry Logic Here ---
-# Example: Could re-run the main upload script
-# echo "$(date): Re-running upload_and_cleanup.sh..." >> "${LOG_FILE}"
-# bash "${SCRIPT_DIR}/upload_and_cleanup.sh"
+# Shares the uplink lock with upload_and_cleanup.sh and the web UI's jobs.
+if [ "${OFFLOAD_LOCK_HELD:-0}" != "1" ]; then
+  exec 9>"${SCRIPT_DIR}/logs/.lock-uplink"
+  if ! flock -n 9; then
+    log_msg INFO "An upload is already using the uplink; its failures will be retried next time."
+    exit 0
+  fi
+fi
 
-# Example: Check rclone logs for errors and retry specific files/folders
-# (This requires more complex log parsing)
+if ! command -v rclone &> /dev/null; then
+  log_msg ERROR "rclone command not found in PATH. Exiting."
+  exit 1
+fi
 
-echo "$(date): Retry logic placeholder - no action taken." >> "${LOG_FILE}"
-exit 0
\ No newline at end of file
+"${PYTHON_BIN}" "${SCRIPT_DIR}/uploader.py" retry "$@" >&7 2>&1
+EXIT_CODE=$?
+if [ ${EXIT_CODE} -eq 0 ]; then
+  log_msg INFO "Retry pass finished."
+else
+  log_msg ERROR "Retry pass finished with errors; failed files stay queued with a longer backoff."
+fi
+exit ${EXIT_CODE}
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# retry_queue.py
+# Persistent queue of uploads that failed, kept in the offload index's
+# failed_transfers table. uploader.py adds a file when rclone reports an error
+# for it (or the run ends without confirming it) and removes it once rclone
+# confirms the copy. Each failure pushes the next attempt back exponentially,
+# with jitter so a flaky uplink does not see every file retried at once.
+# `uploader.py retry` (retry_offload.sh, the web UI's Retry button) drains it.
+#   ./retry_queue.py list       show queued files and when each is next due
+#   ./retry_queue.py clear      forget every queued failure
+
+import sys
+import time
+import random
+
+import config
+import metrics
+import offload_index
+
+# --- Configuration ---
+BASE_DELAY = config.get_int("RETRY_BASE_SECONDS", 60)
+MAX_DELAY = config.get_int("RETRY_MAX_SECONDS", 6 * 3600)
+MAX_ATTEMPTS = config.get_int("RETRY_MAX_ATTEMPTS", 10)
+JITTER = 0.5  # each delay is scaled by a random factor in [1 - JITTER, 1 + JITTER]
+
+FAILURES = metrics.counter("upload_failures_total", "Failed upload attempts queued for retry.", ("category",))
+
+
+def backoff(attempts):
+    """Seconds to wait after the given number of failed attempts."""
+    delay = min(MAX_DELAY, BASE_DELAY * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def record_failure(conn, local_path, category, error, now=None):
+    """Queues local_path (relative to footage/) for retry, or pushes back its next attempt."""
+    now = now or time.time()
+    row = conn.execute("SELECT attempts FROM failed_transfers WHERE local_path = ?", (local_path,)).fetchone()
+    attempts = (row["attempts"] if row else 0) + 1
+    conn.execute(
+        "INSERT INTO failed_transfers (local_path, category, attempts, last_error, first_failed_at, "
+        "next_attempt_at) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (local_path) DO UPDATE SET "
+        "attempts = excluded.attempts, last_error = excluded.last_error, "
+        "next_attempt_at = excluded.next_attempt_at",
+        (local_path, category, attempts, error, now, now + backoff(attempts)))
+    conn.commit()
+    FAILURES.inc(category=category)
+    return attempts
+
+
+def clear(conn, local_paths):
+    conn.executemany("DELETE FROM failed_transfers WHERE local_path = ?", [(p,) for p in local_paths])
+    conn.commit()
+
+
+def due(conn, now=None, force=False):
+    """Returns queued files ready for another attempt, joined with their index rows.
+
+    force ignores the backoff and the attempt cap (a manual retry). Files
+    already uploaded by another path are dropped from the queue here.
+    """
+    now = now or time.time()
+    # Several clips rows can share a local_path (an import-local row and a card's
+    # row); join one row per path, pending only while none of them is uploaded.
+    # Size, modtime and hash come from the newest row (SQLite's bare columns with a lone MAX).
+    sql = ("SELECT f.*, c.size, c.mtime_ns, c.algo, c.digest, c.pending FROM failed_transfers f "
+           "LEFT JOIN (SELECT local_path, size, mtime_ns, algo, digest, MAX(updated_at), "
+           "SUM(state NOT IN (?, ?)) = 0 AS pending FROM clips GROUP BY local_path) c ON c.local_path = f.local_path")
+    args = [offload_index.STATE_COPIED, offload_index.STATE_VERIFIED]
+    if not force:
+        sql += " WHERE f.next_attempt_at <= ? AND f.attempts < ?"
+        args += [now, MAX_ATTEMPTS]
+    rows = conn.execute(sql + " ORDER BY f.next_attempt_at", args).fetchall()
+    done = [row["local_path"] for row in rows if not row["pending"]]
+    if done:
+        clear(conn, done)
+    return [row for row in rows if row["pending"]]
+
+
+def entries(conn):
+    return conn.execute("SELECT * FROM failed_transfers ORDER BY next_attempt_at").fetchall()
+
+
+def summary(conn):
+    """Counts for the dashboard: queued files, how many are due now, how many hit the attempt cap."""
+    now = time.time()
+    row = conn.execute(
+        "SELECT COUNT(*) AS queued, SUM(next_attempt_at <= ? AND attempts < ?) AS due, "
+        "SUM(attempts >= ?) AS exhausted FROM failed_transfers", (now, MAX_ATTEMPTS, MAX_ATTEMPTS)).fetchone()
+    return {"queued": row["queued"], "due": row["due"] or 0, "exhausted": row["exhausted"] or 0}
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    conn = offload_index.connect()
+    if command == "list":
+        now = time.time()
+        for row in entries(conn):
+            wait = max(0, int(row["next_attempt_at"] - now))
+            print(f"{row['local_path']}\tattempts={row['attempts']}\tdue in {wait}s\t{row['last_error'] or ''}")
+    elif command == "clear":
+        count = conn.execute("DELETE FROM failed_transfers").rowcount
+        conn.commit()
+        print(f"Cleared {count} queued failures.")
+    else:
+        print("Usage: ./retry_queue.py list | clear")
+        sys.exit(1)
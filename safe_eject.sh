@@ -1,43 +1,49 @@
 #!/bin/bash
 # safe_eject.sh
-# Placeholder script for safely unmounting and/or powering off the SD card reader/port.
+# Safely unmounts the SD card. card_watcher.py runs it once an offload is
+# verified; the web UI's Eject button runs it too.
+#   ./safe_eject.sh [MOUNT]    defaults to $SD_MOUNT_PATH
 
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
 LOG_FILE="${SCRIPT_DIR}/logs/eject.log"
+LOG_SOURCE="safe_eject.sh"
 PROJECT_USER="zmakey"
-SD_MOUNT="/media/${PROJECT_USER}/SDCARD" # Must match the mount point used
+SD_MOUNT="${1:-${SD_MOUNT_PATH:-/media/${PROJECT_USER}/SDCARD}}"
 
-echo "$(date): Safe eject script triggered." >> "${LOG_FILE}"
+source "${SCRIPT_DIR}/log_common.sh"
+
+log_msg INFO "Safe eject script triggered."
 
 # --- Add SD card unmounting/ejection logic here ---
 
 # 1. Check if mounted
 if mountpoint -q "$SD_MOUNT"; then
-  echo "$(date): SD card is mounted at ${SD_MOUNT}. Attempting unmount..." >> "${LOG_FILE}"
+  log_msg INFO "SD card is mounted at ${SD_MOUNT}. Attempting unmount..."
+  sync
   # Try unmounting using udisksctl (preferred, handles underlying device)
-  udisksctl unmount -b "$(findmnt -n -o SOURCE --target "$SD_MOUNT")" >> "${LOG_FILE}" 2>&1
+  udisksctl unmount -b "$(findmnt -n -o SOURCE --target "$SD_MOUNT")" >&7 2>&1
   UMOUNT_EXIT_CODE=$?
 
   if [ $UMOUNT_EXIT_CODE -eq 0 ]; then
-    echo "$(date): Unmount successful via udisksctl." >> "${LOG_FILE}"
+    log_msg INFO "Unmount successful via udisksctl."
     # Optional: Power off the drive/port if possible (requires hardware support and tools like uhubctl)
-    # echo "$(date): Attempting to power off USB port (example)..." >> "${LOG_FILE}"
-    # uhubctl -l <location> -a off >> "${LOG_FILE}" 2>&1
+    # log_msg INFO "Attempting to power off USB port (example)..."
+    # uhubctl -l <location> -a off >&7 2>&1
   else
-    echo "$(date): udisksctl unmount failed (Code: ${UMOUNT_EXIT_CODE}). Trying umount command..." >> "${LOG_FILE}"
+    log_msg WARN "udisksctl unmount failed (Code: ${UMOUNT_EXIT_CODE}). Trying umount command..."
     # Fallback to basic umount (might leave device busy)
-    umount "$SD_MOUNT" >> "${LOG_FILE}" 2>&1
+    umount "$SD_MOUNT" >&7 2>&1
     UMOUNT_EXIT_CODE=$?
     if [ $UMOUNT_EXIT_CODE -eq 0 ]; then
-        echo "$(date): Unmount successful via umount command." >> "${LOG_FILE}"
+        log_msg INFO "Unmount successful via umount command."
     else
-         echo "$(date): Error: Failed to unmount ${SD_MOUNT} (Code: ${UMOUNT_EXIT_CODE}). It might be busy." >> "${LOG_FILE}"
+         log_msg ERROR "Failed to unmount ${SD_MOUNT} (Code: ${UMOUNT_EXIT_CODE}). It might be busy."
          exit 1
     fi
   fi
 else
-  echo "$(date): SD card not currently mounted at ${SD_MOUNT}. No action taken." >> "${LOG_FILE}"
+  log_msg INFO "SD card not currently mounted at ${SD_MOUNT}. No action taken."
 fi
 
-echo "$(date): Eject process finished." >> "${LOG_FILE}"
+log_msg INFO "Eject process finished."
 exit 0
\ No newline at end of file
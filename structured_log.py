@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# structured_log.py
+# Shared JSON-lines logging for the offloader's logs/ directory.
+# Records are buffered and appended in one write per flush; a log that grows
+# past LOG_MAX_MB is renamed to a timestamped segment, older segments are
+# gzipped, and <log>.segments.json indexes every segment's time range so the
+# UI can jump to a time without scanning everything.
+#   ./structured_log.py pipe <log file> [--source NAME] [--tee]   log stdin lines
+#   ./structured_log.py range <log file> <start epoch> [<end epoch>]
+
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import fcntl
+import atexit
+import logging
+import threading
+
+import config
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(BASE_DIR, "logs")
+MAX_BYTES = config.get_int("LOG_MAX_MB", 10) * 1024 * 1024
+KEEP_SEGMENTS = config.get_int("LOG_KEEP_SEGMENTS", 5)
+FLUSH_INTERVAL = 1.0
+BUFFER_BYTES = 64 * 1024
+RANGE_LIMIT = 2000
+
+# "[2024-01-01 12:00:00] [LEVEL] message", as written by log_msg and logging.Formatter.
+_PREFIXED_LINE = re.compile(r"^\[[^\]]+\] \[(\w+)\] (.*)$")
+_FLUSH_NOW_LEVELS = ("ERROR", "CRITICAL")
+
+
+def segment_index_path(path):
+    return path + ".segments.json"
+
+
+def load_segments(path):
+    """Returns the rotated segments of path, oldest first: [{file, start, end, bytes}]."""
+    try:
+        with open(segment_index_path(path), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _save_segments(path, segments):
+    tmp = segment_index_path(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(segments, f, indent=1)
+    os.replace(tmp, segment_index_path(path))
+
+
+def _first_ts(path):
+    try:
+        with open(path, "rb") as f:
+            return json.loads(f.readline()).get("ts")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _last_ts(path):
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(0, size - 65536))
+            lines = f.read().rstrip(b"\n").split(b"\n")
+        return json.loads(lines[-1]).get("ts")
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+def _compress(path):
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+        while True:
+            chunk = src.read(1024 * 1024)
+            if not chunk:
+                break
+            dst.write(chunk)
+    os.unlink(path)
+    return path + ".gz"
+
+
+class LogWriter:
+    """Buffered JSON-lines appender for one log file, safe across processes.
+
+    Each flush is a single O_APPEND write of whole lines, so writers in other
+    processes (shell pipes, the web app) interleave by record, never mid-line.
+    """
+
+    def __init__(self, path, max_bytes=MAX_BYTES, keep=KEEP_SEGMENTS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self._buffer = []
+        self._buffered = 0
+        self._fd = None
+        self._inode = None
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def write(self, level, msg, source=None, ts=None, **fields):
+        record = {"ts": round(ts if ts is not None else time.time(), 3), "level": level}
+        if source:
+            record["source"] = source
+        record["msg"] = msg
+        record.update(fields)
+        line = (json.dumps(record, default=str) + "\n").encode("utf-8")
+        with self._lock:
+            self._buffer.append(line)
+            self._buffered += len(line)
+            if (self._buffered >= BUFFER_BYTES or level in _FLUSH_NOW_LEVELS
+                    or time.monotonic() - self._last_flush >= FLUSH_INTERVAL):
+                self.flush()
+            elif self._timer is None:
+                # Make sure a quiet writer still lands its last lines within a second.
+                self._timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._last_flush = time.monotonic()
+            if not self._buffer:
+                return
+            data = b"".join(self._buffer)
+            self._buffer, self._buffered = [], 0
+            try:
+                self._ensure_open()
+                os.write(self._fd, data)
+                if os.fstat(self._fd).st_size >= self.max_bytes:
+                    self._rotate()
+            except OSError as e:
+                print(f"structured_log: cannot write {self.path}: {e}", file=sys.stderr)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _ensure_open(self):
+        # Another process may have rotated the file since our last write.
+        try:
+            current = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            current = None
+        if self._fd is not None and current == self._inode:
+            return
+        if self._fd is not None:
+            os.close(self._fd)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+
+    def _rotate(self):
+        lock_path = os.path.join(os.path.dirname(self.path), f".rotate-{os.path.basename(self.path)}")
+        with open(lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            st = os.stat(self.path)
+            if st.st_ino != self._inode or st.st_size < self.max_bytes:
+                return  # someone else rotated first
+            now = time.time()
+            start = _first_ts(self.path) or now
+            segment = f"{self.path}.{time.strftime('%Y%m%dT%H%M%S', time.localtime(start))}"
+            if os.path.exists(segment) or os.path.exists(segment + ".gz"):
+                segment += f"-{int(now)}"
+            os.rename(self.path, segment)
+            self._ensure_open()
+            segments = load_segments(self.path)
+            # The segment just rotated stays plain until the next rotation, so a
+            # writer that has not yet noticed the rename does not lose records.
+            for entry in segments:
+                full = os.path.join(os.path.dirname(self.path), entry["file"])
+                if not entry["file"].endswith(".gz") and os.path.exists(full):
+                    entry["file"] = os.path.basename(_compress(full))
+            segments.append({"file": os.path.basename(segment), "start": start, "end": _last_ts(segment) or now,
+                             "bytes": st.st_size})
+            while len(segments) > self.keep:
+                old = segments.pop(0)
+                try:
+                    os.unlink(os.path.join(os.path.dirname(self.path), old["file"]))
+                except FileNotFoundError:
+                    pass
+            _save_segments(self.path, segments)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path):
+    """Returns the process-wide writer for path."""
+    path = os.path.abspath(path)
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = _writers[path] = LogWriter(path)
+        return writer
+
+
+@atexit.register
+def flush_all():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.flush()
+
+
+class JsonLinesHandler(logging.Handler):
+    """logging handler that writes records through the shared LogWriter for path."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.writer = get_writer(path)
+
+    def emit(self, record):
+        try:
+            msg = record.getMessage()
+            if record.exc_info:
+                msg += "\n" + logging.Formatter().formatException(record.exc_info)
+            self.writer.write(record.levelname, msg, source=record.name, ts=record.created)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.writer.flush()
+
+
+# --- Reading ---
+def format_record(line):
+    """Renders one JSON-lines record as "[time] [LEVEL] source: msg"; other lines pass through."""
+    try:
+        record = json.loads(line)
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["ts"]))
+        source = f"{record['source']}: " if record.get("source") else ""
+        return f"[{stamp}] [{record.get('level', 'INFO')}] {source}{record.get('msg', '')}"
+    except (ValueError, KeyError, TypeError):
+        return line
+
+
+def format_text(text):
+    """format_record applied to every line of text, keeping a trailing partial line as is."""
+    if not text:
+        return text
+    lines = text.split("\n")
+    formatted = [format_record(line) if line else line for line in lines[:-1]]
+    return "\n".join(formatted + [lines[-1]])
+
+
+def _open_segment(path):
+    return gzip.open(path, "rt", errors="replace") if path.endswith(".gz") else open(path, "r", errors="replace")
+
+
+def read_range(path, start, end=None, limit=RANGE_LIMIT):
+    """Returns up to limit raw record lines of path (segments included) with start <= ts <= end."""
+    end = end if end is not None else time.time()
+    directory = os.path.dirname(path)
+    files = [os.path.join(directory, s["file"]) for s in load_segments(path)
+             if s["end"] >= start and s["start"] <= end]
+    files.append(path)
+    lines = []
+    for name in files:
+        try:
+            with _open_segment(name) as f:
+                for line in f:
+                    try:
+                        ts = json.loads(line)["ts"]
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    if ts > end:
+                        break
+                    if ts >= start:
+                        lines.append(line.rstrip("\n"))
+                        if len(lines) >= limit:
+                            return lines
+        except OSError:
+            continue
+    return lines
+
+
+def pipe(path, source=None, tee=False):
+    """Logs every stdin line to path until EOF; "[ts] [LEVEL] msg" prefixes set the level."""
+    writer = get_writer(path)
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if tee:
+            print(line, flush=True)
+        if not line:
+            continue
+        match = _PREFIXED_LINE.match(line)
+        level, msg = (match.group(1).upper(), match.group(2)) if match else ("INFO", line)
+        writer.write(level, msg, source=source)
+    writer.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) >= 2 and args[0] == "pipe":
+        source = args[args.index("--source") + 1] if "--source" in args else None
+        pipe(args[1], source=source, tee="--tee" in args)
+    elif len(args) >= 3 and args[0] == "range":
+        for line in read_range(args[1], float(args[2]), float(args[3]) if len(args) > 3 else None):
+            print(format_record(line))
+    else:
+        print("Usage: ./structured_log.py pipe <log file> [--source NAME] [--tee] | "
+              "range <log file> <start epoch> [<end epoch>]")
+        sys.exit(1)
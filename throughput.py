@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# throughput.py
+# Measured transfer rates, kept in the offload index's throughput table.
+# offload_engine records every card read and uploader every upload run;
+# planner.py turns the most recent ones into copy and upload estimates.
+# Runs under MIN_BYTES are skipped: their time is mostly process startup.
+#   ./throughput.py      print the recent card-read and upload rates
+
+import time
+
+import config
+import offload_index
+
+# --- Configuration ---
+WINDOW = config.get_int("THROUGHPUT_WINDOW", 20)  # runs averaged per estimate
+KEEP = 200  # runs kept per kind
+MIN_BYTES = 16 * 1024 * 1024
+
+CARD_READ = "card_read"
+UPLOAD = "upload"
+KINDS = (CARD_READ, UPLOAD)
+
+
+def record(conn, kind, nbytes, seconds, now=None):
+    """Stores one measured run; old runs beyond KEEP are pruned."""
+    if nbytes < MIN_BYTES or seconds <= 0:
+        return
+    conn.execute("INSERT INTO throughput (kind, bytes, seconds, finished_at) VALUES (?, ?, ?, ?)",
+                 (kind, nbytes, seconds, now or time.time()))
+    conn.execute("DELETE FROM throughput WHERE kind = ? AND rowid NOT IN "
+                 "(SELECT rowid FROM throughput WHERE kind = ? ORDER BY finished_at DESC LIMIT ?)",
+                 (kind, kind, KEEP))
+    conn.commit()
+
+
+def rate(conn, kind, window=WINDOW):
+    """Bytes per second over the last window runs, weighted by size; None with no history."""
+    row = conn.execute("SELECT SUM(bytes) AS bytes, SUM(seconds) AS seconds, COUNT(*) AS runs FROM "
+                       "(SELECT bytes, seconds FROM throughput WHERE kind = ? ORDER BY finished_at DESC LIMIT ?)",
+                       (kind, window)).fetchone()
+    if not row["runs"] or not row["seconds"]:
+        return None
+    return row["bytes"] / row["seconds"]
+
+
+if __name__ == "__main__":
+    conn = offload_index.connect()
+    for kind in KINDS:
+        measured = rate(conn, kind)
+        print(f"{kind}: {measured / 1024**2:.1f} MB/s" if measured else f"{kind}: no history")
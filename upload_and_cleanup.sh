@@ -18,8 +18,12 @@ else
 fi
 
 PROJECT_USER="zmakey"
+PROJECT_DIR="/home/zmakey/sdtransfer-offloader"
+PYTHON_BIN="${PROJECT_DIR}/venv/bin/python3"
+[ -x "${PYTHON_BIN}" ] || PYTHON_BIN="python3"
 VIDEO_REL_PATH="PRIVATE/M4ROOT/CLIP"
 PHOTO_REL_PATH="DCIM/100MSDCF"
+export VIDEO_REL_PATH PHOTO_REL_PATH
 
 LOCAL_BASE="/home/zmakey/sdtransfer-offloader/footage"
 LOCAL_VIDEO="${LOCAL_BASE}/videos"
@@ -41,23 +45,6 @@ fi
 touch "${LOG_DIR}/.writetest" && rm "${LOG_DIR}/.writetest"
 echo "[INFO] Log directory check passed."
 
-# Define rclone options as a Bash array.
-RCLONE_OPTS=(
-    "--config" "${RCLONE_CONFIG}"
-    "--log-level" "INFO"
-    "--log-file" "${RCLONE_LOG}"
-    "--min-age" "1m"
-    "--fast-list"
-    "--transfers" "4"
-    "--checkers" "8"
-    "--contimeout" "60s"
-    "--timeout" "300s"
-    "--retries" "3"
-    "--low-level-retries" "10"
-    "--stats" "1m"
-    "--drive-chunk-size" "128M"
-)
-
 echo "[INFO] Configuration:"
 echo "  SD_MOUNT: ${SD_MOUNT}"
 echo "  VIDEO_REL_PATH: ${VIDEO_REL_PATH}"
@@ -67,22 +54,27 @@ echo "  LOCAL_PHOTO: ${LOCAL_PHOTO}"
 echo "  RCLONE_CONFIG: ${RCLONE_CONFIG}"
 echo "  RCLONE_LOG: ${RCLONE_LOG}"
 
-# Logging function
-log_msg() {
-    local level="$1"
-    local message="$2"
-    local timestamp
-    timestamp=$(date '+%Y-%m-%d %H:%M:%S')
-    local log_line="[${timestamp}] [${level}] ${message}"
-    echo "${log_line}" >> "${RCLONE_LOG}"
-    if [[ "$level" == "ERROR" ]]; then
-        echo "${log_line}" >&2
-    else
-        echo "${log_line}"
-    fi
-}
+# Everything logged below goes to upload.log through log_common.sh's writer (fd 7),
+# and to the console (cron_upload.log when cron runs it).
+LOG_FILE="${RCLONE_LOG}"
+LOG_SOURCE="upload_and_cleanup"
+LOG_ECHO=1
+source "${PROJECT_DIR}/log_common.sh"
 
 log_msg INFO "=== upload_and_cleanup.sh script started ==="
+
+# One offload/upload per card and per uplink, whether started by cron, the
+# shell or the web UI's job manager (which sets OFFLOAD_LOCK_HELD=1).
+if [ "${OFFLOAD_LOCK_HELD:-0}" != "1" ]; then
+    exec 8>"${LOG_DIR}/.lock-$(basename "${SD_MOUNT}")"
+    exec 9>"${LOG_DIR}/.lock-uplink"
+    if ! flock -n 8 || ! flock -n 9; then
+        log_msg WARN "Another offload or upload is already using the card or uplink. Exiting."
+        exit 0
+    fi
+    # The Python stages below run under these locks; tell them not to wait for them.
+    export OFFLOAD_LOCK_HELD=1
+fi
 log_msg DEBUG "Checking for rclone config file: ${RCLONE_CONFIG}"
 if [ ! -f "${RCLONE_CONFIG}" ]; then
     log_msg ERROR "Rclone config file not found at ${RCLONE_CONFIG}. Exiting."
@@ -96,46 +88,32 @@ log_msg INFO "Rclone config file found and readable."
 
 log_msg DEBUG "Defined source paths: VIDEO=${SD_MOUNT}/${VIDEO_REL_PATH}, PHOTO=${SD_MOUNT}/${PHOTO_REL_PATH}"
 
-log_msg INFO "Starting local copy (rsync)..."
-COPY_ERRORS=0
+export RCLONE_CONFIG RCLONE_REMOTE_NAME RCLONE_BASE_PATH
+export OFFLOAD_PATH="${LOCAL_BASE}"
 
-log_msg DEBUG "Checking video source directory: ${SD_MOUNT}/${VIDEO_REL_PATH}"
-if [ ! -d "${SD_MOUNT}/${VIDEO_REL_PATH}" ]; then
-    log_msg WARN "Video source directory ${SD_MOUNT}/${VIDEO_REL_PATH} not found. Skipping video copy."
-elif [ ! -r "${SD_MOUNT}/${VIDEO_REL_PATH}" ]; then
-    log_msg WARN "Video source directory ${SD_MOUNT}/${VIDEO_REL_PATH} not readable. Skipping video copy."
-else
-    log_msg INFO "Copying videos from ${SD_MOUNT}/${VIDEO_REL_PATH} to ${LOCAL_VIDEO}..."
-    rsync -av --no-perms --ignore-existing "${SD_MOUNT}/${VIDEO_REL_PATH}/" "${LOCAL_VIDEO}/" >> "${RCLONE_LOG}" 2>&1
-    RSYNC_V_EXIT=$?
-    if [ ${RSYNC_V_EXIT} -eq 0 ]; then
-        log_msg INFO "Video copy completed successfully."
-    else
-        log_msg ERROR "Error during video copy (exit code ${RSYNC_V_EXIT})."
-        COPY_ERRORS=1
-    fi
+if [ ! -f "${PROJECT_DIR}/offload_index.db" ]; then
+    log_msg INFO "No offload index yet; registering existing local footage."
+    "${PYTHON_BIN}" "${PROJECT_DIR}/offload_index.py" import-local "${LOCAL_BASE}" >&7 2>&1
 fi
 
-log_msg DEBUG "Checking photo source directory: ${SD_MOUNT}/${PHOTO_REL_PATH}"
-if [ ! -d "${SD_MOUNT}/${PHOTO_REL_PATH}" ]; then
-    log_msg WARN "Photo source directory ${SD_MOUNT}/${PHOTO_REL_PATH} not found. Skipping photo copy."
-elif [ ! -r "${SD_MOUNT}/${PHOTO_REL_PATH}" ]; then
-    log_msg WARN "Photo source directory ${SD_MOUNT}/${PHOTO_REL_PATH} not readable. Skipping photo copy."
+COPY_ERRORS=0
+if [ "${SKIP_LOCAL_COPY:-0}" = "1" ]; then
+    log_msg INFO "SKIP_LOCAL_COPY=1; local copy already done by the caller."
 else
-    log_msg INFO "Copying photos from ${SD_MOUNT}/${PHOTO_REL_PATH} to ${LOCAL_PHOTO}..."
-    rsync -av --no-perms --ignore-existing "${SD_MOUNT}/${PHOTO_REL_PATH}/" "${LOCAL_PHOTO}/" >> "${RCLONE_LOG}" 2>&1
-    RSYNC_P_EXIT=$?
-    if [ ${RSYNC_P_EXIT} -eq 0 ]; then
-        log_msg INFO "Photo copy completed successfully."
+    # offload_pipeline.py uploads each clip as soon as it lands, while the card
+    # is still being read; the upload phase below only sweeps up leftovers.
+    log_msg INFO "Starting pipelined copy + upload (offload_pipeline.py, ${OFFLOAD_WORKERS:-4} workers)..."
+    "${PYTHON_BIN}" "${PROJECT_DIR}/offload_pipeline.py" "${SD_MOUNT}" "${LOCAL_BASE}" >&7 2>&1 || COPY_ERRORS=1
+    if [ ${COPY_ERRORS} -eq 0 ]; then
+        log_msg INFO "Pipelined copy + upload completed successfully."
     else
-        log_msg ERROR "Error during photo copy (exit code ${RSYNC_P_EXIT})."
-        COPY_ERRORS=1
+        log_msg ERROR "Errors during pipelined copy + upload; see ${RCLONE_LOG} for per-file details."
     fi
 fi
 
 log_msg INFO "Local copy phase complete."
 if [ ${COPY_ERRORS} -ne 0 ]; then
-    log_msg WARN "There were errors during the local copy phase; some files might not have been copied."
+    log_msg WARN "There were errors during the copy + upload phase; the sweep below retries pending uploads."
 fi
 
 log_msg INFO "Starting upload phase (rclone)..."
@@ -148,47 +126,31 @@ if ! command -v rclone &> /dev/null; then
 fi
 log_msg INFO "rclone command is available: $(command -v rclone)"
 
-log_msg DEBUG "Performing rclone connectivity test (lsd)..."
-rclone lsd "${RCLONE_REMOTE_NAME}:" "${RCLONE_OPTS[@]}" --max-depth 1 > /dev/null 2>&1
-RCLONE_LSD_EXIT=$?
-if [ ${RCLONE_LSD_EXIT} -ne 0 ]; then
-    log_msg ERROR "Rclone failed to list remote '${RCLONE_REMOTE_NAME}:' (exit code ${RCLONE_LSD_EXIT}). Exiting."
-    exit 1
-fi
-log_msg INFO "Rclone connectivity test passed."
-
-log_msg DEBUG "Uploading videos if available..."
-if [ -z "$(ls -A "${LOCAL_VIDEO}" 2>/dev/null)" ]; then
-    log_msg INFO "No files in ${LOCAL_VIDEO}; skipping video upload."
+# uploader.py probes the remote, then uploads only what the offload index lists
+# as copied/verified but not yet uploaded, marking each file as rclone confirms it.
+"${PYTHON_BIN}" "${PROJECT_DIR}/uploader.py" >&7 2>&1 || UPLOAD_ERRORS=1
+if [ ${UPLOAD_ERRORS} -ne 0 ]; then
+    log_msg ERROR "Upload stage reported errors; see ${RCLONE_LOG}."
 else
-    log_msg INFO "Uploading videos from ${LOCAL_VIDEO} to ${RCLONE_REMOTE_NAME}:${RCLONE_BASE_PATH}/videos/"
-    rclone copy "${RCLONE_OPTS[@]}" "${LOCAL_VIDEO}" "${RCLONE_REMOTE_NAME}:${RCLONE_BASE_PATH}/videos/"
-    RCLONE_V_EXIT=$?
-    if [ ${RCLONE_V_EXIT} -ne 0 ]; then
-        log_msg ERROR "rclone video upload failed (exit code ${RCLONE_V_EXIT})."
-        UPLOAD_ERRORS=1
-    else
-        log_msg INFO "Video upload completed successfully."
-    fi
-fi
-
-log_msg DEBUG "Uploading photos if available..."
-if [ -z "$(ls -A "${LOCAL_PHOTO}" 2>/dev/null)" ]; then
-    log_msg INFO "No files in ${LOCAL_PHOTO}; skipping photo upload."
-else
-    log_msg INFO "Uploading photos from ${LOCAL_PHOTO} to ${RCLONE_REMOTE_NAME}:${RCLONE_BASE_PATH}/photos/"
-    rclone copy "${RCLONE_OPTS[@]}" "${LOCAL_PHOTO}" "${RCLONE_REMOTE_NAME}:${RCLONE_BASE_PATH}/photos/"
-    RCLONE_P_EXIT=$?
-    if [ ${RCLONE_P_EXIT} -ne 0 ]; then
-        log_msg ERROR "rclone photo upload failed (exit code ${RCLONE_P_EXIT})."
-        UPLOAD_ERRORS=1
-    else
-        log_msg INFO "Photo upload completed successfully."
-    fi
+    log_msg INFO "Upload stage completed successfully."
 fi
 
 log_msg INFO "Upload phase complete."
 
+# Cleanup: eviction.py deletes local copies only after checking each one on the
+# remote, and only once free space drops below EVICT_MIN_FREE_GB.
+log_msg INFO "Starting cleanup phase (eviction.py)..."
+"${PYTHON_BIN}" "${PROJECT_DIR}/eviction.py" >&7 2>&1 || log_msg WARN "Free space is still below the eviction watermark."
+case "${WIPE_CARD_AFTER_UPLOAD,,}" in
+    1|true|yes|on)
+        if [ ${COPY_ERRORS} -eq 0 ] && [ ${UPLOAD_ERRORS} -eq 0 ]; then
+            log_msg INFO "WIPE_CARD_AFTER_UPLOAD is set; removing verified clips from the card..."
+            "${PYTHON_BIN}" "${PROJECT_DIR}/eviction.py" wipe-card "${SD_MOUNT}" >&7 2>&1 || log_msg ERROR "Card wipe failed."
+        fi
+        ;;
+esac
+log_msg INFO "Cleanup phase complete."
+
 FINAL_EXIT_CODE=0
 if [ ${COPY_ERRORS} -ne 0 ] || [ ${UPLOAD_ERRORS} -ne 0 ]; then
     log_msg ERROR "Script encountered errors during execution."
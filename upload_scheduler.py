@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# upload_scheduler.py
+# Time-of-day bandwidth profiles for the upload stage.
+# upload_schedule.json holds windows such as "full speed overnight, 2M during
+# shoots". Every rclone upload starts with the matching --bwlimit timetable and
+# its remote-control API enabled; the web app's scheduler thread then pushes
+# limit changes to the running rclone (core/bwlimit) without restarting it.
+# Transfers and drive chunk size are picked from the RAM free at start and
+# capped by the Wi-Fi link's quality (network_monitor.py).
+#   ./upload_scheduler.py        print the active profile and tuned options
+
+import re
+import json
+import base64
+import hashlib
+import logging
+import datetime
+import threading
+import urllib.error
+import urllib.request
+
+import psutil
+
+import config
+import network_monitor
+
+# --- Configuration ---
+RC_ADDR = config.get_str("RCLONE_RC_ADDR", "127.0.0.1:5572")
+RC_USER = "offloader"
+TICK_SECONDS = 30
+MEMORY_FRACTION = 0.25  # share of available RAM rclone's chunk buffers may use
+CHUNK_SIZES_MB = (256, 128, 64, 32, 16, 8)
+MIN_CHUNK_MB = 32  # below this, run fewer transfers rather than smaller chunks
+BUFFER_MB = 16  # rclone's default --buffer-size, held per transfer
+MAX_TRANSFERS = 4
+
+DEFAULT_SCHEDULE = {
+    "default_bwlimit": "off",
+    "max_transfers": MAX_TRANSFERS,
+    "profiles": [],
+}
+
+# rclone bandwidth: "off", or a rate like 512k / 2M, optionally upload:download.
+_RATE = r"\d+(\.\d+)?[bBkKMGTP]?i?"
+BWLIMIT_PATTERN = re.compile(rf"^(off|{_RATE}(:{_RATE})?)$")
+TIME_PATTERN = re.compile(r"^([01]\d|2[0-3]):[0-5]\d$")
+
+logger = logging.getLogger("upload_scheduler")
+
+
+# --- Schedule ---
+def load_schedule():
+    schedule = dict(DEFAULT_SCHEDULE)
+    schedule.update(config.upload_schedule() or {})
+    return schedule
+
+
+def validate_schedule(schedule):
+    """Raises ValueError describing the first invalid field."""
+    if not BWLIMIT_PATTERN.match(str(schedule.get("default_bwlimit", ""))):
+        raise ValueError(f"Invalid default bandwidth limit '{schedule.get('default_bwlimit')}'.")
+    if not 1 <= int(schedule.get("max_transfers", MAX_TRANSFERS)) <= 16:
+        raise ValueError("Max transfers must be between 1 and 16.")
+    for profile in schedule.get("profiles", []):
+        name = profile.get("name") or "(unnamed)"
+        for key in ("start", "end"):
+            if not TIME_PATTERN.match(profile.get(key, "")):
+                raise ValueError(f"Profile '{name}': {key} time must be HH:MM.")
+        if not BWLIMIT_PATTERN.match(str(profile.get("bwlimit", ""))):
+            raise ValueError(f"Profile '{name}': invalid bandwidth limit '{profile.get('bwlimit')}'.")
+        if profile.get("transfers") is not None and not 1 <= int(profile["transfers"]) <= 16:
+            raise ValueError(f"Profile '{name}': transfers must be between 1 and 16.")
+
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def _in_window(profile, minute):
+    start, end = _minutes(profile["start"]), _minutes(profile["end"])
+    if start == end:
+        return True
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end  # window crosses midnight
+
+
+def active_profile(schedule=None, now=None):
+    """Returns the first profile whose window contains now, or None."""
+    schedule = schedule or load_schedule()
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    for profile in schedule.get("profiles", []):
+        if _in_window(profile, minute):
+            return profile
+    return None
+
+
+def current_bwlimit(schedule=None, now=None):
+    schedule = schedule or load_schedule()
+    profile = active_profile(schedule, now)
+    return profile["bwlimit"] if profile else schedule.get("default_bwlimit", "off")
+
+
+def bwlimit_timetable(schedule=None):
+    """The schedule as an rclone --bwlimit timetable, so runs outside the web app follow it too."""
+    schedule = schedule or load_schedule()
+    profiles = schedule.get("profiles", [])
+    if not profiles:
+        return schedule.get("default_bwlimit", "off")
+    points = {}
+    for profile in profiles:
+        points.setdefault(profile["end"], None)
+    for profile in profiles:
+        points[profile["start"]] = None
+    # Evaluate each change point with the same first-match rule as active_profile.
+    entries = []
+    for hhmm in sorted(points, key=_minutes):
+        minute = _minutes(hhmm)
+        match = next((p for p in profiles if _in_window(p, minute)), None)
+        entries.append(f"{hhmm},{match['bwlimit'] if match else schedule.get('default_bwlimit', 'off')}")
+    return " ".join(entries)
+
+
+def tuned_options(schedule=None, available=None, link=None):
+    """Picks transfers and drive chunk size so their buffers fit in a share of free RAM and suit the link.
+
+    A weak Wi-Fi link gets one transfer with small chunks, a fair one half the
+    configured transfers, and never more than recent uploads showed to be worth
+    running; link is a network_monitor.current() dict (read now if None).
+    """
+    schedule = schedule or load_schedule()
+    profile = active_profile(schedule)
+    max_transfers = int((profile or {}).get("transfers") or schedule.get("max_transfers", MAX_TRANSFERS))
+    link_limits = network_monitor.limits(max_transfers, link)
+    max_transfers = link_limits["transfers"]
+    chunk_sizes = [c for c in CHUNK_SIZES_MB if c <= (link_limits["chunk_mb"] or c)]
+    if available is None:
+        available = psutil.virtual_memory().available
+    budget_mb = available / (1024 * 1024) * MEMORY_FRACTION
+    transfers, chunk_mb = 1, CHUNK_SIZES_MB[-1]
+    for candidate in range(max_transfers, 0, -1):
+        fit = next((c for c in chunk_sizes
+                    if (c >= MIN_CHUNK_MB or candidate == 1) and candidate * (c + BUFFER_MB) <= budget_mb), None)
+        if fit:
+            transfers, chunk_mb = candidate, fit
+            break
+    return {"transfers": transfers, "checkers": transfers * 2, "chunk_size": f"{chunk_mb}M",
+            "available_mb": int(available / (1024 * 1024)), "link": link_limits["quality"]}
+
+
+# --- rclone remote control ---
+def rc_password():
+    # Derived from the app secret so the web app and cron/shell runs agree without another setting.
+    secret = config.get_str("RCLONE_RC_PASS", "") or config.get_str("FLASK_SECRET_KEY", "")
+    return hashlib.sha256(f"rclone-rc:{secret}".encode()).hexdigest()[:32]
+
+
+def rclone_args(schedule=None, remote_control=True):
+    """Extra rclone flags for an upload: tuned concurrency, bwlimit timetable, remote control.
+
+    Only one rclone at a time can own RC_ADDR; side uploads pass remote_control=False.
+    """
+    schedule = schedule or load_schedule()
+    tuned = tuned_options(schedule)
+    args = ["--transfers", str(tuned["transfers"]), "--checkers", str(tuned["checkers"]),
+            "--drive-chunk-size", tuned["chunk_size"], "--bwlimit", bwlimit_timetable(schedule)]
+    return args + ["--rc", "--rc-addr", RC_ADDR] if remote_control else args
+
+
+def rclone_env():
+    """rc credentials go in the environment rather than argv, where any local user could read them."""
+    return {"RCLONE_RC_USER": RC_USER, "RCLONE_RC_PASS": rc_password()}
+
+
+def rc_call(method, params=None, timeout=5):
+    """Calls the running rclone's rc API. Returns the decoded reply, or None if none is listening."""
+    request = urllib.request.Request(f"http://{RC_ADDR}/{method}", data=json.dumps(params or {}).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    token = base64.b64encode(f"{RC_USER}:{rc_password()}".encode()).decode()
+    request.add_header("Authorization", f"Basic {token}")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read() or b"{}")
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+
+
+class UploadScheduler:
+    """Keeps the running rclone's bandwidth limit in line with the schedule.
+
+    on_window_open(profile) is called when a profile with "start_upload" set
+    becomes active, so uploads can be kicked off at the start of a window.
+    """
+
+    def __init__(self, on_window_open=None, tick=TICK_SECONDS):
+        self.on_window_open = on_window_open
+        self.tick = tick
+        self._wake = threading.Event()
+        self._thread = None
+        self._applied = None  # (rclone pid, rate) last pushed over rc
+        self._last_profile = None
+        self._rclone_pid = None
+
+    def start(self):
+        if self._thread is None:
+            self._last_profile = (active_profile() or {}).get("name")
+            self._thread = threading.Thread(target=self._run, name="upload-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def refresh(self):
+        """Re-evaluates immediately, e.g. after the schedule was edited."""
+        self._wake.set()
+
+    def status(self):
+        schedule = load_schedule()
+        profile = active_profile(schedule)
+        return {
+            "active_profile": profile["name"] if profile else None,
+            "bwlimit": current_bwlimit(schedule),
+            "timetable": bwlimit_timetable(schedule),
+            "rclone_running": self._rclone_pid is not None,
+            "applied_bwlimit": self._applied[1] if self._applied else None,
+            "tuned": tuned_options(schedule),
+        }
+
+    def _run(self):
+        while True:
+            try:
+                self._apply()
+            except Exception as e:
+                logger.error(f"Upload scheduler tick failed: {e}", exc_info=True)
+            self._wake.wait(self.tick)
+            self._wake.clear()
+
+    def _apply(self):
+        schedule = load_schedule()
+        profile = active_profile(schedule)
+        name = profile["name"] if profile else None
+        if name != self._last_profile:
+            self._last_profile = name
+            logger.info(f"Upload schedule: now in '{name or 'default'}' ({current_bwlimit(schedule)}).")
+            if profile and profile.get("start_upload") and self.on_window_open:
+                self.on_window_open(profile)
+        reply = rc_call("core/pid")
+        self._rclone_pid = reply.get("pid") if reply else None
+        if self._rclone_pid is None:
+            return
+        rate = current_bwlimit(schedule)
+        if self._applied != (self._rclone_pid, rate):
+            if rc_call("core/bwlimit", {"rate": rate}) is not None:
+                logger.info(f"Set running rclone (pid {self._rclone_pid}) bandwidth limit to {rate}.")
+                self._applied = (self._rclone_pid, rate)
+
+
+if __name__ == "__main__":
+    schedule = load_schedule()
+    profile = active_profile(schedule)
+    print(f"Active profile: {profile['name'] if profile else '(default)'}")
+    print(f"Bandwidth limit: {current_bwlimit(schedule)}")
+    print(f"Timetable: {bwlimit_timetable(schedule)}")
+    print(f"Tuned options: {tuned_options(schedule)}")
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# uploader.py
+# Upload stage: pushes clips the offload index lists as pending to the rclone
+# remote. rclone runs with --use-json-log so per-file results and --stats
+# snapshots can be parsed, recorded in the index and published on the event bus.
+# Files rclone fails on go to retry_queue; `retry` re-sends only those.
+# With PHOTO_BUNDLE_MB set, small photos go up packed in tar bundles (bundler.py).
+# Clips remote_cache.py already lists on the remote at the same size are marked
+# uploaded without running rclone for them.
+#   ./uploader.py            upload everything pending
+#   ./uploader.py retry      re-send queued failures that are due (--force: all of them)
+
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+
+import bundler
+import config
+import event_bus
+import metrics
+import offload_index
+import remote_cache
+import retry_queue
+import throughput
+import upload_scheduler
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCAL_BASE = config.get_str("OFFLOAD_PATH", os.path.join(BASE_DIR, "footage"))
+_rclone = config.rclone_settings()
+RCLONE_CONFIG_PATH = _rclone["config_path"]
+RCLONE_REMOTE_NAME = _rclone["remote_name"]
+RCLONE_BASE_PATH = _rclone["base_path"]
+CATEGORIES = ("videos", "photos")
+STATS_INTERVAL = "2s"
+RCLONE_EXIT_DIR_NOT_FOUND = 3
+RCLONE_EXIT_FILE_NOT_FOUND = 4
+
+RCLONE_OPTS = [
+    "--config", RCLONE_CONFIG_PATH,
+    "--log-level", "INFO",
+    "--use-json-log",
+    "--stats", STATS_INTERVAL,
+    "--stats-log-level", "NOTICE",
+    "--contimeout", "60s",
+    "--timeout", "300s",
+    "--retries", "3",
+    "--low-level-retries", "10",
+]  # transfers, chunk size and --bwlimit come from upload_scheduler per run
+
+logger = logging.getLogger("uploader")
+
+UPLOADED_BYTES = metrics.counter("uploaded_bytes_total", "Bytes confirmed on the remote.", ("category",))
+UPLOADED_FILES = metrics.counter("uploaded_files_total", "Files confirmed on the remote.", ("category", "method"))
+# rclone's log has no per-file duration; this is the time from its start to each file's "Copied" line.
+CONFIRM_SECONDS = metrics.histogram("upload_confirm_seconds", "Time from rclone start until a file is confirmed.",
+                                    ("category",), metrics.TRANSFER_BUCKETS)
+BATCH_SECONDS = metrics.histogram("upload_batch_seconds", "Duration of one rclone upload run.",
+                                  ("category", "result"), metrics.TRANSFER_BUCKETS)
+RETRIED_FILES = metrics.counter("upload_retries_total", "Files re-sent from the retry queue.", ("category",))
+
+
+def remote_path(category):
+    return f"{RCLONE_REMOTE_NAME}:{RCLONE_BASE_PATH}/{category}/"
+
+
+def parse_log_line(line):
+    """Decodes one line of rclone --use-json-log output, logging messages (not stats)."""
+    try:
+        entry = json.loads(line)
+    except json.JSONDecodeError:
+        entry = {"level": "error", "msg": line}
+    if "stats" not in entry:
+        log = logger.error if entry.get("level") == "error" else logger.info
+        obj = f"{entry['object']}: " if entry.get("object") else ""
+        log(f"rclone: {obj}{entry.get('msg', '').strip()}")
+    return entry
+
+
+def run_rclone(args, on_entry=None, control=None, extra_env=None):
+    """Runs rclone with RCLONE_OPTS, calling on_entry for every parsed JSON log line.
+
+    Lines that are not JSON (rclone's own startup errors) become {"level": "error", "msg": line}.
+    Returns rclone's exit code.
+    """
+    cmd = ["rclone"] + args + RCLONE_OPTS
+    env = dict(os.environ, **extra_env) if extra_env else None
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True, start_new_session=True, env=env)
+    if control is not None:
+        control.attach_process(process)
+    for line in process.stderr:
+        line = line.strip()
+        if not line:
+            continue
+        entry = parse_log_line(line)
+        if on_entry:
+            on_entry(entry)
+    return process.wait()
+
+
+class RemoteError(Exception):
+    """The remote could not be asked; says nothing about whether a file is there."""
+
+
+def remote_stat(category, rel_path):
+    """Returns rclone's lsjson record (Size, ModTime, Hashes) for one remote file, or None if it is absent.
+
+    Raises RemoteError when the lookup itself fails (network, auth, rclone missing).
+    """
+    try:
+        result = subprocess.run(["rclone", "lsjson", "--hash", "--config", RCLONE_CONFIG_PATH,
+                                 remote_path(category) + rel_path], capture_output=True, text=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise RemoteError(f"rclone lsjson failed: {e}") from e
+    if result.returncode in (RCLONE_EXIT_DIR_NOT_FOUND, RCLONE_EXIT_FILE_NOT_FOUND):
+        return None
+    if result.returncode != 0:
+        raise RemoteError(f"rclone lsjson exited with code {result.returncode}: {result.stderr.strip()[-200:]}")
+    try:
+        entries = json.loads(result.stdout)
+    except ValueError as e:
+        raise RemoteError(f"Unreadable rclone lsjson output: {e}") from e
+    return entries[0] if entries else None
+
+
+def check_remote():
+    """Connectivity probe (`rclone about`, cached for a minute); returns True if the remote answers."""
+    return remote_cache.health()["ok"]
+
+
+def upload_category(conn, category, control=None):
+    """Uploads one category's pending files. Returns (files uploaded, rclone exit code)."""
+    rows = offload_index.pending_uploads(conn, category)
+    if not rows:
+        logger.info(f"No pending {category} in the offload index; skipping {category} upload.")
+        return 0, 0
+    return upload_rows(conn, category, rows, control)
+
+
+def upload_rows(conn, category, rows, control=None, order_by=None, local_base=LOCAL_BASE, on_uploaded=None):
+    """Uploads the given index rows of one category in a single rclone run.
+
+    Where bundling is on for the category, small files are first sent as
+    bundles (one rcat each) and only the rest go through `rclone copy`. Rows
+    remote_cache already lists at the same size are confirmed without sending.
+    order_by is passed to rclone's --order-by (e.g. "size,descending").
+    on_uploaded(row), if given, is called for every file confirmed on the remote.
+    Returns (files uploaded, rclone exit code).
+    """
+    if control is not None:
+        control.begin(sum(row["size"] for row in rows), len(rows))
+    # The pipeline queues only category, local_path and size; the cache check needs the modtime and hash.
+    rows = bundler.indexed_rows(conn, rows, local_base)
+    cached = remote_cache.present(conn, rows)
+    if cached:
+        paths = [row["local_path"] for row in cached]
+        offload_index.mark_local(conn, paths, offload_index.STATE_UPLOADED)
+        retry_queue.clear(conn, paths)
+        for row in cached:
+            if control is not None:
+                control.checkpoint(row["size"])
+            _confirm_uploaded(category, row, "cached", control, on_uploaded)
+        logger.info(f"{len(cached)} {category} are already on the remote (remote cache); not sending them.")
+        skip = set(paths)
+        rows = [row for row in rows if row["local_path"] not in skip]
+        if not rows:
+            return len(cached), 0
+    sent, bundle_exit = len(cached), 0
+    if bundler.enabled(category):
+        bundles, rows = bundler.plan(rows)
+        for bundle_rows in bundles:
+            if control is not None and control.cancelled:
+                return sent, bundle_exit
+            count, exit_code = upload_bundle(conn, category, bundle_rows, control, local_base, on_uploaded)
+            sent += count
+            bundle_exit = bundle_exit or exit_code
+        if not rows:
+            return sent, bundle_exit
+    count, exit_code = _copy_rows(conn, category, rows, control, order_by, local_base, on_uploaded)
+    return sent + count, exit_code or bundle_exit
+
+
+def _confirm_uploaded(category, row, method, control=None, on_uploaded=None):
+    UPLOADED_BYTES.inc(row["size"], category=category)
+    UPLOADED_FILES.inc(category=category, method=method)
+    if control is not None:
+        control.file_done()
+    event_bus.publish("transfer", event="file_uploaded", category=category,
+                      name=os.path.relpath(row["local_path"], category), size=row["size"])
+    if on_uploaded:
+        on_uploaded(row)
+
+
+def upload_bundle(conn, category, rows, control=None, local_base=LOCAL_BASE, on_uploaded=None):
+    """Streams rows as one tar bundle into `rclone rcat`, then uploads its index. Returns (files, exit code)."""
+    rows = bundler.indexed_rows(conn, rows, local_base)
+    bundle = bundler.Bundle(rows, local_base)
+    target = remote_path(bundler.BUNDLE_DIR) + bundle.path
+    logger.info(f"Uploading {len(rows)} {category} as bundle {bundle.path} ({bundle.size / 1024**2:.1f} MB)")
+    started = time.monotonic()
+    cmd = (["rclone", "rcat", "--size", str(bundle.size), target] + RCLONE_OPTS
+           + upload_scheduler.rclone_args())
+    env = dict(os.environ, **upload_scheduler.rclone_env())
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               text=False, start_new_session=True, env=env)
+    if control is not None:
+        control.attach_process(process)
+    errors = []
+
+    def drain():
+        for raw in process.stderr:
+            line = raw.decode("utf-8", errors="replace").strip()
+            if line and parse_log_line(line).get("level") == "error":
+                errors.append(line)
+
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+    error = None
+    try:
+        bundle.write(process.stdin, checkpoint=control.checkpoint if control is not None else None)
+        process.stdin.close()
+        exit_code = process.wait()
+        if exit_code != 0:
+            error = f"rclone rcat exited with code {exit_code}"
+    except (bundler.BundleError, OSError) as e:
+        process.kill()
+        exit_code = process.wait() or 1
+        error = str(e)
+    finally:
+        reader.join()
+    if error is None:
+        error = _verify_bundle(bundle)
+    if error is None:
+        index = json.dumps(bundle.index(), indent=1).encode()
+        try:
+            result = subprocess.run(["rclone", "rcat", "--size", str(len(index)), target + bundler.INDEX_SUFFIX,
+                                     "--config", RCLONE_CONFIG_PATH], input=index, capture_output=True, timeout=300)
+            if result.returncode != 0:
+                error = f"index upload exited with code {result.returncode}"
+        except (OSError, subprocess.TimeoutExpired) as e:
+            error = f"index upload failed: {e}"
+    BATCH_SECONDS.observe(time.monotonic() - started, category=category, result="ok" if error is None else "error")
+    if error is not None:
+        if control is not None and control.cancelled:
+            return 0, exit_code or 1
+        logger.error(f"Bundle {bundle.path} failed ({error}); {len(rows)} {category} queued for retry.")
+        for row in rows:
+            retry_queue.record_failure(conn, row["local_path"], category, f"bundle: {error}")
+        return 0, exit_code or 1
+    bundler.record(conn, bundle.index())
+    remote_cache.record(conn, [(f"{bundler.BUNDLE_DIR}/{bundle.path}", bundle.size, None, None),
+                               (f"{bundler.BUNDLE_DIR}/{bundle.path}{bundler.INDEX_SUFFIX}", len(index), None, None)])
+    throughput.record(conn, throughput.UPLOAD, bundle.size, time.monotonic() - started)
+    paths = [row["local_path"] for row in rows]
+    offload_index.mark_local(conn, paths, offload_index.STATE_UPLOADED)
+    retry_queue.clear(conn, paths)
+    for row in rows:
+        _confirm_uploaded(category, row, "bundle", control, on_uploaded)
+    logger.info(f"Bundle {bundle.path} uploaded: {len(rows)} files in {time.monotonic() - started:.1f}s.")
+    return len(rows), 0
+
+
+def _verify_bundle(bundle):
+    """Checks the uploaded bundle's size (and md5 where the remote has one). Returns an error or None."""
+    try:
+        record = remote_stat(bundler.BUNDLE_DIR, bundle.path)
+    except RemoteError as e:
+        return f"could not verify the bundle: {e}"
+    if record is None:
+        return "bundle not found on the remote after upload"
+    if record.get("Size") != bundle.size:
+        return f"remote size {record.get('Size')} != bundle size {bundle.size}"
+    remote_md5 = (record.get("Hashes") or {}).get("md5")
+    if remote_md5 and remote_md5 != bundle.md5:
+        return f"remote md5 {remote_md5} != bundle md5 {bundle.md5}"
+    return None
+
+
+def _copy_rows(conn, category, rows, control=None, order_by=None, local_base=LOCAL_BASE, on_uploaded=None):
+    prefix = category + "/"
+    pending = {row["local_path"][len(prefix):]: row for row in rows}
+    scheduled_args = upload_scheduler.rclone_args()
+    if order_by:
+        scheduled_args += ["--order-by", order_by]
+    logger.info(f"Uploading {len(rows)} {category} to {remote_path(category)} "
+                f"({' '.join(scheduled_args[:8])})")
+    uploaded = set()
+    failed = {}
+    state = {"bytes": 0}
+    started = time.monotonic()
+
+    def on_entry(entry):
+        stats = entry.get("stats")
+        if stats is not None:
+            delta = stats.get("bytes", 0) - state["bytes"]
+            state["bytes"] = stats.get("bytes", 0)
+            if control is not None and delta > 0:
+                control.checkpoint(delta)
+            event_bus.publish("transfer", event="upload_progress", category=category,
+                              bytes=stats.get("bytes", 0), total_bytes=stats.get("totalBytes", 0),
+                              speed=stats.get("speed", 0), eta=stats.get("eta"),
+                              transferring=[t.get("name") for t in stats.get("transferring") or []])
+        elif entry.get("object") in pending and entry.get("msg", "").startswith("Copied"):
+            name = entry["object"]
+            uploaded.add(name)
+            remote_cache.record(conn, [remote_cache.clip_object(prefix + name, pending[name])], commit=False)
+            offload_index.mark_local(conn, [prefix + name], offload_index.STATE_UPLOADED)
+            CONFIRM_SECONDS.observe(time.monotonic() - started, category=category)
+            _confirm_uploaded(category, pending[name], "rclone", control, on_uploaded)
+        elif entry.get("object") in pending and entry.get("level") == "error":
+            failed[entry["object"]] = entry.get("msg", "").strip()
+
+    with tempfile.NamedTemporaryFile("w", prefix=f"pending_{category}_", suffix=".txt") as list_file:
+        list_file.write("\n".join(pending) + "\n")
+        list_file.flush()
+        exit_code = run_rclone(["copy", "--files-from-raw", list_file.name, "--no-traverse",
+                                os.path.join(local_base, category), remote_path(category)] + scheduled_args,
+                               on_entry, control, upload_scheduler.rclone_env())
+    BATCH_SECONDS.observe(time.monotonic() - started, category=category, result="ok" if exit_code == 0 else "error")
+    if exit_code == 0:
+        throughput.record(conn, throughput.UPLOAD, sum(row["size"] for row in rows), time.monotonic() - started)
+        # Files already identical on the remote are skipped silently; a clean
+        # exit means everything in the list is there.
+        unreported = [name for name in pending if name not in uploaded]
+        remote_cache.record(conn, [remote_cache.clip_object(prefix + name, pending[name]) for name in unreported],
+                            commit=False)
+        offload_index.mark_local(conn, [prefix + name for name in unreported], offload_index.STATE_UPLOADED)
+        retry_queue.clear(conn, [prefix + name for name in pending])
+        for name in unreported:
+            if control is not None:
+                control.checkpoint(pending[name]["size"])
+            _confirm_uploaded(category, pending[name], "rclone", control, on_uploaded)
+        logger.info(f"Upload of {category} completed successfully.")
+        return len(uploaded) + len(unreported), exit_code
+    retry_queue.clear(conn, [prefix + name for name in uploaded])
+    if control is not None and control.cancelled:
+        return len(uploaded), exit_code
+    # Only files rclone named in an error are certain failures; the rest of an
+    # aborted run are queued too, since nothing confirmed them.
+    for name in pending:
+        if name not in uploaded:
+            retry_queue.record_failure(conn, prefix + name, category,
+                                       failed.get(name) or f"rclone exited with code {exit_code}")
+    logger.error(f"rclone {category} upload failed (exit code {exit_code}); "
+                 f"{len(uploaded)} of {len(pending)} files confirmed, "
+                 f"{len(pending) - len(uploaded)} queued for retry.")
+    return len(uploaded), exit_code
+
+
+def upload_pending(control=None):
+    """Uploads every pending category. Returns a summary dict."""
+    summary = {"files_uploaded": 0, "errors": []}
+    if not check_remote():
+        summary["errors"].append(f"Remote '{RCLONE_REMOTE_NAME}:' is not reachable")
+        return summary
+    conn = offload_index.connect()
+    try:
+        remote_cache.reconcile_if_due(conn)
+        for category in CATEGORIES:
+            if control is not None and control.cancelled:
+                break
+            count, exit_code = upload_category(conn, category, control)
+            summary["files_uploaded"] += count
+            if exit_code != 0:
+                summary["errors"].append(f"{category} upload failed (exit code {exit_code})")
+    finally:
+        conn.close()
+    return summary
+
+
+def retry_failed(control=None, force=False):
+    """Re-sends only the files in the retry queue that are due (all of them with force).
+
+    Each category goes up in one rclone run over just those paths, with
+    --no-traverse, so recovering a few clips never re-lists the remote.
+    Returns a summary dict like upload_pending's.
+    """
+    summary = {"files_uploaded": 0, "errors": []}
+    conn = offload_index.connect()
+    try:
+        rows = retry_queue.due(conn, force=force)
+        if not rows:
+            logger.info("Retry queue: nothing due.")
+            return summary
+        logger.info(f"Retry queue: {len(rows)} files due.")
+        if not check_remote():
+            summary["errors"].append(f"Remote '{RCLONE_REMOTE_NAME}:' is not reachable")
+            logger.error(f"{summary['errors'][-1]}; failures stay queued.")
+            return summary
+        by_category = {}
+        for row in rows:
+            if not os.path.exists(os.path.join(LOCAL_BASE, row["local_path"])):
+                logger.warning(f"Retry queue: {row['local_path']} is no longer on local disk; dropping it.")
+                retry_queue.clear(conn, [row["local_path"]])
+                continue
+            by_category.setdefault(row["category"], []).append(row)
+        for category, category_rows in by_category.items():
+            if control is not None and control.cancelled:
+                break
+            RETRIED_FILES.inc(len(category_rows), category=category)
+            count, exit_code = upload_rows(conn, category, category_rows, control)
+            summary["files_uploaded"] += count
+            if exit_code != 0:
+                summary["errors"].append(f"{category} retry failed (exit code {exit_code})")
+    finally:
+        conn.close()
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    if len(sys.argv) > 1 and sys.argv[1] == "retry":
+        result = retry_failed(force="--force" in sys.argv[2:])
+    else:
+        result = upload_pending()
+    sys.exit(1 if result["errors"] else 0)